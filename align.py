@@ -0,0 +1,421 @@
+"""Built-in alignment with OpenCV, an in-process alternative to align_image_stack.
+
+Every image of a bracket is registered to its middle exposure with ECC
+(cv2.findTransformECC), coarse to fine over a pyramid of their downscaled luminance.
+The images are brought to the same brightness by their EV difference first, and
+pixels that are clipped or in the noise of an exposure are left out. The result is a
+Euclidean transform (a rotation and a shift) per image, which is cheap to store, so
+the frames are only warped in memory when they are loaded for merging.
+
+The transforms are cached per bracket in Merged/alignment.json. Re-runs reuse them
+while the images are unchanged, and other brackets start their search from the
+transforms of the nearest bracket that has been aligned, which on a tripod is
+already close.
+
+Brackets shot from the same camera position, e.g. on a panoramic head, are out of
+line in nearly the same way. With per_position, AlignmentCache.align() recognises
+the position by a thumbnail of the middle exposure, estimates the transforms once
+for it and only checks how well they line up the images of its other brackets,
+estimating them again when they don't.
+"""
+
+import json
+import os
+import pathlib
+import threading
+import time
+
+from image_io import load_image, luminance, require
+from manifest import SAVE_INTERVAL, file_fingerprint, partial_path
+
+# Changing how transforms are estimated invalidates the cached ones
+ALIGN_VERSION = 1
+# Longest side of the luminance images the transforms are estimated on
+WORK_SIZE = 1024
+# Coarsest pyramid level to start the search on
+MIN_SIZE = 128
+# Per pyramid level, the search stops once an update moves less than ECC_EPS
+ECC_ITERATIONS = 50
+ECC_EPS = 1e-3  # Pixels
+# Pixels outside this range (linear, of the image's own exposure) are left out
+NOISE_FLOOR = 0.002
+CLIP_LEVEL = 0.95
+# Brackets whose reference images are this alike were shot from the same position
+POSITION_MATCH = 0.9
+# Reused transforms may correlate this much worse than for the bracket they were
+# estimated on before they are estimated again
+CHECK_TOLERANCE = 0.01
+
+
+def identity() -> list:
+    return [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+
+def is_identity(transform) -> bool:
+    return transform is None or transform == identity()
+
+
+def reference_index(evs: list) -> int:
+    """The image the others are aligned to: the middle exposure."""
+    order = sorted(range(len(evs)), key=lambda k: evs[k])
+    return order[len(order) // 2]
+
+
+def scale_transform(transform, factor: float):
+    """A transform for images scaled by factor, e.g. 0.5 for half the size."""
+    np = require("numpy")
+    scaled = np.array(transform, dtype=np.float32)
+    scaled[:, 2] *= factor
+    return scaled
+
+
+def prepare(img, gain: float, size: tuple):
+    """Downscaled, exposure matched and gamma encoded luminance of img, with a mask
+    of the pixels that are well exposed in img itself."""
+    cv2 = require("cv2", "opencv-python")
+    np = require("numpy")
+
+    lum = cv2.resize(luminance(img), size, interpolation=cv2.INTER_AREA)
+    mask = ((lum > NOISE_FLOOR) & (lum < CLIP_LEVEL)).astype(np.uint8)
+    lum *= gain
+    np.clip(lum, 0.0, 1.0, out=lum)
+    # Gamma encoding spreads the shadows so they count as much as the highlights
+    np.power(lum, 1 / 2.2, out=lum)
+    return lum, mask
+
+
+def pyramid(img, mask) -> list:
+    """[(image, mask), ...] from the coarsest level to img itself."""
+    cv2 = require("cv2", "opencv-python")
+    levels = [(img, mask)]
+    while max(img.shape) // 2 >= MIN_SIZE:
+        img = cv2.pyrDown(img)
+        mask = cv2.resize(
+            mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST
+        )
+        levels.append((img, mask))
+    return levels[::-1]
+
+
+def find_transform(template: list, image: list, init=None) -> tuple:
+    """Register the pyramid of image to that of template with ECC.
+
+    init is a starting transform for the finest level. Returns the transform for
+    the finest level and the correlation it reached (1 is a perfect match)."""
+    cv2 = require("cv2", "opencv-python")
+    np = require("numpy")
+
+    criteria = (
+        cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+        ECC_ITERATIONS,
+        ECC_EPS,
+    )
+    levels = len(template)
+    matrix = scale_transform(identity() if init is None else init, 0.5 ** (levels - 1))
+    correlation = 0.0
+    for level, ((template_img, _), (img, mask)) in enumerate(zip(template, image)):
+        if level:
+            matrix[:, 2] *= 2
+        try:
+            # A copy, as the matrix is left half updated if ECC doesn't converge
+            correlation, matrix = cv2.findTransformECC(
+                template_img,
+                img,
+                matrix.copy(),
+                cv2.MOTION_EUCLIDEAN,
+                criteria,
+                mask,
+                5,
+            )
+        except cv2.error:
+            # Not enough detail at this level, the finer ones may still converge
+            continue
+    return np.asarray(matrix, dtype=np.float32), float(correlation)
+
+
+class PreparedBracket:
+    """The downscaled luminance pyramids of the images of a bracket.
+
+    Only these are kept, not the images themselves. The images are loaded at
+    1/load_scale of their size (see load_image), and their transforms are in
+    pixels of that size."""
+
+    def __init__(self, img_list: list, load_scale: int = 1):
+        images = [i.split("___") for i in img_list]
+        evs = [float(ev) for path, ev in images]
+        self.ref = reference_index(evs)
+        self.levels = []
+        for path, ev in images:
+            img = load_image(pathlib.Path(path), load_scale)
+            # The images of a bracket all have the same size
+            height, width = img.shape[:2]
+            self.scale = min(1.0, WORK_SIZE / max(height, width))
+            size = (
+                max(1, round(width * self.scale)),
+                max(1, round(height * self.scale)),
+            )
+            # Each EV step is a factor of 2, brighter images have a lower EV
+            gain = 2.0 ** (float(ev) - evs[self.ref])
+            self.levels.append(pyramid(*prepare(img, gain, size)))
+            del img
+
+    def thumbnail(self):
+        """The coarsest level of the reference image, to recognise the view by."""
+        return self.levels[self.ref][0][0]
+
+    def estimate(self, init: list = None) -> tuple:
+        """Estimate the transform of every image, starting from init if given.
+
+        Returns the transforms, in pixels of the loaded images and in the order of
+        the images, and the correlation each reached."""
+        transforms = []
+        correlations = []
+        for k, levels in enumerate(self.levels):
+            if k == self.ref:
+                transforms.append(identity())
+                correlations.append(1.0)
+                continue
+            start = None if init is None else scale_transform(init[k], self.scale)
+            matrix, correlation = find_transform(self.levels[self.ref], levels, start)
+            transforms.append(scale_transform(matrix, 1 / self.scale).tolist())
+            correlations.append(correlation)
+        return transforms, correlations
+
+    def check(self, transforms: list) -> list:
+        """The correlation of every image with the reference once warped with
+        transforms, without searching for better ones."""
+        cv2 = require("cv2", "opencv-python")
+        template = self.levels[self.ref][-1][0]
+        height, width = template.shape
+        correlations = []
+        for k, levels in enumerate(self.levels):
+            if k == self.ref:
+                correlations.append(1.0)
+                continue
+            img, mask = levels[-1]
+            matrix = scale_transform(transforms[k], self.scale)
+            flags = cv2.WARP_INVERSE_MAP
+            img = cv2.warpAffine(
+                img, matrix, (width, height), flags=cv2.INTER_LINEAR | flags
+            )
+            mask = cv2.warpAffine(
+                mask, matrix, (width, height), flags=cv2.INTER_NEAREST | flags
+            )
+            try:
+                correlations.append(cv2.computeECC(template, img, mask))
+            except cv2.error:
+                correlations.append(0.0)
+        return correlations
+
+
+def estimate_transforms(img_list: list, init: list = None) -> tuple:
+    """Estimate the transform of every image of a bracket given as "path___ev".
+
+    init gives a transform per image to start from, e.g. those of a neighbouring
+    bracket. Returns the transforms, in full resolution pixels and in the order of
+    img_list, and the correlation each reached."""
+    return PreparedBracket(img_list).estimate(init)
+
+
+def view_similarity(thumbnail, other) -> float:
+    """How alike two thumbnails are, 1 when they show exactly the same view."""
+    cv2 = require("cv2", "opencv-python")
+    if thumbnail.shape != other.shape:
+        return 0.0
+    try:
+        return cv2.computeECC(thumbnail, other)
+    except cv2.error:  # One of them has no detail at all
+        return 0.0
+
+
+class CameraPosition:
+    """Brackets shot from the same position, which share one set of transforms."""
+
+    def __init__(self, index: int, thumbnail):
+        self.index = index  # Bracket whose reference image is the thumbnail
+        self.thumbnail = thumbnail
+        self.transforms = None
+        self.checks = None  # PreparedBracket.check() of the transforms
+        self.ready = threading.Event()  # Set once transforms have been estimated
+
+
+def warp(img, transform):
+    """Warp an HxWx3 image with a transform from estimate_transforms."""
+    if is_identity(transform):
+        return img
+    cv2 = require("cv2", "opencv-python")
+    np = require("numpy")
+    height, width = img.shape[:2]
+    return cv2.warpAffine(
+        img,
+        np.array(transform, dtype=np.float32),
+        (width, height),
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+
+
+class AlignmentCache:
+    """The cached transforms of the brackets of one Merged folder."""
+
+    def __init__(self, out_folder: pathlib.Path):
+        self.path = out_folder / "alignment.json"
+        self.entries = {}  # output name (e.g. "merged_000") -> entry dict
+        self.positions = []  # CameraPositions found in this run
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open("r") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as ex:
+            print(
+                "Warning: Ignoring unreadable alignment cache %s: %s" % (self.path, ex)
+            )
+            return
+        if data.get("version") == ALIGN_VERSION:
+            self.entries = data.get("brackets", {})
+
+    @staticmethod
+    def signature(img_list: list, load_scale: int = 1) -> dict:
+        images = [i.split("___") for i in img_list]
+        signature = {
+            "inputs": [file_fingerprint(path) for path, ev in images],
+            "evs": [float(ev) for path, ev in images],
+            "work_size": WORK_SIZE,
+        }
+        if load_scale != 1:
+            signature["load_scale"] = load_scale
+        return signature
+
+    def get(self, name: str, img_list: list, load_scale: int = 1):
+        """The cached transforms of a bracket, or None if its images changed."""
+        with self._lock:
+            entry = self.entries.get(name)
+        if entry is None or entry["signature"] != self.signature(img_list, load_scale):
+            return None
+        return entry["transforms"]
+
+    def nearest(self, index: int, image_count: int):
+        """The transforms of the closest bracket with as many images, or None."""
+        with self._lock:
+            entries = [
+                e for e in self.entries.values() if len(e["transforms"]) == image_count
+            ]
+        if not entries:
+            return None
+        return min(entries, key=lambda e: abs(e["index"] - index))["transforms"]
+
+    def find_position(self, index: int, thumbnail) -> tuple:
+        """The CameraPosition a bracket was shot from, and whether it is new.
+
+        A new position is added for the bracket if none matches, which the caller
+        must estimate the transforms of and then set ready."""
+        with self._lock:
+            matches = [
+                (view_similarity(thumbnail, p.thumbnail), p) for p in self.positions
+            ]
+            matches = [m for m in matches if m[0] >= POSITION_MATCH]
+            if matches:
+                return max(matches, key=lambda m: m[0])[1], False
+            position = CameraPosition(index, thumbnail)
+            self.positions.append(position)
+            return position, True
+
+    def align(
+        self,
+        name: str,
+        index: int,
+        img_list: list,
+        per_position=False,
+        load_scale: int = 1,
+    ):
+        """The transforms of a bracket, and how they were found: "cached", "reused"
+        from another bracket at the same position or "estimated".
+
+        With per_position, transforms are estimated once per camera position and
+        reused for the other brackets shot from there, as long as they still
+        line up their images about as well. load_scale is that of PreparedBracket."""
+        transforms = self.get(name, img_list, load_scale)
+        if transforms is not None:
+            return transforms, "cached"
+
+        bracket = PreparedBracket(img_list, load_scale)
+        position = None
+        new_position = False
+        if per_position:
+            position, new_position = self.find_position(index, bracket.thumbnail())
+        try:
+            if position is not None and not new_position:
+                position.ready.wait()
+                with self._lock:
+                    reused, checks = position.transforms, position.checks
+                if reused is not None and len(reused) == len(img_list):
+                    correlations = bracket.check(reused)
+                    if all(
+                        c >= expected - CHECK_TOLERANCE
+                        for c, expected in zip(correlations, checks)
+                    ):
+                        self.record(
+                            name, index, img_list, reused, correlations, load_scale
+                        )
+                        return reused, "reused"
+
+            init = None
+            if position is not None and position.transforms is not None:
+                init = position.transforms
+            if init is None or len(init) != len(img_list):
+                init = self.nearest(index, len(img_list))
+            transforms, correlations = bracket.estimate(init)
+            if position is not None:
+                # Brackets after this one are more likely to be shot like it
+                checks = bracket.check(transforms)
+                with self._lock:
+                    position.transforms, position.checks = transforms, checks
+        finally:
+            if new_position:
+                position.ready.set()
+        self.record(name, index, img_list, transforms, correlations, load_scale)
+        return transforms, "estimated"
+
+    def record(
+        self,
+        name: str,
+        index: int,
+        img_list: list,
+        transforms: list,
+        correlations: list,
+        load_scale: int = 1,
+    ):
+        with self._lock:
+            self.entries[name] = {
+                "index": index,
+                "signature": self.signature(img_list, load_scale),
+                "transforms": transforms,
+                "correlations": correlations,
+            }
+            self._dirty = True
+            due = time.monotonic() - self._last_save > SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def save(self):
+        """Write the cache atomically."""
+        with self._lock:
+            data = {"version": ALIGN_VERSION, "brackets": self.entries}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = partial_path(self.path)
+            with tmp_path.open("w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def flush(self):
+        if self._dirty:
+            self.save()
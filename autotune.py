@@ -0,0 +1,213 @@
+"""Finding how many brackets to merge at once on this machine.
+
+The best thread count depends on the CPU, the RAM, the merge backend and the size
+of the images, so rather than guessing, calibrate() merges a few brackets from the
+actual job at increasing thread counts and measures the throughput of each. Past
+some count more threads barely help and only use more memory, so the result is the
+knee of that curve: the lowest count within KNEE_FRACTION of the best throughput.
+
+Results are stored per machine in config.json, in gui_settings "machine_threads",
+and used as that machine's default thread count.
+"""
+
+import os
+import pathlib
+import shutil
+import socket
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+from blender_worker import BlenderWorkerPool
+from hdr_batch import SCRIPT_DIR, BracketJob, HDRBatch, merge_strip_rows
+from pipeline import estimate_merge_memory, get_memory_budget
+
+# Thread counts to try, up to the number of logical CPUs
+THREAD_COUNTS = (1, 2, 4, 6, 8, 12, 16, 24, 32)
+# The lowest count reaching this fraction of the best throughput is picked
+KNEE_FRACTION = 0.95
+# Stop once this many counts in a row haven't improved on the best
+PATIENCE = 2
+
+
+def get_thread_counts(max_threads: int = None) -> list:
+    """The thread counts to try, from 1 up to max_threads or the CPU count."""
+    limit = max_threads or os.cpu_count() or THREAD_COUNTS[-1]
+    return [c for c in THREAD_COUNTS if c <= limit] or [1]
+
+
+def pick_knee(levels: list) -> int:
+    """The lowest thread count whose throughput is close to the best one."""
+    best = max(level["brackets_per_second"] for level in levels)
+    for level in sorted(levels, key=lambda level: level["threads"]):
+        if level["brackets_per_second"] >= best * KNEE_FRACTION:
+            return level["threads"]
+
+
+def get_default_threads(config: dict) -> str:
+    """The thread count tuned for this machine, or else the last one used."""
+    gui_settings = config["gui_settings"]
+    tuned = gui_settings.get("machine_threads", {}).get(socket.gethostname())
+    return tuned["threads"] if tuned else gui_settings["threads"]
+
+
+def remember_threads(config: dict, threads: str):
+    """Save a thread count chosen by hand, also over this machine's tuned one."""
+    gui_settings = config["gui_settings"]
+    gui_settings["threads"] = threads
+    tuned = gui_settings.get("machine_threads", {}).get(socket.gethostname())
+    if tuned:
+        tuned["threads"] = threads
+
+
+def set_machine_threads(config: dict, result: dict):
+    """Store the result of calibrate() as this machine's thread count."""
+    machines = config["gui_settings"].setdefault("machine_threads", {})
+    machines[socket.gethostname()] = {
+        key: result[key]
+        for key in ("threads", "brackets_per_second", "merge_backend", "resolution")
+    }
+    machines[socket.gethostname()]["tuned"] = datetime.now().strftime("%Y-%m-%d")
+
+
+def calibrate(
+    batch: HDRBatch,
+    folders: list,
+    extension: str,
+    do_align: bool = False,
+    do_raw: bool = False,
+    do_recursive: bool = False,
+    merge_backend: str = "blender",
+    pp3_for_folder=None,
+    max_threads: int = None,
+) -> dict:
+    """Time merging brackets from folders at increasing thread counts.
+
+    The outputs are written to a temporary folder, so the job's own outputs,
+    manifests and grouping reports are left alone. Returns the chosen "threads"
+    (as a string, like in config.json) with the measured "levels". Raises a
+    SettingsError like HDRBatch.run, or RuntimeError if a bracket fails to merge."""
+    counts = get_thread_counts(max_threads)
+    batch.start(folders, do_raw, do_align)
+    merge_backend = batch.get_merge_backend(merge_backend)
+    build_settings = batch.get_build_settings(merge_backend, do_align, do_raw)
+    merge_blend = SCRIPT_DIR / "blender" / "HDR_Merge.blend"
+    merge_py = SCRIPT_DIR / "blender" / "blender_merge.py"
+
+    sample = []
+    for job in batch.iter_jobs(
+        folders,
+        extension,
+        do_raw,
+        do_recursive,
+        pp3_for_folder,
+        build_settings,
+        dry_run=True,
+    ):
+        sample.append(job)
+        if len(sample) >= counts[-1]:
+            break
+    if any(batch.writes_tiffs(job, do_align, merge_backend) for job in sample):
+        # Copies of a bracket would all write the same TIFFs at once, so only
+        # try as many threads as there are different brackets
+        counts = [c for c in counts if c <= len(sample)] or [1]
+    resolution = sample[0].resolution()
+    estimate = estimate_merge_memory(
+        resolution,
+        len(sample[0].img_list),
+        merge_backend,
+        merge_strip_rows(batch.config, merge_backend),
+    )
+    budget = get_memory_budget(batch.config["gui_settings"]["memory_budget_gb"])
+    print(
+        "Calibrating with %d brackets of %s, trying %s threads"
+        % (len(sample), resolution, ", ".join(str(c) for c in counts))
+    )
+
+    if merge_backend == "blender_worker":
+        batch.blender_workers = BlenderWorkerPool(
+            batch.exe_paths["blender_exe"], merge_blend, merge_py
+        )
+    out_root = pathlib.Path(tempfile.mkdtemp(prefix="hdr-tune-"))
+    levels = []
+    try:
+        for threads in counts:
+            # As many brackets as threads, so every thread has one to merge
+            out_folder = out_root / str(threads)
+            jobs = []
+            for i in range(threads):
+                job = sample[i % len(sample)]
+                # Everything but where it's written, e.g. how RAW files are decoded
+                data = dict(job.to_dict(), out_folder=out_folder.as_posix(), index=i)
+                jobs.append(BracketJob.from_dict(data))
+            started = perf_counter()
+            with batch.get_pipeline(str(threads)) as pipeline:
+                futures = []
+                for job in jobs:
+                    batch.add_total()
+                    futures.append(
+                        batch.do_merge(
+                            pipeline,
+                            job,
+                            batch.exe_paths["blender_exe"],
+                            merge_blend,
+                            merge_py,
+                            batch.exe_paths["luminance_cli_exe"],
+                            batch.exe_paths["align_image_stack_exe"],
+                            do_align,
+                            merge_backend,
+                        )
+                    )
+            wall = perf_counter() - started
+            for future in futures:
+                if future.exception() is not None:
+                    raise RuntimeError(
+                        "A bracket failed to merge while calibrating: %s"
+                        % future.exception()
+                    )
+
+            # Blender's peak memory is measured, the built-in merge is estimated
+            measured = [
+                row["max_rss_mb"] * 1024**2
+                for row in batch.report.rows.values()
+                if row["out_folder"] == str(out_folder)
+                and row["stage"] == "merge"
+                and "max_rss_mb" in row
+            ]
+            memory = threads * max(measured + [estimate])
+            levels.append(
+                {
+                    "threads": threads,
+                    "brackets_per_second": threads / wall,
+                    "memory_gb": memory / 1024**3,
+                    "headroom_gb": (budget - memory) / 1024**3 if budget else None,
+                }
+            )
+            print(
+                "Threads %d: %.2f brackets/s, about %.1f GB while merging"
+                % (threads, threads / wall, memory / 1024**3)
+            )
+
+            if budget and memory >= budget:
+                print("Memory budget reached, more threads wouldn't merge at once")
+                break
+            best = max(levels, key=lambda level: level["brackets_per_second"])
+            if len(levels) - 1 - levels.index(best) >= PATIENCE:
+                break
+    finally:
+        batch.finish()
+        shutil.rmtree(out_root, ignore_errors=True)
+
+    threads = pick_knee(levels)
+    chosen = next(level for level in levels if level["threads"] == threads)
+    print(
+        "Using %d threads on %s (%.2f brackets/s)"
+        % (threads, socket.gethostname(), chosen["brackets_per_second"])
+    )
+    return {
+        "threads": str(threads),
+        "brackets_per_second": round(chosen["brackets_per_second"], 3),
+        "merge_backend": merge_backend,
+        "resolution": resolution,
+        "levels": levels,
+    }
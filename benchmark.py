@@ -0,0 +1,537 @@
+"""Benchmark the merge pipeline on synthetic brackets.
+
+    python benchmark.py [options]
+
+Generates folders of exposure brackets, as 16-bit TIFFs with the EXIF tags used to
+group them, at each combination of --resolutions and --images, and runs them
+through finding the brackets, grouping, merging and tonemapping like hdr_cli.py
+does. Unless --real-tools is given, Blender, Luminance and align_image_stack are
+replaced by the stubs in benchmark_stubs.py, so the benchmark also runs on a
+machine without them; the times then mostly measure the NumPy merge and the
+scheduling around the tools.
+
+Each scenario runs in a fresh process, so its peak memory isn't affected by the
+ones before it. Save the results with --output, and pass an earlier results file
+as --baseline to compare with it. The exit code is 1 if a scenario's throughput
+dropped by more than --tolerance percent, or if any bracket failed.
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from statistics import median
+from time import perf_counter
+
+from exif_index import ExifIndex
+from hdr_batch import (
+    MERGE_BACKENDS,
+    SCRIPT_DIR,
+    HDRBatch,
+    get_config,
+    get_default_config,
+)
+from image_io import require
+from run_report import get_child_usage
+
+# Exposures of a bracket are this many EVs apart, around BASE_EXPOSURE
+EV_STEP = 2
+BASE_EXPOSURE = 1 / 250
+# Seconds between the shots of a bracket, and between brackets
+SHOT_INTERVAL = 0.5
+BRACKET_INTERVAL = 5.0
+
+TIFF_TYPES = {"short": 3, "long": 4, "rational": 5, "ascii": 2}
+
+
+def write_tiff(path: pathlib.Path, img, exif: dict):
+    """Write an uncompressed 16-bit RGB TIFF with the EXIF tags get_exif reads.
+
+    exif has exposure_time and aperture (as (numerator, denominator)), iso and
+    taken (a datetime)."""
+    height, width = img.shape[:2]
+    data = img.astype("<u2").tobytes()
+    taken = exif["taken"]
+
+    # IFD0 and the EXIF IFD as (tag, type, values); offsets are filled in below
+    ifd0 = [
+        (256, "long", [width]),  # ImageWidth
+        (257, "long", [height]),  # ImageLength
+        (258, "short", [16, 16, 16]),  # BitsPerSample
+        (259, "short", [1]),  # Compression: none
+        (262, "short", [2]),  # PhotometricInterpretation: RGB
+        (273, "long", [8]),  # StripOffsets, the data follows the header
+        (277, "short", [3]),  # SamplesPerPixel
+        (278, "long", [height]),  # RowsPerStrip
+        (279, "long", [len(data)]),  # StripByteCounts
+        (284, "short", [1]),  # PlanarConfiguration: interleaved
+        (34665, "long", [0]),  # ExifIFD offset
+    ]
+    exif_ifd = [
+        (33434, "rational", [exif["exposure_time"]]),
+        (33437, "rational", [exif["aperture"]]),
+        (34855, "short", [exif["iso"]]),
+        (36867, "ascii", taken.strftime("%Y:%m:%d %H:%M:%S")),  # DateTimeOriginal
+        (37521, "ascii", "%02d" % (taken.microsecond // 10000)),  # SubSecTimeOriginal
+    ]
+
+    ifd0_offset = 8 + len(data)
+    exif_offset = ifd0_offset + 2 + len(ifd0) * 12 + 4
+    extra_offset = exif_offset + 2 + len(exif_ifd) * 12 + 4
+    ifd0[-1] = (34665, "long", [exif_offset])
+    extra = bytearray()
+
+    def pack_ifd(entries: list) -> bytes:
+        packed = struct.pack("<H", len(entries))
+        for tag, type_name, values in entries:
+            if type_name == "ascii":
+                value = values.encode() + b"\0"
+                count = len(value)
+            elif type_name == "rational":
+                value = b"".join(struct.pack("<2I", *v) for v in values)
+                count = len(values)
+            else:
+                value = struct.pack(
+                    "<%d%s" % (len(values), "H" if type_name == "short" else "I"),
+                    *values
+                )
+                count = len(values)
+            if len(value) <= 4:
+                field = value.ljust(4, b"\0")
+            else:
+                field = struct.pack("<I", extra_offset + len(extra))
+                extra.extend(value + b"\0" * (len(value) % 2))
+            packed += struct.pack("<HHI", tag, TIFF_TYPES[type_name], count) + field
+        return packed + struct.pack("<I", 0)
+
+    ifds = pack_ifd(ifd0) + pack_ifd(exif_ifd)
+    with path.open("wb") as f:
+        f.write(b"II*\0" + struct.pack("<I", ifd0_offset))
+        f.write(data)
+        f.write(ifds)
+        f.write(extra)
+
+
+def get_exposures(images: int) -> list:
+    """(EV, exposure time) of each image of a bracket, centred on BASE_EXPOSURE.
+
+    Shot in the usual camera order: the middle exposure, then darker and brighter."""
+    evs = [EV_STEP * (i - images // 2) for i in range(images)]
+    evs.sort(key=lambda ev: (abs(ev), ev))
+    return [(ev, BASE_EXPOSURE * 2.0**ev) for ev in evs]
+
+
+def as_rational(value: float) -> tuple:
+    if value < 1:
+        return 1, round(1 / value)
+    return round(value), 1
+
+
+def make_brackets(
+    folder: pathlib.Path, resolution: str, images: int, brackets: int, seed: int
+):
+    """Write brackets of images to folder, from a random but repeatable scene."""
+    np = require("numpy")
+    width, height = (int(d) for d in resolution.split("x"))
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    taken = datetime(2024, 1, 1, 12, 0, 0)
+    number = 0
+    for bracket in range(brackets):
+        # A smooth gradient over several stops, with noise as fine detail
+        gradient = np.linspace(0.0, 6.0, width, dtype=np.float32)
+        scene = 2.0 ** (gradient[None, :, None] - 4.0) * rng.uniform(
+            0.5, 1.5, (height, width, 3)
+        ).astype(np.float32)
+        for ev, exposure_time in get_exposures(images):
+            linear = np.clip(scene * 2.0**ev, 0.0, 1.0)
+            srgb = np.where(
+                linear <= 0.0031308,
+                linear * 12.92,
+                1.055 * linear ** (1 / 2.4) - 0.055,
+            )
+            write_tiff(
+                folder / ("IMG_%04d.tif" % number),
+                (srgb * 65535).round(),
+                {
+                    "exposure_time": as_rational(exposure_time),
+                    "aperture": (80, 10),
+                    "iso": 100,
+                    "taken": taken,
+                },
+            )
+            number += 1
+            taken += timedelta(seconds=SHOT_INTERVAL)
+        taken += timedelta(seconds=BRACKET_INTERVAL)
+
+
+def write_stubs(folder: pathlib.Path, seconds: float) -> dict:
+    """Create launchers for the stub tools, returning exe_paths that use them."""
+    folder.mkdir(parents=True, exist_ok=True)
+    stubs_py = SCRIPT_DIR / "benchmark_stubs.py"
+    exe_paths = {}
+    for key, tool in (
+        ("blender_exe", "blender"),
+        ("luminance_cli_exe", "luminance"),
+        ("align_image_stack_exe", "align_image_stack"),
+    ):
+        if sys.platform.startswith("win"):
+            path = folder / (tool + ".bat")
+            path.write_text(
+                '@"%s" "%s" %s %s %%*\n' % (sys.executable, stubs_py, tool, seconds)
+            )
+        else:
+            path = folder / tool
+            path.write_text(
+                '#!/bin/sh\nexec "%s" "%s" %s %s "$@"\n'
+                % (sys.executable, stubs_py, tool, seconds)
+            )
+            path.chmod(0o755)
+        exe_paths[key] = str(path)
+    exe_paths["rawtherapee_cli_exe"] = ""
+    return exe_paths
+
+
+def percentile(values: list, percent: float):
+    """Nearest-rank percentile, or None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+def run_scenario(
+    folder: pathlib.Path,
+    config: dict,
+    merge_backend: str,
+    threads: str,
+    do_align: bool,
+    repeats: int,
+) -> dict:
+    """Merge the brackets in folder repeats times and measure the runs.
+
+    Meant to run in its own process, see the module docstring."""
+    walls = []
+    discover = []
+    latencies = []
+    tool_rss = []
+    brackets = failed = 0
+    log_path = folder.parent / (folder.name + ".log")
+    with log_path.open("w") as log, contextlib.redirect_stdout(log):
+        for _ in range(repeats):
+            # Start from nothing, so no bracket is skipped and EXIF is read again
+            shutil.rmtree(folder / "Merged", ignore_errors=True)
+            exif_index_path = folder.parent / (folder.name + "_exif_index.jsonl")
+            exif_index_path.unlink(missing_ok=True)
+
+            batch = HDRBatch(config)
+            batch.exif_index = ExifIndex(exif_index_path)
+            started = perf_counter()
+            failed += len(
+                batch.run(
+                    [str(folder)],
+                    ".tif",
+                    do_align=do_align,
+                    merge_backend=merge_backend,
+                    threads=threads,
+                )
+            )
+            walls.append(perf_counter() - started)
+            brackets = batch.total_sets_global
+
+            per_bracket = {}
+            for row in batch.report.rows.values():
+                if row["stage"] == "discover":
+                    discover.append(row["wall"])
+                elif row["bracket"] is not None:
+                    # Steps follow each other directly, so a bracket's latency is
+                    # the sum of its waits and run times
+                    per_bracket[row["bracket"]] = (
+                        per_bracket.get(row["bracket"], 0)
+                        + row.get("queue_wait", 0)
+                        + row.get("wall", 0)
+                    )
+                if "max_rss_mb" in row:
+                    tool_rss.append(row["max_rss_mb"])
+            latencies += per_bracket.values()
+
+    wall = median(walls)
+    try:
+        import resource
+
+        peak_rss = get_child_usage(resource.getrusage(resource.RUSAGE_SELF))
+        peak_rss_mb = peak_rss["max_rss_mb"]
+    except ImportError:  # Windows
+        peak_rss_mb = None
+    return {
+        "brackets": brackets,
+        "failed": failed,
+        "wall": walls,
+        "wall_median": wall,
+        "brackets_per_second": brackets / wall if wall else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p99": percentile(latencies, 99),
+        "discover_median": median(discover) if discover else None,
+        "peak_rss_mb": peak_rss_mb,
+        "tool_peak_rss_mb": max(tool_rss, default=None),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark merging on synthetic exposure brackets."
+    )
+    parser.add_argument(
+        "--resolutions",
+        default="1024x683,2048x1365",
+        help="Comma separated image sizes, WIDTHxHEIGHT (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--images",
+        default="3,5",
+        help="Comma separated numbers of images per bracket (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--brackets",
+        type=int,
+        default=8,
+        help="Brackets per scenario (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs per scenario, the median is reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default="4",
+        help="Brackets to merge at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        choices=list(MERGE_BACKENDS),
+        default="numpy",
+        help="Merge backend (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-a", "--align", action="store_true", help="Include the align stage"
+    )
+    parser.add_argument(
+        "--real-tools",
+        action="store_true",
+        help="Use the tools from config.json instead of the stubs",
+    )
+    parser.add_argument(
+        "--tool-seconds",
+        type=float,
+        default=0.0,
+        help="Seconds each stub tool takes per call (default: %(default)s)",
+    )
+    parser.add_argument("--config", help="Path of config.json, for --real-tools")
+    parser.add_argument(
+        "--seed", type=int, default=1, help="Seed of the synthetic scenes"
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="Folder for the generated images, reused between runs "
+        "(default: a temporary folder that is removed afterwards)",
+    )
+    parser.add_argument("-o", "--output", help="Save the results to this JSON file")
+    parser.add_argument("--baseline", help="Results JSON file to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=10.0,
+        help="Allowed throughput drop against the baseline, in percent "
+        "(default: %(default)s)",
+    )
+    return parser.parse_args(argv)
+
+
+def get_benchmark_config(args, work_dir: pathlib.Path) -> dict:
+    if args.real_tools:
+        config = get_config(pathlib.Path(args.config) if args.config else None)
+    else:
+        config = get_default_config()
+        config["exe_paths"] = write_stubs(work_dir / "stubs", args.tool_seconds)
+        config["_optional_exes_available"] = {
+            "align_image_stack_exe": True,
+            "rawtherapee_cli_exe": False,
+            "luminance_cli_exe": True,
+        }
+        if args.backend != "numpy":
+            # The Blender stub only writes placeholder EXRs, which the built-in
+            # tonemapping can't read, so tonemap with the Luminance stub instead
+            config["gui_settings"]["tonemap_backend"] = "luminance"
+    return config
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Print the throughput change of each scenario, returning those that
+    dropped by more than tolerance percent."""
+    for key, value in results["settings"].items():
+        if baseline.get("settings", {}).get(key) != value:
+            print(
+                "Note: %s was %s in the baseline, now %s"
+                % (key, baseline.get("settings", {}).get(key), value)
+            )
+    regressions = []
+    for name, result in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name, {}).get("brackets_per_second")
+        after = result["brackets_per_second"]
+        if not before or not after:
+            print("%-18s not in baseline" % name)
+            continue
+        change = (after / before - 1) * 100
+        print("%-18s %.2f -> %.2f brackets/s (%+.1f%%)" % (name, before, after, change))
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def format_seconds(value) -> str:
+    return "-" if value is None else "%.2fs" % value
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    resolutions = [r.strip() for r in args.resolutions.split(",") if r.strip()]
+    image_counts = [int(i) for i in args.images.split(",") if i.strip()]
+
+    if args.work_dir:
+        work_dir = pathlib.Path(args.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        work_dir = pathlib.Path(tempfile.mkdtemp(prefix="hdr-benchmark-"))
+        while "___" in str(work_dir):
+            # Images are passed around as "path___ev", which rules out ___ in paths
+            work_dir.rmdir()
+            work_dir = pathlib.Path(tempfile.mkdtemp(prefix="hdr-benchmark-"))
+
+    try:
+        try:
+            config = get_benchmark_config(args, work_dir)
+        except RuntimeError as ex:
+            print("Error: %s" % ex)
+            return 2
+        config["gui_settings"]["threads"] = args.threads
+
+        results = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "machine": {
+                "hostname": socket.gethostname(),
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+            },
+            "settings": {
+                "backend": args.backend,
+                "align": args.align,
+                "threads": args.threads,
+                "brackets": args.brackets,
+                "repeat": args.repeat,
+                "tools": "real" if args.real_tools else "stub",
+                "tool_seconds": args.tool_seconds,
+                "seed": args.seed,
+            },
+            "scenarios": {},
+        }
+        print(
+            "%-18s %8s %8s %10s %8s %8s %8s %9s %9s"
+            % (
+                "Scenario",
+                "Brackets",
+                "Wall",
+                "Brackets/s",
+                "p50",
+                "p90",
+                "p99",
+                "Discover",
+                "Peak RSS",
+            )
+        )
+        failed = 0
+        for resolution in resolutions:
+            for images in image_counts:
+                name = "%s x%d" % (resolution, images)
+                folder = work_dir / ("%s_x%d_%d" % (resolution, images, args.brackets))
+                if len(list(folder.glob("*.tif"))) != images * args.brackets:
+                    shutil.rmtree(folder, ignore_errors=True)
+                    make_brackets(folder, resolution, images, args.brackets, args.seed)
+
+                # A fresh process per scenario, for its peak memory
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")
+                ) as executor:
+                    result = executor.submit(
+                        run_scenario,
+                        folder,
+                        config,
+                        args.backend,
+                        args.threads,
+                        args.align,
+                        args.repeat,
+                    ).result()
+                results["scenarios"][name] = result
+                failed += result["failed"]
+                print(
+                    "%-18s %8d %8s %10s %8s %8s %8s %9s %9s"
+                    % (
+                        name,
+                        result["brackets"],
+                        format_seconds(result["wall_median"]),
+                        "%.2f" % result["brackets_per_second"],
+                        format_seconds(result["latency_p50"]),
+                        format_seconds(result["latency_p90"]),
+                        format_seconds(result["latency_p99"]),
+                        format_seconds(result["discover_median"]),
+                        (
+                            "-"
+                            if result["peak_rss_mb"] is None
+                            else "%.0f MB" % result["peak_rss_mb"]
+                        ),
+                    )
+                )
+
+        if failed:
+            print("%d brackets failed, see the .log files in %s" % (failed, work_dir))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print("Results saved to %s" % args.output)
+
+        regressions = []
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            print("\nCompared with %s (%s):" % (args.baseline, baseline["created"]))
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print(
+                    "Throughput dropped by more than %.0f%%: %s"
+                    % (args.tolerance, ", ".join(regressions))
+                )
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Stand-ins for Blender, Luminance and align_image_stack, used by benchmark.py.
+
+    python benchmark_stubs.py TOOL SECONDS [tool arguments...]
+
+Each stub accepts the same arguments hdr_batch.py passes to the real tool, waits
+SECONDS to stand in for the tool's own work, and writes placeholder files where the
+tool would write its outputs, so the rest of the pipeline runs as usual. Only the
+standard library is used, to keep the stubs quick to start.
+"""
+
+import json
+import pathlib
+import shutil
+import sys
+import time
+
+# Keep in sync with blender_worker.py
+DONE_MARKER = "HDR_MERGE_DONE"
+
+
+def write_placeholder(path: str):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"benchmark placeholder\n")
+
+
+def blender(args: list, seconds: float):
+    args = args[args.index("--") + 1 :]
+    if args and args[0] == "--worker":
+        print("Blender merge worker ready", flush=True)
+        for line in sys.stdin:
+            job = json.loads(line)
+            print("Loading: %d images" % len(job["images"]), flush=True)
+            time.sleep(seconds)
+            write_placeholder(job["exr"])
+            print("Saved: %s" % job["exr"], flush=True)
+            print(DONE_MARKER, flush=True)
+        return
+    if args and args[0] == "--exr":
+        args = args[3:]
+    # RESOLUTION EXR_PATH FILTERS BRACKET_ID IMAGES...
+    exr_path = args[1]
+    print("Loading: %d images" % len(args[4:]))
+    time.sleep(seconds)
+    write_placeholder(exr_path)
+    print("Saved: %s" % exr_path)
+
+
+def luminance(args: list, seconds: float):
+    time.sleep(seconds)
+    write_placeholder(args[args.index("-o") + 1])
+
+
+def align_image_stack(args: list, seconds: float):
+    """Copy the images unchanged to where the aligned ones would be written."""
+    prefix_index = args.index("-a") + 1
+    prefix = args[prefix_index]
+    images = [a for a in args[prefix_index + 1 :] if not a.startswith("-")]
+    time.sleep(seconds)
+    for i, image in enumerate(images):
+        print("saving %s" % image)
+        shutil.copyfile(image, "%s%04d.tif" % (prefix, i))
+
+
+STUBS = {
+    "blender": blender,
+    "luminance": luminance,
+    "align_image_stack": align_image_stack,
+}
+
+
+if __name__ == "__main__":
+    STUBS[sys.argv[1]](sys.argv[3:], float(sys.argv[2]))
@@ -1,55 +1,22 @@
 import bpy
+import json
 import os
 import pathlib
 import sys
+import traceback
 
 # Example call:
 # blender.exe --background HDR_Merge.blend --factory-startup --python blender_merge.py -- 3456x5184 "C:/foo/bar/Merged/exr/merged_000.exr" ND8_ND400 0 imgpath1___12 imgpath2___9 imgpath3___6 imgpath4___3 imgpath5___0
+#
+# The EXR compression and precision can be given first, e.g. "-- --exr zip half 3456x5184 ...",
+# otherwise PIZ compressed 32-bit float is used.
+#
+# Persistent worker mode, reading one JSON job per line from stdin:
+# blender.exe --background HDR_Merge.blend --factory-startup --python blender_merge.py -- --worker
+# {"resolution": "3456x5184", "exr": "C:/foo/bar/Merged/exr/merged_000.exr", "filters": "None", "bracket_id": 0, "images": ["imgpath1___12", ...], "exr_compression": "piz", "exr_precision": "float"}
 
-argv = sys.argv
-argv = argv[argv.index("--") + 1 :]  # get all args after "--"
-# list where first position is X-res, second position is Y-res
-RESOLUTION = [int(d) for d in argv[0].split("x")]
-EXR_OUTFILE = argv[1]
-FILTERS = argv[2]
-BRACKET_ID = int(argv[3])  # Bracket ID for unique filenames
-IMAGES = sorted([i.split("___") for i in argv[4:]], key=lambda x: float(x[1]))
-
-exr_fpath = pathlib.Path(EXR_OUTFILE)
-
-nodes = []
-previous_node = None
-previous_group = None
-groups = [None]
-nt = bpy.context.scene.node_tree
-for i, (img_path, ev) in enumerate(IMAGES):
-    ev = float(ev)
-    n = nt.nodes.new("CompositorNodeImage")
-    nodes.append(n)
-    print("Loading:", i, os.path.basename(img_path))
-    img = bpy.data.images.load(img_path)
-    n.image = img
-    if i != 0:
-        print("Creating group", i)
-        g = nt.nodes.new("CompositorNodeGroup")
-        groups.append(g)
-        g.node_tree = bpy.data.node_groups["Merge HDR"]
-        nt.links.new(previous_node.outputs[0], g.inputs[0])
-        nt.links.new(n.outputs[0], g.inputs[1])
-        if i == 1:
-            nt.links.new(previous_node.outputs[0], g.inputs[2])
-        else:
-            nt.links.new(previous_group.outputs[0], g.inputs[2])
-        g.inputs[3].default_value = ev
-        previous_group = g
-    previous_node = n
-
-bpy.ops.wm.save_as_mainfile(
-    filepath=str(exr_fpath.with_name("bracket_%03d_sample.blend" % BRACKET_ID)),
-    compress=True,
-)
-
-nt.links.new(groups[-1].outputs[0], nt.nodes["OUT"].inputs[0])
+DONE_MARKER = "HDR_MERGE_DONE"
+FAILED_MARKER = "HDR_MERGE_FAILED"
 
 
 def filter_fix(filter_type, node_tree, img_nodes):
@@ -62,22 +29,141 @@ def filter_fix(filter_type, node_tree, img_nodes):
             node_tree.links.new(g.outputs[0], l.to_socket)
 
 
-if "ND8" in FILTERS:
-    filter_fix("ND8", nt, nodes)
-if "ND400" in FILTERS:
-    filter_fix("ND400", nt, nodes)
+def merge(
+    resolution,
+    exr_outfile,
+    filters,
+    bracket_id,
+    images,
+    exr_compression="piz",
+    exr_precision="float",
+):
+    """Build the compositor tree for one bracket and render it to exr_outfile."""
+    # list where first position is X-res, second position is Y-res
+    resolution = [int(d) for d in resolution.split("x")]
+    images = sorted([i.split("___") for i in images], key=lambda x: float(x[1]))
+    exr_fpath = pathlib.Path(exr_outfile)
+
+    nodes = []
+    previous_node = None
+    previous_group = None
+    groups = [None]
+    nt = bpy.context.scene.node_tree
+    for i, (img_path, ev) in enumerate(images):
+        ev = float(ev)
+        n = nt.nodes.new("CompositorNodeImage")
+        nodes.append(n)
+        print("Loading:", i, os.path.basename(img_path), flush=True)
+        img = bpy.data.images.load(img_path)
+        n.image = img
+        if i != 0:
+            print("Creating group", i)
+            g = nt.nodes.new("CompositorNodeGroup")
+            groups.append(g)
+            g.node_tree = bpy.data.node_groups["Merge HDR"]
+            nt.links.new(previous_node.outputs[0], g.inputs[0])
+            nt.links.new(n.outputs[0], g.inputs[1])
+            if i == 1:
+                # EVs are relative to the brightest exposure of the folder, which
+                # may not be in this bracket, so scale the first image by its own EV
+                gain = nt.nodes.new("CompositorNodeExposure")
+                gain.inputs[1].default_value = float(images[0][1])
+                nt.links.new(previous_node.outputs[0], gain.inputs[0])
+                nt.links.new(gain.outputs[0], g.inputs[2])
+            else:
+                nt.links.new(previous_group.outputs[0], g.inputs[2])
+            g.inputs[3].default_value = ev
+            previous_group = g
+        previous_node = n
+
+    bpy.ops.wm.save_as_mainfile(
+        filepath=str(exr_fpath.with_name("bracket_%03d_sample.blend" % bracket_id)),
+        compress=True,
+    )
+
+    nt.links.new(groups[-1].outputs[0], nt.nodes["OUT"].inputs[0])
+
+    if "ND8" in filters:
+        filter_fix("ND8", nt, nodes)
+    if "ND400" in filters:
+        filter_fix("ND400", nt, nodes)
+
+    if not exr_fpath.parent.exists():
+        exr_fpath.parent.mkdir(parents=True, exist_ok=True)
 
-if not exr_fpath.parent.exists():
-    exr_fpath.parent.mkdir(parents=True, exist_ok=True)
+    rset = bpy.context.scene.render
+    rset.filepath = str(exr_fpath)
+    rset.resolution_x = resolution[0]
+    rset.resolution_y = resolution[1]
+    rset.image_settings.exr_codec = exr_compression.upper()
+    rset.image_settings.color_depth = "16" if exr_precision == "half" else "32"
 
-rset = bpy.context.scene.render
-rset.filepath = str(exr_fpath)
-rset.resolution_x = RESOLUTION[0]
-rset.resolution_y = RESOLUTION[1]
+    bpy.ops.render.render(write_still=True)  # Render!
 
-bpy.ops.render.render(write_still=True)  # Render!
+    bpy.ops.wm.save_as_mainfile(
+        filepath=str(exr_fpath.with_name("bracket_%03d_sample.blend" % bracket_id)),
+        compress=True,
+    )
+
+
+def reset_tree(base_node_names, base_image_names):
+    """Remove the nodes and images added for the previous job."""
+    nt = bpy.context.scene.node_tree
+    for n in list(nt.nodes):
+        if n.name not in base_node_names:
+            nt.nodes.remove(n)
+    for img in list(bpy.data.images):
+        # Only free loaded files, Render Result and Viewer Node are reused by Blender
+        if img.source == "FILE" and img.name not in base_image_names:
+            bpy.data.images.remove(img)
+
+
+def run_worker():
+    """Merge brackets read from stdin until it is closed."""
+    base_node_names = {n.name for n in bpy.context.scene.node_tree.nodes}
+    base_image_names = {img.name for img in bpy.data.images}
+    print("Blender merge worker ready", flush=True)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        job = {}
+        try:
+            job = json.loads(line)
+            merge(
+                job["resolution"],
+                job["exr"],
+                job["filters"],
+                int(job["bracket_id"]),
+                job["images"],
+                job.get("exr_compression", "piz"),
+                job.get("exr_precision", "float"),
+            )
+        except Exception as ex:
+            traceback.print_exc()
+            print(
+                FAILED_MARKER,
+                json.dumps({"bracket_id": job.get("bracket_id"), "error": str(ex)}),
+                flush=True,
+            )
+        else:
+            print(
+                DONE_MARKER,
+                json.dumps({"bracket_id": job["bracket_id"], "exr": job["exr"]}),
+                flush=True,
+            )
+        finally:
+            reset_tree(base_node_names, base_image_names)
+
+
+argv = sys.argv
+argv = argv[argv.index("--") + 1 :]  # get all args after "--"
 
-bpy.ops.wm.save_as_mainfile(
-    filepath=str(exr_fpath.with_name("bracket_%03d_sample.blend" % BRACKET_ID)),
-    compress=True,
-)
+if argv and argv[0] == "--worker":
+    run_worker()
+else:
+    exr_settings = {}
+    if argv and argv[0] == "--exr":
+        exr_settings = {"exr_compression": argv[1], "exr_precision": argv[2]}
+        argv = argv[3:]
+    merge(argv[0], argv[1], argv[2], int(argv[3]), argv[4:], **exr_settings)
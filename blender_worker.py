@@ -0,0 +1,137 @@
+"""Long-lived Blender processes that merge many brackets each.
+
+Starting Blender and loading HDR_Merge.blend takes several seconds, so instead of
+launching Blender for every bracket each thread keeps one Blender running
+blender_merge.py in worker mode and sends it one JSON job per line on stdin.
+"""
+
+import json
+import pathlib
+import subprocess
+import threading
+
+# Keep in sync with blender/blender_merge.py
+DONE_MARKER = "HDR_MERGE_DONE"
+FAILED_MARKER = "HDR_MERGE_FAILED"
+
+
+class BlenderWorker:
+    """A single persistent Blender process."""
+
+    def __init__(
+        self, blender_exe: str, merge_blend: pathlib.Path, merge_py: pathlib.Path
+    ):
+        cmd = [
+            blender_exe,
+            "--background",
+            merge_blend.as_posix(),
+            "--factory-startup",
+            "--python",
+            merge_py.as_posix(),
+            "--",
+            "--worker",
+        ]
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def merge(
+        self,
+        resolution: str,
+        exr_path: pathlib.Path,
+        filter_used: str,
+        bracket_id: int,
+        img_list: list,
+        log_path: pathlib.Path,
+        line_callback=None,
+        exr_compression: str = "piz",
+        exr_precision: str = "float",
+    ):
+        """Send one bracket to Blender and wait for it to finish rendering.
+
+        Blender's output for the job is written to log_path as it arrives, and
+        passed to line_callback (if given) one line at a time."""
+        job = {
+            "resolution": resolution,
+            "exr": pathlib.Path(exr_path).as_posix(),
+            "filters": filter_used,
+            "bracket_id": bracket_id,
+            "images": img_list,
+            "exr_compression": exr_compression,
+            "exr_precision": exr_precision,
+        }
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "w", buffering=1) as log_file:
+            try:
+                self.process.stdin.write(json.dumps(job) + "\n")
+                self.process.stdin.flush()
+            except OSError as ex:
+                raise RuntimeError("Blender worker is not running: %s" % ex)
+
+            for line in self.process.stdout:
+                if line.startswith(DONE_MARKER):
+                    return
+                if line.startswith(FAILED_MARKER):
+                    result = json.loads(line[len(FAILED_MARKER) :])
+                    raise RuntimeError(
+                        "Blender failed to merge bracket %d: %s"
+                        % (bracket_id, result.get("error"))
+                    )
+                log_file.write(line)
+                if line_callback is not None:
+                    line_callback(line)
+
+        raise RuntimeError(
+            "Blender worker exited with code %s while merging bracket %d"
+            % (self.process.wait(), bracket_id)
+        )
+
+    def close(self):
+        """Close stdin so the worker exits after its current job."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class BlenderWorkerPool:
+    """Hands each thread its own BlenderWorker, starting it on first use."""
+
+    def __init__(
+        self, blender_exe: str, merge_blend: pathlib.Path, merge_py: pathlib.Path
+    ):
+        self.blender_exe = blender_exe
+        self.merge_blend = merge_blend
+        self.merge_py = merge_py
+        self._local = threading.local()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def get_worker(self) -> BlenderWorker:
+        worker = getattr(self._local, "worker", None)
+        if worker is None or not worker.is_alive():
+            worker = BlenderWorker(self.blender_exe, self.merge_blend, self.merge_py)
+            self._local.worker = worker
+            with self._lock:
+                self._workers.append(worker)
+        return worker
+
+    def merge(self, *args, **kwargs):
+        """Merge a bracket on the calling thread's worker, see BlenderWorker.merge."""
+        self.get_worker().merge(*args, **kwargs)
+
+    def close(self):
+        """Shut down all workers."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
@@ -0,0 +1,205 @@
+"""Reading exposure EXIF data, with a persistent index to avoid re-parsing files.
+
+Parsing EXIF is slow on network shares and happens for every file on every run, so
+the results are kept in a JSON-lines file keyed by absolute path, size and mtime.
+Entries for files that changed on disk are simply re-read and appended. The file is
+kept in the user's cache folder, see get_index_path.
+
+Files that aren't in the index are read by a bounded pool of threads, and only the
+header bytes needed for the tags below are parsed (no maker notes or thumbnails).
+"""
+
+import itertools
+import json
+import os
+import pathlib
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import exifread
+
+# Bump when the fields returned by get_exif change, so stale entries are re-read
+EXIF_INDEX_VERSION = 2
+
+# The last tag we need from the EXIF IFD, parsing stops once it's been read
+STOP_TAG = "SubSecTimeOriginal"
+# exifread's value for reading every tag
+READ_ALL_TAGS = "UNDEF"
+
+
+def get_index_path() -> pathlib.Path:
+    """Where the index is kept: the local app data folder on Windows, otherwise
+    $XDG_CACHE_HOME or ~/.cache."""
+    if sys.platform.startswith("win"):
+        cache = os.environ.get("LOCALAPPDATA") or pathlib.Path.home() / "AppData/Local"
+    else:
+        cache = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache) / "hdr-merge-master" / "exif_index.jsonl"
+
+
+def read_tags(filepath: pathlib.Path, stop_tag: str = STOP_TAG) -> dict:
+    with filepath.open("rb") as f:
+        return exifread.process_file(
+            f, stop_tag=stop_tag, details=False, extract_thumbnail=False
+        )
+
+
+def get_exif(filepath: pathlib.Path):
+    tags = read_tags(filepath)
+    if "Image ImageWidth" not in tags:
+        # Dimensions are only stored further along in the EXIF IFD
+        tags = read_tags(filepath, READ_ALL_TAGS)
+
+    # Try different possible EXIF tag names for image dimensions
+    try:
+        width = str(tags["Image ImageWidth"])
+        height = str(tags["Image ImageLength"])
+    except KeyError:
+        try:
+            width = str(tags["EXIF ExifImageWidth"])
+            height = str(tags["EXIF ExifImageLength"])
+        except KeyError:
+            raise RuntimeError("Could not find image dimensions in EXIF data")
+
+    resolution = width + "x" + height
+    shutter_speed = eval(str(tags["EXIF ExposureTime"]))
+    try:
+        aperture = eval(str(tags["EXIF FNumber"]))
+    except ZeroDivisionError:
+        aperture = 0
+    iso = int(str(tags["EXIF ISOSpeedRatings"]))
+    return {
+        "resolution": resolution,
+        "shutter_speed": shutter_speed,
+        "aperture": aperture,
+        "iso": iso,
+        "timestamp": get_timestamp(tags),
+    }
+
+
+def get_timestamp(tags: dict):
+    """Capture time in seconds (with sub-second precision when available), or None."""
+    try:
+        taken = datetime.strptime(
+            str(tags["EXIF DateTimeOriginal"]).strip(), "%Y:%m:%d %H:%M:%S"
+        )
+    except (KeyError, ValueError):
+        return None
+    timestamp = (taken - datetime(1970, 1, 1)).total_seconds()
+    subsec = str(tags.get("EXIF SubSecTimeOriginal", "")).strip()
+    if subsec.isdigit():
+        timestamp += float("0." + subsec)
+    return timestamp
+
+
+class ExifIndex:
+    """On-disk cache of get_exif results."""
+
+    def __init__(self, index_path: pathlib.Path = None):
+        self.index_path = index_path or get_index_path()
+        self._entries = None  # path -> (size, mtime_ns, exif), loaded on first use
+        self._lock = threading.Lock()
+        self._warned = False
+
+    def _warn(self, ex: OSError):
+        """Report that the index can't be written, once rather than for every file.
+        The EXIF data is then only kept in memory for this run."""
+        if not self._warned:
+            print("Warning: Could not update EXIF index %s: %s" % (self.index_path, ex))
+            self._warned = True
+
+    def _load(self):
+        self._entries = {}
+        if not self.index_path.exists():
+            return
+
+        lines = 0
+        with self.index_path.open("r") as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partially written line from an interrupted run
+                if entry.get("v") != EXIF_INDEX_VERSION:
+                    continue
+                self._entries[entry["path"]] = (
+                    entry["size"],
+                    entry["mtime_ns"],
+                    entry["exif"],
+                )
+
+        # Entries are only ever appended, drop outdated ones once they pile up
+        if lines > 2 * len(self._entries) + 100:
+            self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as f:
+                for path, (size, mtime_ns, exif) in self._entries.items():
+                    f.write(self._format_entry(path, size, mtime_ns, exif))
+            tmp_path.replace(self.index_path)
+        except OSError as ex:
+            self._warn(ex)
+
+    @staticmethod
+    def _format_entry(path: str, size: int, mtime_ns: int, exif: dict) -> str:
+        entry = {
+            "v": EXIF_INDEX_VERSION,
+            "path": path,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "exif": exif,
+        }
+        return json.dumps(entry) + "\n"
+
+    def get(self, filepath: pathlib.Path) -> dict:
+        """Get the EXIF data of a file, from the index if the file is unchanged."""
+        filepath = pathlib.Path(filepath).absolute()
+        path = filepath.as_posix()
+        stat = filepath.stat()
+
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            cached = self._entries.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return dict(cached[2])
+
+        exif = get_exif(filepath)
+        with self._lock:
+            self._entries[path] = (stat.st_size, stat.st_mtime_ns, exif)
+            try:
+                self.index_path.parent.mkdir(parents=True, exist_ok=True)
+                with self.index_path.open("a") as f:
+                    f.write(
+                        self._format_entry(path, stat.st_size, stat.st_mtime_ns, exif)
+                    )
+            except OSError as ex:
+                self._warn(ex)
+        return dict(exif)
+
+    def iter_many(self, files, max_workers: int = 8):
+        """Yield the EXIF data of each file in order, reading up to max_workers
+        files at once. Reads that haven't started are cancelled if the caller stops
+        iterating early."""
+        files = iter(files)
+        max_workers = max(1, max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque(
+                executor.submit(self.get, f)
+                for f in itertools.islice(files, max_workers * 2)
+            )
+            try:
+                while pending:
+                    result = pending.popleft().result()
+                    for f in itertools.islice(files, 1):
+                        pending.append(executor.submit(self.get, f))
+                    yield result
+            finally:
+                for future in pending:
+                    future.cancel()
@@ -0,0 +1,169 @@
+"""Splitting a sorted list of images into exposure bracket sets.
+
+The files are walked once, and a new set is started whenever a frame:
+
+* has the exposure that sets usually start with,
+* repeats an exposure that is already in the current set,
+* comes earlier in the usual order of exposures than the frame before it (e.g.
+  the base exposure after the +2 EV one), or
+* was taken noticeably later than the previous frame finished exposing, compared
+  to the gaps between frames inside a set (needs DateTimeOriginal in the EXIF).
+
+The usual order is found without knowing where the sets are: the first exposure
+is the one most often found after a long pause (or the very first frame), and each
+following one is the exposure that most often comes next. This copes with dropped
+or extra frames, so one missing image no longer shifts every following set, and
+sets may have different numbers of images.
+"""
+
+from collections import Counter
+
+EXPOSURE_KEYS = ("shutter_speed", "aperture", "iso")
+
+# A pause between frames longer than this always starts a new set (seconds)...
+MIN_SET_GAP = 1.0
+# ...as does one this many times longer than the pauses inside the previous set
+GAP_FACTOR = 4.0
+
+
+def exposure_key(exif: dict) -> tuple:
+    return tuple(exif[k] for k in EXPOSURE_KEYS)
+
+
+def describe_exposure(exif: dict) -> str:
+    shutter = exif["shutter_speed"]
+    if 0 < shutter < 1:
+        shutter = "1/%g" % round(1 / shutter, 1)
+    else:
+        shutter = "%gs" % shutter
+    return "%s F/%g ISO%d" % (shutter, exif["aperture"], exif["iso"])
+
+
+def _idle_gap(previous: dict, current: dict):
+    """Seconds between the end of the previous exposure and the start of the next,
+    or None when the timestamps are missing."""
+    if previous.get("timestamp") is None or current.get("timestamp") is None:
+        return None
+    return current["timestamp"] - (previous["timestamp"] + previous["shutter_speed"])
+
+
+def _split(exifs: list, sequence: dict) -> list:
+    """Split exifs into sets in a single pass, see the module docstring.
+
+    sequence maps exposure keys to their usual position within a set."""
+    sets = [[0]]
+    current_keys = {exposure_key(exifs[0])}
+    position = sequence.get(exposure_key(exifs[0]), -1)
+    set_gap = 0.0  # Longest pause between frames in the current set
+    reference_gap = None  # Longest pause inside the previous set
+    for i in range(1, len(exifs)):
+        key = exposure_key(exifs[i])
+        gap = _idle_gap(exifs[i - 1], exifs[i])
+
+        new_set = key in current_keys
+        if key in sequence:
+            # Always start over at the first exposure, so a set missing frames
+            # doesn't take the start of the next one
+            new_set = new_set or sequence[key] <= position or sequence[key] == 0
+        if not new_set and gap is not None:
+            threshold = MIN_SET_GAP
+            if reference_gap is not None:
+                threshold = max(threshold, GAP_FACTOR * reference_gap)
+            new_set = gap > threshold
+
+        if new_set:
+            sets.append([i])
+            current_keys = {key}
+            reference_gap = set_gap
+            set_gap = 0.0
+            position = -1
+        else:
+            sets[-1].append(i)
+            current_keys.add(key)
+            if gap is not None:
+                set_gap = max(set_gap, gap)
+        position = sequence.get(key, position)
+    return sets
+
+
+def _gap_starts(exifs: list) -> list:
+    """Indices of the frames taken after a pause much longer than the usual one
+    between frames, which are likely the first frames of sets."""
+    gaps = [_idle_gap(exifs[i - 1], exifs[i]) for i in range(1, len(exifs))]
+    known = sorted(gap for gap in gaps if gap is not None)
+    if not known:
+        return []
+    # Most pauses are the ones inside sets
+    threshold = max(MIN_SET_GAP, GAP_FACTOR * known[len(known) // 4])
+    return [i + 1 for i, gap in enumerate(gaps) if gap is not None and gap > threshold]
+
+
+def usual_sequence(exifs: list) -> dict:
+    """The usual order of exposures within a set, as a mapping of exposure keys to
+    their position, see the module docstring."""
+    keys = [exposure_key(exif) for exif in exifs]
+    gap_starts = _gap_starts(exifs)
+    first = Counter([keys[0]] + [keys[i] for i in gap_starts]).most_common(1)[0][0]
+
+    # How often each exposure follows another, except across the pauses between sets
+    boundaries = set(gap_starts)
+    followers = {}
+    for i in range(1, len(keys)):
+        if i not in boundaries and keys[i] != keys[i - 1]:
+            followers.setdefault(keys[i - 1], Counter())[keys[i]] += 1
+
+    sequence = {first: 0}
+    key = first
+    while True:
+        following = [
+            k
+            for k, _ in followers.get(key, Counter()).most_common()
+            if k not in sequence
+        ]
+        if not following:
+            return sequence
+        key = following[0]
+        sequence[key] = len(sequence)
+
+
+def group_brackets(exifs: list) -> list:
+    """Split the EXIF data of a sorted list of files into bracket sets.
+
+    Returns a list of sets, each a list of indices into exifs."""
+    if not exifs:
+        return []
+    return _split(exifs, usual_sequence(exifs))
+
+
+def grouping_report(files: list, exifs: list, sets: list) -> tuple:
+    """Describe how files were grouped.
+
+    Returns (report text, list of warnings about unusual sets)."""
+    sizes = Counter(len(s) for s in sets)
+    usual_size = sizes.most_common(1)[0][0] if sets else 0
+
+    warnings = []
+    lines = [
+        "Sets: %d" % len(sets),
+        "Images per set: %s"
+        % ", ".join("%d x %d" % (size, n) for size, n in sorted(sizes.items())),
+        "",
+    ]
+    for set_index, s in enumerate(sets):
+        note = ""
+        if len(s) < 2:
+            note = "  <-- only one image, skipped"
+            warnings.append(
+                "Set %d has only one image (%s), skipping it"
+                % (set_index, files[s[0]].name)
+            )
+        elif len(s) != usual_size:
+            note = "  <-- %d images instead of %d" % (len(s), usual_size)
+            warnings.append(
+                "Set %d has %d images instead of %d (starting at %s)"
+                % (set_index, len(s), usual_size, files[s[0]].name)
+            )
+        lines.append("Set %d:%s" % (set_index, note))
+        for i in s:
+            lines.append("    %s  %s" % (files[i].name, describe_exposure(exifs[i])))
+    return "\n".join(lines) + "\n", warnings
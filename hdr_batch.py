@@ -0,0 +1,1703 @@
+"""The merging pipeline, without any GUI.
+
+HDRBatch finds the brackets in a list of folders and runs them through the align,
+merge and tonemap stages. It is used by both the Tk interface in hdr_brackets.py
+and the command line interface in hdr_cli.py, so it must not import tkinter.
+"""
+
+import os
+import sys
+import subprocess
+import json
+import pathlib
+from pathlib import Path
+from math import log
+from datetime import datetime
+from fnmatch import fnmatch
+from concurrent.futures import Future
+from functools import partial
+import threading
+from time import sleep, time
+
+import align
+import image_io
+import numpy_merge
+import tonemap
+from exif_index import ExifIndex
+from blender_worker import BlenderWorkerPool
+from grouping import group_brackets, grouping_report
+from manifest import (
+    BuildManifest,
+    commit_output,
+    file_hash,
+    partial_path,
+    tool_fingerprint,
+)
+from tool_output import parse_progress
+from run_report import RunReport, get_child_usage
+from job_queue import FolderQueue, get_worker_id
+from pipeline import (
+    MemoryBudget,
+    StagedPipeline,
+    estimate_merge_memory,
+    get_memory_budget,
+)
+
+if getattr(sys, "frozen", False):
+    SCRIPT_DIR = pathlib.Path(sys.executable).parent  # Built with cx_freeze
+else:
+    SCRIPT_DIR = pathlib.Path(__file__).resolve().parent
+
+verbose = False
+
+# Available merge backends, mapped to their display names in the UI
+MERGE_BACKENDS = {
+    "blender": "Blender",
+    "blender_worker": "Blender (persistent)",
+    "numpy": "NumPy (built-in)",
+}
+
+# Ways the NumPy backend can merge, mapped to their display names
+MERGE_MODES = {
+    "chain": "Chain (like Blender)",
+    "weighted": "Noise-weighted with ghost removal",
+}
+
+# Ways to align the images of a bracket, mapped to their display names
+ALIGN_BACKENDS = {
+    "align_image_stack": "align_image_stack (Hugin)",
+    "opencv": "OpenCV (built-in)",
+}
+
+# Ways to tonemap the JPGs, mapped to their display names
+TONEMAP_BACKENDS = {
+    "numpy": "NumPy (built-in)",
+    "luminance": "Luminance HDR",
+}
+
+# gui_settings that change how brackets are merged, which queue workers take from the
+# coordinator rather than their own config.json so the manifest stays accurate
+JOB_SETTINGS = (
+    "raw_backend",
+    "raw_write_tiffs",
+    "merge_mode",
+    "exr_compression",
+    "exr_precision",
+    "proxy_scale",
+    "align_backend",
+    "align_per_position",
+    "tonemap_backend",
+    "tonemap_operator",
+)
+
+# Fractions of the full resolution that proxies can be merged at, 1 being full size
+PROXY_SCALES = (1, 2, 4, 8)
+
+# Ways to develop RAW files, mapped to their display names
+RAW_BACKENDS = {
+    "rawtherapee": "RawTherapee",
+    "rawpy": "rawpy (built-in)",
+}
+
+
+def get_log_path(bracket_id: int, label: str, out_folder: pathlib.Path):
+    """Get the path of a timestamped log file for a bracket."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    log_filename = "bracket_%03d_%s_%s.log" % (bracket_id, label, timestamp)
+    log_path = out_folder / "logs" / log_filename
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    return log_path
+
+
+def run_subprocess_with_prefix(
+    cmd: list,
+    bracket_id: int,
+    label: str,
+    out_folder: pathlib.Path,
+    line_callback=None,
+):
+    """Run a subprocess and save output to a timestamped log file.
+
+    Output is written to the log as it arrives rather than collected in memory,
+    and line_callback (if given) is called with each line, e.g. to show progress.
+
+    Returns the CPU time and peak memory of the process (see get_child_usage), or
+    an empty dict where the OS doesn't report them."""
+    log_path = get_log_path(bracket_id, label, out_folder)
+    usage = {}
+
+    with open(log_path, "w", buffering=1) as log_file:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        with process:
+            for line in process.stdout:
+                log_file.write(line)
+                if line_callback is not None:
+                    line_callback(line)
+            if hasattr(os, "wait4"):
+                # Reap the process here, as Popen.wait doesn't give its resource use
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                usage = get_child_usage(rusage)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return usage
+
+
+def read_json(fp: pathlib.Path) -> dict:
+    with fp.open("r") as f:
+        s = f.read()
+        # Work around invalid JSON when people paste single backslashes in there.
+        s = s.replace("\\", "/")
+        try:
+            return json.loads(s)
+        except json.JSONDecodeError as ex:
+            raise RuntimeError("Error reading JSON from %s: %s" % (fp, ex))
+
+
+def get_default_config() -> dict:
+    """Get default configuration with OS-specific paths."""
+    if sys.platform.startswith("win"):
+        # Windows default paths
+        default_exe_paths = {
+            "align_image_stack_exe": "C:\\Program Files\\Hugin\\bin\\align_image_stack.exe",
+            "blender_exe": "C:\\Program Files\\Blender Foundation\\Blender 3.4\\blender.exe",
+            "luminance_cli_exe": "C:\\Program Files\\Luminance HDR\\v.2.6.0\\luminance-hdr-cli.exe",
+            "rawtherapee_cli_exe": "C:\\Program Files\\RawTherapee\\5.12\\rawtherapee-cli.exe",
+        }
+    else:
+        # Linux default paths
+        default_exe_paths = {
+            "align_image_stack_exe": "/usr/bin/align_image_stack",
+            "blender_exe": "/usr/bin/blender",
+            "luminance_cli_exe": "/usr/bin/luminance-hdr-cli",
+            "rawtherapee_cli_exe": "/usr/bin/rawtherapee-cli",
+        }
+
+    return {
+        "exe_paths": default_exe_paths,
+        "gui_settings": {
+            "raw_extension": ".dng",
+            "tif_extension": ".tif",
+            "threads": "6",
+            "do_align": False,
+            "do_recursive": False,
+            "do_raw": False,
+            "pp3_file": "",
+            # "rawpy" decodes RAW files in-process, without PP3 profiles
+            "raw_backend": "rawtherapee",
+            # With rawpy, also write the developed TIFFs when merging with NumPy
+            "raw_write_tiffs": False,
+            "merge_backend": "blender",
+            # With the NumPy backend, "weighted" averages all exposures by their noise
+            # and leaves out moving objects, a strip at a time
+            "merge_mode": "chain",
+            # 4 or 8 quickly merges previews at 1/4 or 1/8 of the resolution into
+            # Merged/proxy instead, always with the NumPy backend and OpenCV alignment
+            "proxy_scale": 1,
+            # Compression and precision of the merged EXRs, see image_io.EXR_COMPRESSIONS
+            # and EXR_PRECISIONS. Faster compression trades CPU time for disk space.
+            "exr_compression": "piz",
+            "exr_precision": "float",
+            # "opencv" aligns in-process, and without writing aligned TIFFs when
+            # merging with NumPy
+            "align_backend": "align_image_stack",
+            # With "opencv", align once per camera position rather than per bracket
+            "align_per_position": False,
+            # "luminance" tonemaps with luminance-hdr-cli instead, for its exact look
+            "tonemap_backend": "numpy",
+            # One of tonemap.OPERATORS
+            "tonemap_operator": "reinhard02",
+            # Worker counts for the other pipeline stages, merging uses "threads"
+            "raw_threads": "2",
+            "align_threads": "4",
+            "tonemap_threads": "2",
+            # Empty uses 75% of physical memory, 0 disables the limit
+            "memory_budget_gb": "",
+            # Number of files to read EXIF data from at once
+            "exif_threads": "8",
+            # Thread counts found by auto-tuning, by hostname
+            "machine_threads": {},
+        },
+        "pp3_profiles": [],
+    }
+
+
+def get_config(cf: pathlib.Path = None) -> dict:
+    """Load configuration from config.json, creating it if it doesn't exist.
+
+    Raises RuntimeError with instructions if the configuration is incomplete."""
+    if cf is None:
+        cf = SCRIPT_DIR / "config.json"
+
+    default_config = get_default_config()
+    config = {}
+    error = ""
+    missing_json_error = (
+        "You need to configure some paths first. Edit the '%s' file and fill in the paths."
+        % cf
+    )
+
+    # Required exe paths (must exist)
+    required_exes = ["blender_exe"]
+    # Optional exe paths (can be missing, features will be disabled)
+    optional_exes = [
+        "align_image_stack_exe",
+        "rawtherapee_cli_exe",
+        "luminance_cli_exe",
+    ]
+
+    if not cf.exists() or cf.stat().st_size == 0:
+        with cf.open("w") as f:
+            json.dump(default_config, f, indent=4, sort_keys=True)
+        error = missing_json_error + " (file does not exist or is empty)"
+    else:
+        config = read_json(cf)
+        # Merge with defaults to ensure all keys exist
+        for key, value in default_config.items():
+            if key not in config:
+                config[key] = value
+            elif isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    if sub_key not in config[key]:
+                        config[key][sub_key] = sub_value
+
+        # Validate required exe_paths
+        exe_paths = config.get("exe_paths", {})
+        for key in required_exes:
+            path = exe_paths.get(key, "")
+            if not path:
+                error = missing_json_error + " (%s is empty)" % key
+                break
+            if not pathlib.Path(path).exists():
+                error = (
+                    '"%s" in config.json either doesn\'t exist or is an invalid path.'
+                    % path
+                )
+
+        # Check optional exe_paths and mark as unavailable if missing
+        config["_optional_exes_available"] = {}
+        for key in optional_exes:
+            path = exe_paths.get(key, "")
+            if path and pathlib.Path(path).exists():
+                config["_optional_exes_available"][key] = True
+            else:
+                config["_optional_exes_available"][key] = False
+                print(
+                    "Warning: %s is not available (%s). Related features will be disabled."
+                    % (key, path + " not found" if path else "path not configured")
+                )
+
+    if error:
+        raise RuntimeError(error)
+
+    return config
+
+
+def save_config(config: dict, cf: pathlib.Path = None):
+    """Save configuration to config.json."""
+    if cf is None:
+        cf = SCRIPT_DIR / "config.json"
+    with cf.open("w") as f:
+        json.dump(config, f, indent=4, sort_keys=True)
+
+
+def get_glob(extension: str) -> str:
+    """Turn an extension like ".tif" into a glob pattern, unless it already is one."""
+    if "*" not in extension:
+        return "*%s" % extension
+    return extension
+
+
+def iter_folders(roots: list, extension: str, recursive: bool):
+    """Yield each folder to process, walking every input folder only once.
+
+    In recursive mode every subfolder containing files matching extension is
+    yielded as soon as it is found, skipping our own "Merged" output folders."""
+    pattern = get_glob(extension)
+    seen = set()
+    for root in roots:
+        root = pathlib.Path(root)
+        if not root.exists():
+            print("Warning: Batch folder does not exist: %s" % root)
+            continue
+        if not recursive:
+            if root not in seen:
+                seen.add(root)
+                yield root
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d != "Merged")
+            folder = pathlib.Path(dirpath)
+            if folder == root or folder in seen:
+                continue
+            if any(fnmatch(name, pattern) for name in filenames):
+                seen.add(folder)
+                yield folder
+
+
+def ev_diff(bright_image, dark_image):
+    dr_shutter = log(bright_image["shutter_speed"] / dark_image["shutter_speed"], 2)
+    try:
+        dr_aperture = log(dark_image["aperture"] / bright_image["aperture"], 1.41421)
+    except (ValueError, ZeroDivisionError):
+        # No lens data means aperture is 0, and we can't divide by 0 :)
+        dr_aperture = 0
+    dr_iso = log(bright_image["iso"] / dark_image["iso"], 2)
+    return dr_shutter + dr_aperture + dr_iso
+
+
+class BracketJob:
+    """A single exposure bracket to merge, and where its outputs go."""
+
+    def __init__(
+        self,
+        folder: pathlib.Path,
+        out_folder: pathlib.Path,
+        index: int,
+        img_list: list,
+        exifs: list,
+        filter_used: str = "None",
+    ):
+        self.folder = folder
+        self.out_folder = out_folder
+        self.index = index
+        self.img_list = img_list  # "path___ev" strings
+        self.exifs = exifs
+        self.filter_used = filter_used
+        self.name = "merged_%03d" % index
+        self.key = (folder, index)  # Identifies the bracket in progress reports
+        self.exr_path = out_folder / "exr" / (self.name + ".exr")
+        self.jpg_path = out_folder / "jpg" / (self.name + ".jpg")
+        # Set by process_folder to skip brackets that haven't changed since last run.
+        # Jobs run by a queue worker have no manifest, the coordinator updates it.
+        self.manifest = None
+        self.signature = None
+        # PP3 profile of a bracket of RAW files, which are developed to TIFFs first
+        self.pp3_file = None
+        # RAW files that are decoded with rawpy rather than RawTherapee
+        self.decode_raw = False
+        # Transforms of the images found by the OpenCV alignment, which the NumPy
+        # merge applies as it loads them
+        self.transforms = None
+        # The merged image, kept from the NumPy merge for the built-in tonemapping
+        self.merged = None
+        # Proxies are merged from the images loaded at 1/scale of their size
+        self.scale = 1
+        # The configuration to merge with, set by do_merge. Queue workers use a
+        # copy with the coordinator's JOB_SETTINGS.
+        self.config = None
+
+    def resolution(self) -> str:
+        """The "WIDTHxHEIGHT" the bracket is merged at."""
+        width, height = (int(d) for d in self.exifs[0]["resolution"].split("x"))
+        return "%dx%d" % (-(-width // self.scale), -(-height // self.scale))
+
+    def image_names(self) -> list:
+        return [Path(p.split("___")[0]).name for p in self.img_list]
+
+    def to_dict(self) -> dict:
+        """The job as JSON-compatible data, for passing it to queue workers."""
+        return {
+            "folder": self.folder.as_posix(),
+            "out_folder": self.out_folder.as_posix(),
+            "index": self.index,
+            "img_list": self.img_list,
+            "exifs": self.exifs,
+            "filter_used": self.filter_used,
+            "signature": self.signature,
+            "pp3_file": self.pp3_file,
+            "decode_raw": self.decode_raw,
+            "scale": self.scale,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        job = cls(
+            pathlib.Path(data["folder"]),
+            pathlib.Path(data["out_folder"]),
+            data["index"],
+            data["img_list"],
+            data["exifs"],
+            data["filter_used"],
+        )
+        job.signature = data["signature"]
+        job.pp3_file = data.get("pp3_file")
+        job.decode_raw = data.get("decode_raw", False)
+        job.scale = data.get("scale", 1)
+        return job
+
+
+def get_profile_for_folder(
+    profiles: list, folder_path: str, folder_profiles: dict = None
+):
+    """Get the PP3 profile for a folder, auto-matching by folder key or using default.
+
+    folder_profiles maps folder paths to the names of manually assigned profiles."""
+    folder_profiles = folder_profiles or {}
+    if not profiles:
+        return None
+
+    folder_name = pathlib.Path(folder_path).name.lower()
+
+    # First check if folder has a manually assigned profile
+    if folder_path in folder_profiles:
+        profile_name = folder_profiles[folder_path]
+        for profile in profiles:
+            if profile.get("name") == profile_name:
+                return profile
+
+    # Then try to auto-match by folder key
+    for profile in profiles:
+        folder_key = profile.get("folder_key", "").lower()
+        if folder_key and folder_key in folder_name:
+            return profile
+
+    # Fall back to default profile
+    for profile in profiles:
+        if profile.get("default", False):
+            return profile
+
+    # If no default, return first profile
+    return profiles[0] if profiles else None
+
+
+class SettingsError(RuntimeError):
+    """The settings of a batch can't be used, title is a short summary for dialogs."""
+
+    def __init__(self, title: str, message: str):
+        super().__init__(message)
+        self.title = title
+
+
+class NoMatchingFilesError(SettingsError):
+    """None of the input folders contain files to merge."""
+
+
+def get_proxy_scale(config: dict) -> int:
+    """The proxy_scale setting, 1 when merging at full resolution."""
+    return int(config["gui_settings"]["proxy_scale"])
+
+
+def get_align_backend(config: dict) -> str:
+    """The align_backend setting, except that proxies are always aligned with
+    OpenCV at their own size, rather than align_image_stack at full size."""
+    if get_proxy_scale(config) > 1:
+        return "opencv"
+    return config["gui_settings"]["align_backend"]
+
+
+def merge_strip_rows(config: dict, merge_backend: str) -> int:
+    """Rows merged at once, or 0 if the images of a bracket are loaded whole."""
+    if merge_backend == "numpy" and config["gui_settings"]["merge_mode"] == "weighted":
+        return numpy_merge.STRIP_ROWS
+    return 0
+
+
+def check_settings(config: dict, do_raw: bool, do_align: bool):
+    """Raise a SettingsError if a feature is enabled that can't be used."""
+    optional_exes_available = config.get("_optional_exes_available", {})
+
+    raw_backend = config["gui_settings"]["raw_backend"]
+    if do_raw and raw_backend == "rawpy":
+        try:
+            image_io.require("rawpy")
+        except RuntimeError as ex:
+            raise SettingsError(
+                "rawpy Not Installed",
+                "RAW processing with rawpy is enabled but it can't be imported!\n\n"
+                "%s" % ex,
+            )
+    # RawTherapee and PP3 profiles are only needed to develop with RawTherapee
+    use_rawtherapee = do_raw and raw_backend != "rawpy"
+
+    if use_rawtherapee and not optional_exes_available.get(
+        "rawtherapee_cli_exe", False
+    ):
+        raise SettingsError(
+            "RawTherapee Not Available",
+            "RAW processing is enabled but RawTherapee CLI is not configured or not found!\n\n"
+            "Please configure the RawTherapee CLI path in config.json.",
+        )
+
+    # Validate RAW processing settings if enabled
+    if use_rawtherapee and not config.get("pp3_profiles", []):
+        raise SettingsError(
+            "PP3 Profile Required",
+            "RAW processing is enabled but no PP3 profiles are configured!\n\n"
+            "Please add at least one PP3 profile using 'Manage Profiles...'.",
+        )
+
+    if config["gui_settings"]["tonemap_backend"] == "luminance":
+        if not optional_exes_available.get("luminance_cli_exe", False):
+            raise SettingsError(
+                "Luminance HDR Not Available",
+                "Tonemapping with Luminance HDR is enabled but luminance-hdr-cli is "
+                "not configured or not found!\n\n"
+                "Please configure the luminance_cli_exe path in config.json, or set "
+                "tonemap_backend to numpy.",
+            )
+    else:
+        try:
+            image_io.require("PIL.Image", "Pillow")
+        except RuntimeError as ex:
+            raise SettingsError(
+                "Pillow Not Installed",
+                "The built-in tonemapping needs Pillow to write JPGs!\n\n%s" % ex,
+            )
+    try:
+        proxy_scale = get_proxy_scale(config)
+    except ValueError:
+        proxy_scale = None
+    if proxy_scale not in PROXY_SCALES:
+        raise SettingsError(
+            "Unknown Proxy Scale",
+            "proxy_scale in config.json must be one of: %s"
+            % ", ".join(str(s) for s in PROXY_SCALES),
+        )
+    if config["gui_settings"]["merge_mode"] not in MERGE_MODES:
+        raise SettingsError(
+            "Unknown Merge Mode",
+            "merge_mode in config.json must be one of: %s" % ", ".join(MERGE_MODES),
+        )
+    if config["gui_settings"]["exr_compression"] not in image_io.EXR_COMPRESSIONS:
+        raise SettingsError(
+            "Unknown EXR Compression",
+            "exr_compression in config.json must be one of: %s"
+            % ", ".join(image_io.EXR_COMPRESSIONS),
+        )
+    if config["gui_settings"]["exr_precision"] not in image_io.EXR_PRECISIONS:
+        raise SettingsError(
+            "Unknown EXR Precision",
+            "exr_precision in config.json must be one of: %s"
+            % ", ".join(image_io.EXR_PRECISIONS),
+        )
+    if config["gui_settings"]["tonemap_operator"] not in tonemap.OPERATORS:
+        raise SettingsError(
+            "Unknown Tonemapper",
+            "tonemap_operator in config.json must be one of: %s"
+            % ", ".join(tonemap.OPERATORS),
+        )
+
+    # Validate Align feature if enabled
+    if do_align and get_align_backend(config) == "opencv":
+        try:
+            image_io.require("cv2", "opencv-python")
+        except RuntimeError as ex:
+            raise SettingsError(
+                "OpenCV Not Installed",
+                "Align with OpenCV is enabled but it can't be imported!\n\n%s" % ex,
+            )
+    elif do_align and not optional_exes_available.get("align_image_stack_exe", False):
+        raise SettingsError(
+            "Align Image Stack Not Available",
+            "Align is enabled but align_image_stack is not configured or not found!\n\n"
+            "Please configure the align_image_stack path in config.json.",
+        )
+
+
+class HDRBatch:
+    """Merges every bracket found in a list of folders."""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.exe_paths = config.get("exe_paths", {})
+        self.exif_index = ExifIndex()
+        # Brackets finish on the stage threads, so the counters are only changed
+        # while holding progress_lock
+        self.total_sets_global = 0
+        self.completed_sets_global = 0
+        self.failed_sets = []  # Keys of the brackets that raised an exception
+        self.progress_lock = threading.Lock()
+        self.processed_folders = []
+        self.bracket_list = []  # Images per bracket in each processed folder
+        self.stage_workers = {}
+        self.start_time = None
+        self.blender_workers = None  # Persistent Blender processes, if used
+        self.manifests = {}  # Build manifest of each Merged folder
+        # Transforms found by OpenCV in each Merged folder, loaded by the align
+        # threads while holding status_lock
+        self.alignment_caches = {}
+        self.bracket_status = {}  # (folder, bracket index) -> what it's doing now
+        self.status_lock = threading.Lock()
+        self.report = RunReport()  # Timings of every step
+
+    def develop_bracket(self, job: BracketJob, rawtherapee_cli_exe: str, pp3_file: str):
+        """Develop the RAW files of a bracket to TIFFs in a 'tif' subfolder with
+        RawTherapee, replacing job.img_list with the TIFFs."""
+        folder = job.folder
+        i = job.index
+        tif_folder = folder / "tif"
+        tif_folder.mkdir(parents=True, exist_ok=True)
+
+        raw_files = []
+        new_img_list = []
+        for img in job.img_list:
+            raw_path, ev = img.split("___")
+            raw_path = pathlib.Path(raw_path)
+            # RawTherapee names its output after the RAW file
+            tif_path = tif_folder / (raw_path.stem + ".tif")
+            new_img_list.append(tif_path.as_posix() + "___" + ev)
+            # Keep TIFFs developed since the RAW file and profile last changed
+            if not tif_path.exists() or tif_path.stat().st_mtime < max(
+                raw_path.stat().st_mtime, pathlib.Path(pp3_file).stat().st_mtime
+            ):
+                raw_files.append(raw_path)
+
+        if raw_files:
+            print(
+                "Folder %s: Bracket %d: Developing %d RAW files with RawTherapee"
+                % (folder.name, i, len(raw_files))
+            )
+            # Usage: rawtherapee-cli -p profile.pp3 -o output_dir -t -Y -c input_files
+            cmd = [
+                rawtherapee_cli_exe,
+                "-p",
+                pp3_file,  # Apply PP3 profile
+                "-o",
+                str(tif_folder),  # Output directory
+                "-t",  # TIFF output (16-bit uncompressed)
+                "-Y",  # Overwrite TIFFs developed with an older profile
+                "-c",  # Convert mode (must be last before input files)
+            ]
+            cmd += [str(raw_file) for raw_file in raw_files]
+            if verbose:
+                print("Folder %s: Command: %s" % (folder.name, " ".join(cmd)))
+
+            self.set_status(job.key, "developing")
+            usage = run_subprocess_with_prefix(
+                cmd,
+                i,
+                "rawtherapee",
+                job.out_folder,
+                line_callback=self.progress_callback(job.key, "rawtherapee"),
+            )
+            self.report.record_job(job, "raw", tool="rawtherapee", **usage)
+
+        job.img_list = new_img_list
+        # The RAW files' EXIF may only give the size of their embedded preview
+        resolution = self.exif_index.get(pathlib.Path(new_img_list[0].split("___")[0]))[
+            "resolution"
+        ]
+        job.exifs = [dict(exif, resolution=resolution) for exif in job.exifs]
+
+    def decode_bracket(self, job: BracketJob):
+        """Decode the RAW files of a bracket with rawpy to 16-bit TIFFs in a
+        'rawpy_tif' subfolder, replacing job.img_list with the TIFFs.
+
+        Only needed when the TIFFs are asked for or the next step reads files,
+        otherwise the NumPy merge decodes the RAW files itself."""
+        tif_folder = job.folder / "rawpy_tif"
+        tif_folder.mkdir(parents=True, exist_ok=True)
+        self.set_status(job.key, "developing")
+
+        new_img_list = []
+        decoded = 0
+        for img in job.img_list:
+            raw_path, ev = img.split("___")
+            raw_path = pathlib.Path(raw_path)
+            tif_path = tif_folder / (raw_path.stem + ".tif")
+            new_img_list.append(tif_path.as_posix() + "___" + ev)
+            if (
+                tif_path.exists()
+                and tif_path.stat().st_mtime >= raw_path.stat().st_mtime
+            ):
+                continue
+            # Written under a temporary name, so a cancelled run leaves no half TIFF
+            image_io.write_tiff16(partial_path(tif_path), image_io.read_raw(raw_path))
+            commit_output(tif_path)
+            decoded += 1
+
+        if decoded:
+            print(
+                "Folder %s: Bracket %d: Decoded %d RAW files with rawpy"
+                % (job.folder.name, job.index, decoded)
+            )
+            self.report.record_job(job, "raw", tool="rawpy")
+        job.img_list = new_img_list
+
+    def get_manifest(self, out_folder: pathlib.Path) -> BuildManifest:
+        """Get the build manifest of a Merged folder, loading it on first use."""
+        if out_folder not in self.manifests:
+            self.manifests[out_folder] = BuildManifest(out_folder)
+        return self.manifests[out_folder]
+
+    def get_alignment_cache(self, out_folder: pathlib.Path) -> align.AlignmentCache:
+        """Get the alignment cache of a Merged folder, loading it on first use."""
+        with self.status_lock:
+            if out_folder not in self.alignment_caches:
+                self.alignment_caches[out_folder] = align.AlignmentCache(out_folder)
+            return self.alignment_caches[out_folder]
+
+    def set_status(self, key: tuple, status: str):
+        """Set the live status of a bracket, keyed by (folder, bracket index).
+
+        A status of None removes the bracket from the status line."""
+        with self.status_lock:
+            if status is None:
+                self.bracket_status.pop(key, None)
+            else:
+                self.bracket_status[key] = status
+
+    def progress_callback(self, key: tuple, label: str):
+        """A line_callback that shows the progress a tool reports as key's status."""
+
+        def on_line(line):
+            progress = parse_progress(label, line)
+            if progress is not None:
+                self.set_status(key, progress)
+
+        return on_line
+
+    def status_text(self, limit: int = 4) -> str:
+        """Summary of what the brackets that are currently running are doing."""
+        with self.status_lock:
+            statuses = sorted(
+                self.bracket_status.items(),
+                key=lambda s: (str(s[0][0]), -1 if s[0][1] is None else s[0][1]),
+            )
+        parts = []
+        for (folder, index), status in statuses[:limit]:
+            if index is None:
+                parts.append("%s: %s" % (folder.name, status))
+            else:
+                parts.append("%s #%d: %s" % (folder.name, index, status))
+        if len(statuses) > limit:
+            parts.append("+%d more" % (len(statuses) - limit))
+        return "  |  ".join(parts)
+
+    def add_total(self):
+        """Count a newly found bracket."""
+        with self.progress_lock:
+            self.total_sets_global += 1
+
+    def add_completed(self):
+        """Count a finished bracket and print the overall progress."""
+        with self.progress_lock:
+            self.completed_sets_global += 1
+            completed, total = self.completed_sets_global, self.total_sets_global
+        print(
+            "Completed sets: %d/%d, %.1f%%"
+            % (completed, total, completed / total * 100)
+        )
+
+    def add_failed(self, key: tuple):
+        with self.progress_lock:
+            self.failed_sets.append(key)
+
+    def report_failure(self, key: tuple, future: Future):
+        """Done-callback of a bracket's Future that reports it if it failed."""
+        ex = future.exception()
+        if ex is not None:
+            print("Folder %s: Bracket %d: Exception - %s" % (key[0].name, key[1], ex))
+            self.add_failed(key)
+
+    def get_progress(self) -> tuple:
+        """(completed, failed, total) brackets so far, safe to call from any thread."""
+        with self.progress_lock:
+            return (
+                self.completed_sets_global,
+                len(self.failed_sets),
+                self.total_sets_global,
+            )
+
+    def align_bracket(self, job: BracketJob, align_image_stack_exe: str):
+        """Align the images of a bracket, replacing job.img_list with the aligned files."""
+        folder = job.folder
+        i = job.index
+        img_list = job.img_list
+        align_folder = job.out_folder / "aligned"
+
+        if verbose:
+            print(
+                "Folder %s: Bracket %d: Aligning images %s"
+                % (folder.name, i, job.image_names())
+            )
+        else:
+            print("Folder %s: Bracket %d: Aligning images" % (folder.name, i))
+
+        align_folder.mkdir(parents=True, exist_ok=True)
+        actual_img_list = [i.split("___")[0] for i in img_list]
+        cmd = [
+            align_image_stack_exe,
+            "-v",
+            "-i",
+            "-l",
+            "-a",
+            (align_folder / "align_{}_".format(i)).as_posix(),
+            "--gpu",
+        ]
+        cmd += actual_img_list
+        new_img_list = []
+        for j, img in enumerate(img_list):
+            new_img_list.append(
+                (
+                    align_folder
+                    / "align_{}_{}.tif___{}".format(
+                        i, str(j).zfill(4), img_list[j].split("___")[-1]
+                    )
+                ).as_posix()
+            )
+        self.set_status(job.key, "aligning")
+        usage = run_subprocess_with_prefix(
+            cmd,
+            i,
+            "align",
+            job.out_folder,
+            line_callback=self.progress_callback(job.key, "align"),
+        )
+        self.report.record_job(job, "align", tool="align_image_stack", **usage)
+        job.img_list = new_img_list
+
+    def align_bracket_opencv(self, job: BracketJob, merge_backend: str):
+        """Find the transforms that align the images of a bracket with OpenCV.
+
+        The NumPy merge warps the images as it loads them, the other backends get
+        the aligned images written to the 'aligned' folder like align_image_stack's."""
+        folder = job.folder
+        i = job.index
+        cache = self.get_alignment_cache(job.out_folder)
+        self.set_status(job.key, "aligning")
+        self.report.record_job(job, "align", tool="opencv")
+
+        print("Folder %s: Bracket %d: Aligning images" % (folder.name, i))
+        transforms, source = cache.align(
+            job.name,
+            i,
+            job.img_list,
+            per_position=job.config["gui_settings"]["align_per_position"],
+            load_scale=job.scale,
+        )
+        self.report.record_job(job, "align", transforms=source)
+        if source == "reused":
+            print(
+                "Folder %s: Bracket %d: Reusing the alignment of this camera position"
+                % (folder.name, i)
+            )
+        elif source == "cached" and verbose:
+            print("Folder %s: Bracket %d: Reusing cached alignment" % (folder.name, i))
+        job.transforms = transforms
+
+        if merge_backend == "numpy":
+            return
+        align_folder = job.out_folder / "aligned"
+        align_folder.mkdir(parents=True, exist_ok=True)
+        new_img_list = []
+        for j, (img, transform) in enumerate(zip(job.img_list, transforms)):
+            path, ev = img.split("___")
+            aligned_path = align_folder / ("align_%d_%04d.tif" % (i, j))
+            image = align.warp(image_io.load_image(pathlib.Path(path)), transform)
+            image_io.write_tiff16(partial_path(aligned_path), image)
+            commit_output(aligned_path)
+            new_img_list.append(aligned_path.as_posix() + "___" + ev)
+        job.img_list = new_img_list
+        job.transforms = None
+
+    def merge_bracket(
+        self,
+        job: BracketJob,
+        blender_exe: str,
+        merge_blend: pathlib.Path,
+        merge_py: pathlib.Path,
+        merge_backend: str,
+    ):
+        """Merge the images of a bracket to job.exr_path."""
+        folder = job.folder
+        i = job.index
+        # Written under a temporary name until complete
+        exr_path = partial_path(job.exr_path)
+        out_folder = job.out_folder
+        exr_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if verbose:
+            print(
+                "Folder %s: Bracket %d: Merging %s"
+                % (folder.name, i, job.image_names())
+            )
+        else:
+            print("Folder %s: Bracket %d: Merging" % (folder.name, i))
+
+        self.set_status(job.key, "merging")
+        # In-process and persistent merges have no child process of their own to
+        # measure, so only get their wall time
+        self.report.record_job(job, "merge", tool=merge_backend)
+        gui_settings = job.config["gui_settings"]
+        if merge_backend == "numpy":
+            # Tonemapped next, so there's no need to read the EXR back
+            keep_result = gui_settings["tonemap_backend"] == "numpy"
+            merged = numpy_merge.merge_to_exr(
+                job.img_list,
+                exr_path,
+                job.transforms,
+                gui_settings["merge_mode"],
+                gui_settings["exr_compression"],
+                gui_settings["exr_precision"],
+                keep_result,
+                job.scale,
+            )
+            if keep_result:
+                job.merged = merged
+        elif merge_backend == "blender_worker":
+            self.blender_workers.merge(
+                job.exifs[0]["resolution"],
+                exr_path,
+                job.filter_used,
+                i,
+                job.img_list,
+                get_log_path(i, "blender", out_folder),
+                line_callback=self.progress_callback(job.key, "blender"),
+                exr_compression=gui_settings["exr_compression"],
+                exr_precision=gui_settings["exr_precision"],
+            )
+        else:
+            cmd = [
+                blender_exe,
+                "--background",
+                merge_blend.as_posix(),
+                "--factory-startup",
+                "--python",
+                merge_py.as_posix(),
+                "--",
+                "--exr",
+                gui_settings["exr_compression"],
+                gui_settings["exr_precision"],
+                job.exifs[0]["resolution"],
+                exr_path.as_posix(),
+                job.filter_used,
+                str(i),  # Bracket ID
+            ]
+            cmd += job.img_list
+            usage = run_subprocess_with_prefix(
+                cmd,
+                i,
+                "blender",
+                out_folder,
+                line_callback=self.progress_callback(job.key, "blender"),
+            )
+            self.report.record_job(job, "merge", **usage)
+
+        if merge_backend != "numpy":
+            # Delete .blend1 backup file created by Blender
+            blend1_path = exr_path.with_name("bracket_%03d_sample.blend1" % i)
+            if blend1_path.exists():
+                blend1_path.unlink()
+
+        commit_output(job.exr_path)
+
+    def tonemap_bracket(self, job: BracketJob, luminance_cli_exe: str):
+        """Tonemap the merged EXR of a bracket to a JPG for stitching."""
+        folder = job.folder
+        i = job.index
+        job.jpg_path.parent.mkdir(parents=True, exist_ok=True)
+        self.set_status(job.key, "tonemapping")
+
+        operator = job.config["gui_settings"]["tonemap_operator"]
+        if job.config["gui_settings"]["tonemap_backend"] == "luminance":
+            cmd = [
+                luminance_cli_exe,
+                "-l",
+                job.exr_path.as_posix(),
+                "--tmo",
+                operator,
+                "-q",
+                str(tonemap.JPG_QUALITY),
+                "-o",
+                partial_path(job.jpg_path).as_posix(),
+            ]
+            usage = run_subprocess_with_prefix(cmd, i, "luminance", job.out_folder)
+            self.report.record_job(job, "tonemap", tool="luminance", **usage)
+        else:
+            merged = job.merged
+            job.merged = None
+            if merged is None:  # Merged by Blender
+                merged = image_io.load_image(job.exr_path)
+            tonemap.write_jpg(partial_path(job.jpg_path), merged, operator)
+            self.report.record_job(job, "tonemap", tool=operator)
+        commit_output(job.jpg_path)
+        if job.manifest is not None:
+            job.manifest.record(job.name, job.signature, [job.exr_path, job.jpg_path])
+        if verbose:
+            print(
+                "Folder %s: Bracket %d: Complete %s"
+                % (folder.name, i, job.image_names())
+            )
+        else:
+            print("Folder %s: Bracket %d: Complete" % (folder.name, i))
+        self.add_completed()
+
+    def skip_if_up_to_date(self, job: BracketJob) -> bool:
+        """Count a bracket as completed if its outputs are up to date."""
+        if job.manifest is None or not job.manifest.is_up_to_date(
+            job.name, job.signature
+        ):
+            return False
+        print(
+            "Folder %s: Bracket %d: Skipping, %s is up to date"
+            % (
+                job.folder.name,
+                job.index,
+                job.exr_path.relative_to(job.out_folder.parent),
+            )
+        )
+        self.add_completed()
+        return True
+
+    def writes_tiffs(self, job: BracketJob, do_align: bool, merge_backend: str):
+        """Whether the RAW files of a bracket are developed or decoded to TIFFs in
+        its source folder before it's merged."""
+        if not job.decode_raw:
+            return bool(job.pp3_file)
+        config = job.config or self.config
+        opencv_align = do_align and get_align_backend(config) == "opencv"
+        return (
+            (do_align and not opencv_align)
+            or merge_backend != "numpy"
+            or config["gui_settings"]["raw_write_tiffs"]
+        )
+
+    def do_merge(
+        self,
+        pipeline: StagedPipeline,
+        job: BracketJob,
+        blender_exe: str,
+        merge_blend: pathlib.Path,
+        merge_py: pathlib.Path,
+        luminance_cli_exe: str,
+        align_image_stack_exe: str,
+        do_align: bool,
+        merge_backend: str = "blender",
+    ) -> Future:
+        """Queue the develop, align, merge and tonemap steps of a bracket on the
+        pipeline."""
+        if self.skip_if_up_to_date(job):
+            return pipeline.submit([])
+
+        if job.config is None:
+            job.config = self.config
+        opencv_align = do_align and get_align_backend(job.config) == "opencv"
+        steps = []
+        if job.decode_raw and self.writes_tiffs(job, do_align, merge_backend):
+            steps.append(("raw", partial(self.decode_bracket, job)))
+        elif job.pp3_file:
+            steps.append(
+                (
+                    "raw",
+                    partial(
+                        self.develop_bracket,
+                        job,
+                        self.exe_paths["rawtherapee_cli_exe"],
+                        job.pp3_file,
+                    ),
+                )
+            )
+        if opencv_align:
+            steps.append(
+                ("align", partial(self.align_bracket_opencv, job, merge_backend))
+            )
+        elif do_align:
+            steps.append(
+                ("align", partial(self.align_bracket, job, align_image_stack_exe))
+            )
+        steps.append(
+            (
+                "merge",
+                partial(
+                    self.merge_bracket,
+                    job,
+                    blender_exe,
+                    merge_blend,
+                    merge_py,
+                    merge_backend,
+                ),
+                # Only known once any RAW files have been developed
+                lambda: estimate_merge_memory(
+                    job.resolution(),
+                    len(job.img_list),
+                    merge_backend,
+                    merge_strip_rows(job.config, merge_backend),
+                ),
+            )
+        )
+        steps.append(("tonemap", partial(self.tonemap_bracket, job, luminance_cli_exe)))
+        future = pipeline.submit(steps, tag=job)
+        future.add_done_callback(lambda f: self.set_status(job.key, None))
+        return future
+
+    def process_folder(
+        self,
+        folder: pathlib.Path,
+        extension: str,
+        do_raw: bool,
+        pp3_file: str,
+        build_settings: dict,
+        dry_run: bool = False,
+    ):
+        """Find the brackets in a single folder, yielding a BracketJob for each.
+
+        In RAW mode the brackets are found from the RAW files' EXIF, and each one is
+        developed with RawTherapee as the first step of its own merge, or decoded
+        with rawpy as part of it. With dry_run nothing is written to the output
+        folder, i.e. no grouping report and no renaming of earlier outputs."""
+        out_folder = folder / "Merged"
+        proxy_scale = get_proxy_scale(self.config)
+        if proxy_scale > 1:
+            # Kept apart from the full resolution outputs, which can be merged later
+            out_folder = out_folder / "proxy"
+
+        decode = do_raw and self.config["gui_settings"]["raw_backend"] == "rawpy"
+        develop = do_raw and not decode and pp3_file and pathlib.Path(pp3_file).exists()
+        if develop:
+            build_settings = dict(build_settings, pp3=file_hash(pp3_file))
+
+        files = sorted(folder.glob(get_glob(extension)))
+
+        if not files:
+            print("Error processing %s: No matching files found" % folder)
+            return
+
+        started = time()
+        exif_threads = int(self.config["gui_settings"]["exif_threads"])
+        exifs = list(self.exif_index.iter_many(files, exif_threads))
+        sets = group_brackets(exifs)
+        report, warnings = grouping_report(files, exifs, sets)
+
+        print("\nFolder: %s" % folder)
+        print(report.split("\n\n")[0])
+        for warning in warnings:
+            print("Warning: %s" % warning)
+        print()
+        if verbose:
+            print(report)
+        if not dry_run:
+            report_path = out_folder / "logs" / "grouping_report.txt"
+            report_path.parent.mkdir(parents=True, exist_ok=True)
+            report_path.write_text(report)
+
+        # EVs are relative to the brightest exposure in the whole folder, so every
+        # set is merged to the same scale even if some of its images are missing
+        reference = {"shutter_speed": 1000000000, "aperture": 0.1, "iso": 1000000000000}
+        evs = [ev_diff(reference, e) for e in exifs]
+        min_ev = min(evs)
+
+        filter_used = "None"  # self.filter.get().replace(' ', '').replace('+', '_')  # Depreciated
+
+        jobs = []
+        for i, s in enumerate(sets):
+            if len(s) < 2:
+                continue
+            img_list = [
+                files[ii].as_posix() + "___" + str(evs[ii] - min_ev) for ii in s
+            ]
+            set_exifs = [exifs[ii] for ii in s]
+            if decode:
+                # The RAW files' EXIF may only give the size of their embedded preview
+                resolution = image_io.raw_resolution(files[s[0]])
+                set_exifs = [dict(exif, resolution=resolution) for exif in set_exifs]
+            jobs.append(
+                BracketJob(folder, out_folder, i, img_list, set_exifs, filter_used)
+            )
+
+        manifest = self.get_manifest(out_folder)
+        for job in jobs:
+            job.manifest = manifest
+            job.signature = manifest.signature(job.img_list, build_settings)
+            if develop:
+                job.pp3_file = pp3_file
+            job.decode_raw = decode
+            job.scale = proxy_scale
+        if not dry_run:
+            # Rename earlier outputs whose bracket got a different number
+            manifest.reconcile({job.name: job.signature for job in jobs})
+        self.report.record(
+            out_folder,
+            folder.name,
+            None,
+            "discover",
+            tool="exif",
+            wall=time() - started,
+            worker=get_worker_id(),
+        )
+
+        yield from jobs
+
+    def get_build_settings(self, merge_backend: str, do_align: bool, do_raw: bool):
+        """Anything that changes the outputs, so changing it redoes the brackets."""
+        merge_blend = SCRIPT_DIR / "blender" / "HDR_Merge.blend"
+        merge_py = SCRIPT_DIR / "blender" / "blender_merge.py"
+        build_settings = {
+            "merge_backend": merge_backend,
+            "align": do_align,
+            "tonemap": self.config["gui_settings"]["tonemap_operator"],
+            "tools": {},
+        }
+        if self.config["gui_settings"]["tonemap_backend"] == "luminance":
+            build_settings["tools"]["luminance"] = tool_fingerprint(
+                self.exe_paths["luminance_cli_exe"]
+            )
+        else:
+            build_settings["tools"]["tonemap"] = "numpy (version %d)" % (
+                tonemap.TONEMAP_VERSION
+            )
+        merge_mode = self.config["gui_settings"]["merge_mode"]
+        if merge_backend == "numpy" and merge_mode != "chain":
+            build_settings["merge_mode"] = merge_mode
+        if get_proxy_scale(self.config) > 1:
+            build_settings["proxy_scale"] = get_proxy_scale(self.config)
+        exr_format = "%s/%s" % (
+            self.config["gui_settings"]["exr_compression"],
+            self.config["gui_settings"]["exr_precision"],
+        )
+        if exr_format != "piz/float":
+            build_settings["exr"] = exr_format
+        if merge_backend != "numpy":
+            build_settings["tools"]["blender"] = tool_fingerprint(
+                self.exe_paths["blender_exe"]
+            )
+            build_settings["tools"]["merge_blend"] = file_hash(merge_blend)
+            build_settings["tools"]["merge_py"] = file_hash(merge_py)
+        if do_align and get_align_backend(self.config) == "opencv":
+            build_settings["tools"]["align"] = "opencv %s (version %d)" % (
+                image_io.require("cv2", "opencv-python").__version__,
+                align.ALIGN_VERSION,
+            )
+            if self.config["gui_settings"]["align_per_position"]:
+                build_settings["align_per_position"] = True
+        elif do_align:
+            build_settings["tools"]["align"] = tool_fingerprint(
+                self.exe_paths["align_image_stack_exe"]
+            )
+        if do_raw and self.config["gui_settings"]["raw_backend"] == "rawpy":
+            rawpy = image_io.require("rawpy")
+            build_settings["tools"]["rawpy"] = "%s (LibRaw %s)" % (
+                rawpy.__version__,
+                ".".join(str(v) for v in rawpy.libraw_version),
+            )
+        elif do_raw:
+            build_settings["tools"]["rawtherapee"] = tool_fingerprint(
+                self.exe_paths["rawtherapee_cli_exe"]
+            )
+        return build_settings
+
+    def record_step(
+        self,
+        job: BracketJob,
+        stage: str,
+        queued: float,
+        started: float,
+        finished: float,
+    ):
+        """Record the timing of a pipeline step in the run report."""
+        self.report.record_job(
+            job,
+            stage,
+            queue_wait=started - queued,
+            wall=finished - started,
+            worker=get_worker_id(),
+        )
+
+    def get_pipeline(self, threads: str) -> StagedPipeline:
+        """A StagedPipeline with the stage workers and memory budget from config."""
+        gui_settings = self.config["gui_settings"]
+        self.stage_workers = {
+            "raw": gui_settings["raw_threads"],
+            "align": gui_settings["align_threads"],
+            "merge": threads,
+            "tonemap": gui_settings["tonemap_threads"],
+        }
+        memory_budget = MemoryBudget(
+            get_memory_budget(gui_settings["memory_budget_gb"])
+        )
+        if memory_budget.budget:
+            print(
+                "Memory budget for merging: %.1f GB" % (memory_budget.budget / 1024**3)
+            )
+        return StagedPipeline(
+            self.stage_workers, memory_budget, on_step=self.record_step
+        )
+
+    def iter_jobs(
+        self,
+        folders: list,
+        extension: str,
+        do_raw: bool,
+        do_recursive: bool,
+        pp3_for_folder,
+        build_settings: dict,
+        dry_run: bool = False,
+    ):
+        """Yield a BracketJob for every bracket in folders, as they are found.
+
+        Raises NoMatchingFilesError if there are none. See process_folder for
+        dry_run."""
+        # In RAW mode we look for the RAW files, TIFFs are developed per bracket
+        if do_raw:
+            discovery_extension = extension
+            if not discovery_extension.startswith("."):
+                discovery_extension = "." + discovery_extension
+            if discovery_extension == ".":
+                discovery_extension = ".dng"
+        else:
+            discovery_extension = extension
+
+        found = False
+        for proc_folder in iter_folders(folders, discovery_extension, do_recursive):
+            folder_pp3_file = pp3_for_folder(proc_folder) if pp3_for_folder else ""
+
+            folder_brackets = 0
+            for job in self.process_folder(
+                proc_folder,
+                discovery_extension,
+                do_raw,
+                folder_pp3_file,
+                build_settings,
+                dry_run,
+            ):
+                folder_brackets = len(job.img_list)
+                found = True
+                yield job
+            if folder_brackets:
+                self.processed_folders.append(proc_folder)
+                self.bracket_list.append(folder_brackets)
+
+        # Check if any valid folders were found
+        if not found:
+            print("No matching files found in the input folders.")
+            if do_raw:
+                raise NoMatchingFilesError(
+                    "No matching files",
+                    "No RAW files found in any of the batch folders!\n\n"
+                    "Please check that the folders contain RAW images with the pattern: '%s'"
+                    % discovery_extension,
+                )
+            raise NoMatchingFilesError(
+                "No matching files",
+                "No matching files found in any of the batch folders!\n\n"
+                "Please check that the folders contain images with the pattern: '%s'"
+                % extension,
+            )
+
+    def start(self, folders: list, do_raw: bool, do_align: bool):
+        """Check the settings and reset the totals before processing folders."""
+        check_settings(self.config, do_raw, do_align)
+        if not folders:
+            raise SettingsError(
+                "No input folders",
+                "Please add at least one input folder first.",
+            )
+        self.start_time = datetime.now()
+        print("Starting [%s]..." % self.start_time.strftime("%H:%M:%S"))
+
+        # Brackets are queued as soon as they are found, so the totals grow
+        # while the folders are still being scanned.
+        self.total_sets_global = 0
+        self.completed_sets_global = 0
+        self.failed_sets = []
+        self.processed_folders = []
+        self.bracket_list = []
+        self.manifests = {}
+        self.alignment_caches = {}
+        self.report = RunReport()
+
+    def finish(self):
+        """Stop the Blender workers and save the manifests."""
+        if self.blender_workers:
+            self.blender_workers.close()
+            self.blender_workers = None
+        for manifest in self.manifests.values():
+            manifest.flush()
+        for cache in self.alignment_caches.values():
+            cache.flush()
+
+    def write_report(self, do_align: bool, merge_backend: str):
+        """Save the run report to the logs folder of every output folder."""
+        try:
+            self.report.write(
+                {
+                    "merge_backend": merge_backend,
+                    "align": do_align,
+                    "stage_workers": self.stage_workers,
+                    "memory_budget_gb": self.config["gui_settings"]["memory_budget_gb"],
+                }
+            )
+        except OSError as ex:
+            print("Couldn't save the run report: %s" % ex)
+
+    def print_summary(self, do_align: bool, merge_backend: str):
+        print("Done!!!")
+        end_time = datetime.now()
+        duration = (end_time - self.start_time).total_seconds()
+        print("Total time: %.1f seconds (%.1f minutes)" % (duration, duration / 60))
+        print("Alignment: %s" % ("Yes" if do_align else "No"))
+        print("Merge backend: %s" % MERGE_BACKENDS[merge_backend])
+        print("Images per bracket: %s" % self.bracket_list)
+        print("Total sets processed: %d" % self.total_sets_global)
+        if self.failed_sets:
+            print("Failed sets: %d" % len(self.failed_sets))
+        print(
+            "Threads used: %s"
+            % ", ".join(
+                "%s %d" % (stage, int(workers))
+                for stage, workers in self.stage_workers.items()
+            )
+        )
+        table = self.report.summary_table()
+        if table:
+            print("\n" + table)
+
+    def get_merge_backend(self, merge_backend: str) -> str:
+        """The merge backend to actually use, which is always NumPy for proxies."""
+        proxy_scale = get_proxy_scale(self.config)
+        if proxy_scale == 1:
+            return merge_backend
+        print(
+            "Merging proxies at 1/%d of the resolution into Merged/proxy" % proxy_scale
+        )
+        return "numpy"
+
+    def run(
+        self,
+        folders: list,
+        extension: str,
+        do_align: bool = False,
+        do_raw: bool = False,
+        do_recursive: bool = False,
+        merge_backend: str = "blender",
+        threads: str = "6",
+        pp3_for_folder=None,
+    ) -> list:
+        """Merge all brackets in folders, printing progress and a summary.
+
+        In RAW mode extension is that of the RAW files, and pp3_for_folder returns
+        the PP3 profile to use for a folder. Use get_progress to follow the
+        progress from another thread.
+
+        Returns the keys of the brackets that failed. Raises a SettingsError if the
+        settings can't be used, or NoMatchingFilesError if nothing was found."""
+        self.start(folders, do_raw, do_align)
+        merge_backend = self.get_merge_backend(merge_backend)
+        merge_blend = SCRIPT_DIR / "blender" / "HDR_Merge.blend"
+        merge_py = SCRIPT_DIR / "blender" / "blender_merge.py"
+        build_settings = self.get_build_settings(merge_backend, do_align, do_raw)
+        if merge_backend == "blender_worker":
+            self.blender_workers = BlenderWorkerPool(
+                self.exe_paths["blender_exe"], merge_blend, merge_py
+            )
+
+        try:
+            # Leaving the block waits for every bracket that was queued
+            with self.get_pipeline(threads) as pipeline:
+                for job in self.iter_jobs(
+                    folders,
+                    extension,
+                    do_raw,
+                    do_recursive,
+                    pp3_for_folder,
+                    build_settings,
+                ):
+                    self.add_total()
+                    t = self.do_merge(
+                        pipeline,
+                        job,
+                        self.exe_paths["blender_exe"],
+                        merge_blend,
+                        merge_py,
+                        self.exe_paths["luminance_cli_exe"],
+                        self.exe_paths["align_image_stack_exe"],
+                        do_align,
+                        merge_backend,
+                    )
+                    t.add_done_callback(partial(self.report_failure, job.key))
+
+                print("Total sets to process: %d" % self.total_sets_global)
+        finally:
+            self.finish()
+            self.write_report(do_align, merge_backend)
+
+        self.print_summary(do_align, merge_backend)
+        return self.failed_sets
+
+    def coordinate(
+        self,
+        queue: FolderQueue,
+        folders: list,
+        extension: str,
+        do_align: bool = False,
+        do_raw: bool = False,
+        do_recursive: bool = False,
+        merge_backend: str = "blender",
+        pp3_for_folder=None,
+    ) -> list:
+        """Like run, but publish the brackets to queue for workers to merge.
+
+        Finding the brackets still happens here, while workers develop any RAW
+        files along with the rest of each bracket. Workers must see the folders
+        (and PP3 profiles) under the same paths, and report back through the queue so the
+        manifests can be updated. Returns the keys of the brackets that failed."""
+        self.start(folders, do_raw, do_align)
+        merge_backend = self.get_merge_backend(merge_backend)
+        build_settings = self.get_build_settings(merge_backend, do_align, do_raw)
+        settings = {
+            "merge_backend": merge_backend,
+            "do_align": do_align,
+            "gui_settings": {
+                key: self.config["gui_settings"][key] for key in JOB_SETTINGS
+            },
+        }
+
+        queue.reset()
+        published = {}  # Job ID -> BracketJob
+        for job in self.iter_jobs(
+            folders, extension, do_raw, do_recursive, pp3_for_folder, build_settings
+        ):
+            self.add_total()
+            if self.skip_if_up_to_date(job):
+                continue
+            job_id = "%06d" % len(published)
+            queue.put(job_id, {"job": job.to_dict(), "settings": settings})
+            published[job_id] = job
+        queue.close()
+        print(
+            "Total sets to process: %d, %d published to %s"
+            % (self.total_sets_global, len(published), queue.path)
+        )
+
+        seen = set()
+        try:
+            while len(seen) < len(published):
+                for job_id in queue.requeue_expired():
+                    print("Job %s: Lease expired, queued again" % job_id)
+                for job_id, data, succeeded in queue.finished_jobs(seen):
+                    job = published[job_id]
+                    if "claimed" in data:
+                        # Time from publishing to the last claim, on different
+                        # clocks, so only as accurate as they are in sync
+                        self.report.record_job(
+                            job,
+                            "queue",
+                            queue_wait=data["claimed"] - data["published"],
+                            worker=data["worker"],
+                        )
+                    if succeeded:
+                        self.report.add_rows(data["result"].get("timings", []))
+                        job.manifest.record(
+                            job.name, job.signature, [job.exr_path, job.jpg_path]
+                        )
+                        print(
+                            "Folder %s: Bracket %d: Complete (%s)"
+                            % (job.folder.name, job.index, data["worker"])
+                        )
+                        self.add_completed()
+                    else:
+                        print(
+                            "Folder %s: Bracket %d: Failed - %s"
+                            % (
+                                job.folder.name,
+                                job.index,
+                                "; ".join(data.get("errors", [])),
+                            )
+                        )
+                        self.add_failed(job.key)
+                sleep(1)
+        finally:
+            self.finish()
+            self.write_report(do_align, merge_backend)
+
+        self.print_summary(do_align, merge_backend)
+        return self.failed_sets
+
+    def work(self, queue: FolderQueue, threads: str = "6") -> int:
+        """Merge brackets from queue until the coordinator has published them all
+        and none are left. Returns the number of brackets that failed here."""
+        merge_blend = SCRIPT_DIR / "blender" / "HDR_Merge.blend"
+        merge_py = SCRIPT_DIR / "blender" / "blender_merge.py"
+        max_jobs = max(1, int(threads))
+        print("Worker %s: Waiting for jobs in %s" % (get_worker_id(), queue.path))
+
+        running = {}  # Lease -> (BracketJob, Future)
+        completed = failed = 0
+        self.report = RunReport()
+        last_heartbeat = time()
+        try:
+            with self.get_pipeline(threads) as pipeline:
+                while running or not queue.is_finished():
+                    # Claim enough jobs to keep the merge stage busy
+                    while len(running) < max_jobs:
+                        lease = queue.claim()
+                        if lease is None:
+                            break
+                        job = BracketJob.from_dict(lease.job["job"])
+                        settings = lease.job["settings"]
+                        job.config = dict(
+                            self.config,
+                            gui_settings=dict(
+                                self.config["gui_settings"],
+                                **settings.get("gui_settings", {}),
+                            ),
+                        )
+                        merge_backend = settings["merge_backend"]
+                        if (
+                            merge_backend == "blender_worker"
+                            and self.blender_workers is None
+                        ):
+                            self.blender_workers = BlenderWorkerPool(
+                                self.exe_paths["blender_exe"], merge_blend, merge_py
+                            )
+                        self.add_total()
+                        running[lease] = job, self.do_merge(
+                            pipeline,
+                            job,
+                            self.exe_paths["blender_exe"],
+                            merge_blend,
+                            merge_py,
+                            self.exe_paths["luminance_cli_exe"],
+                            self.exe_paths["align_image_stack_exe"],
+                            settings["do_align"],
+                            merge_backend,
+                        )
+
+                    for lease, (job, future) in list(running.items()):
+                        if not future.done():
+                            continue
+                        del running[lease]
+                        try:
+                            future.result()
+                        except Exception as ex:
+                            print("Job %s: Exception - %s" % (lease.job_id, ex))
+                            lease.fail(str(ex))
+                            failed += 1
+                        else:
+                            lease.complete(
+                                {
+                                    "worker": get_worker_id(),
+                                    # Sent back for the coordinator's run report
+                                    "timings": self.report.job_rows(job),
+                                }
+                            )
+                            completed += 1
+
+                    if time() - last_heartbeat > queue.heartbeat_interval:
+                        for lease in running:
+                            lease.heartbeat()
+                        last_heartbeat = time()
+                        # Also rescue the jobs of crashed workers if the
+                        # coordinator isn't running anymore
+                        queue.requeue_expired()
+                    sleep(1)
+        finally:
+            self.finish()
+
+        print(
+            "Worker %s: Done, %d brackets merged, %d failed"
+            % (get_worker_id(), completed, failed)
+        )
+        table = self.report.summary_table()
+        if table:
+            print("\n" + table)
+        return failed
@@ -1,11 +1,5 @@
 import sys
-import subprocess
-import json
 import pathlib
-import exifread
-from pathlib import Path
-from math import log
-from datetime import datetime
 from tkinter import (
     TOP,
     BOTH,
@@ -35,18 +29,29 @@ from tkinter import (
     StringVar,
     Toplevel,
 )
-from concurrent.futures import ThreadPoolExecutor
 import threading
-from time import sleep
+import traceback
+
+from hdr_batch import (
+    MERGE_BACKENDS,
+    SCRIPT_DIR,
+    HDRBatch,
+    SettingsError,
+    get_config,
+    get_profile_for_folder,
+    save_config,
+)
+from autotune import (
+    calibrate,
+    get_default_threads,
+    remember_threads,
+    set_machine_threads,
+)
 
 __version__ = "1.2.0"
 
-if getattr(sys, "frozen", False):
-    SCRIPT_DIR = pathlib.Path(sys.executable).parent  # Built with cx_freeze
-else:
-    SCRIPT_DIR = pathlib.Path(__file__).resolve().parent
-
-verbose = False
+# How often the progress bar is updated while merging (milliseconds)
+PROGRESS_INTERVAL = 250
 
 
 def center(win):
@@ -59,148 +64,12 @@ def center(win):
     win.geometry("{}x{}+{}+{}".format(width, height, x, y))
 
 
-def run_subprocess_with_prefix(
-    cmd: list, bracket_id: int, label: str, out_folder: pathlib.Path
-):
-    """Run a subprocess and save output to a timestamped log file."""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    log_filename = "bracket_%03d_%s_%s.log" % (bracket_id, label, timestamp)
-    log_path = out_folder / "logs" / log_filename
-    log_path.parent.mkdir(parents=True, exist_ok=True)
-
-    with open(log_path, "w") as log_file:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        log_file.write("STDOUT:\n")
-        log_file.write(result.stdout)
-        log_file.write("\nSTDERR:\n")
-        log_file.write(result.stderr)
-
-    if result.returncode != 0:
-        raise subprocess.CalledProcessError(result.returncode, cmd)
-
-
-def read_json(fp: pathlib.Path) -> dict:
-    with fp.open("r") as f:
-        s = f.read()
-        # Work around invalid JSON when people paste single backslashes in there.
-        s = s.replace("\\", "/")
-        try:
-            return json.loads(s)
-        except json.JSONDecodeError as ex:
-            raise RuntimeError("Error reading JSON from %s: %s" % (fp, ex))
-
-
-def get_default_config() -> dict:
-    """Get default configuration with OS-specific paths."""
-    if sys.platform.startswith("win"):
-        # Windows default paths
-        default_exe_paths = {
-            "align_image_stack_exe": "C:\\Program Files\\Hugin\\bin\\align_image_stack.exe",
-            "blender_exe": "C:\\Program Files\\Blender Foundation\\Blender 3.4\\blender.exe",
-            "luminance_cli_exe": "C:\\Program Files\\Luminance HDR\\v.2.6.0\\luminance-hdr-cli.exe",
-            "rawtherapee_cli_exe": "C:\\Program Files\\RawTherapee\\5.12\\rawtherapee-cli.exe",
-        }
-    else:
-        # Linux default paths
-        default_exe_paths = {
-            "align_image_stack_exe": "/usr/bin/align_image_stack",
-            "blender_exe": "/usr/bin/blender",
-            "luminance_cli_exe": "/usr/bin/luminance-hdr-cli",
-            "rawtherapee_cli_exe": "/usr/bin/rawtherapee-cli",
-        }
-
-    return {
-        "exe_paths": default_exe_paths,
-        "gui_settings": {
-            "raw_extension": ".dng",
-            "tif_extension": ".tif",
-            "threads": "6",
-            "do_align": False,
-            "do_recursive": False,
-            "do_raw": False,
-            "pp3_file": "",
-        },
-        "pp3_profiles": [],
-    }
-
-
-def get_config() -> dict:
-    """Load configuration from config.json, creating it if it doesn't exist."""
-    global SCRIPT_DIR
-    cf = SCRIPT_DIR / "config.json"
-
-    default_config = get_default_config()
-    config = {}
-    error = ""
-    missing_json_error = (
-        "You need to configure some paths first. Edit the '%s' file and fill in the paths."
-        % cf
-    )
-
-    # Required exe paths (must exist)
-    required_exes = ["blender_exe", "luminance_cli_exe"]
-    # Optional exe paths (can be missing, features will be disabled)
-    optional_exes = ["align_image_stack_exe", "rawtherapee_cli_exe"]
-
-    if not cf.exists() or cf.stat().st_size == 0:
-        with cf.open("w") as f:
-            json.dump(default_config, f, indent=4, sort_keys=True)
-        error = missing_json_error + " (file does not exist or is empty)"
-    else:
-        config = read_json(cf)
-        # Merge with defaults to ensure all keys exist
-        for key, value in default_config.items():
-            if key not in config:
-                config[key] = value
-            elif isinstance(value, dict):
-                for sub_key, sub_value in value.items():
-                    if sub_key not in config[key]:
-                        config[key][sub_key] = sub_value
-
-        # Validate required exe_paths
-        exe_paths = config.get("exe_paths", {})
-        for key in required_exes:
-            path = exe_paths.get(key, "")
-            if not path:
-                error = missing_json_error + " (%s is empty)" % key
-                break
-            if not pathlib.Path(path).exists():
-                error = (
-                    '"%s" in config.json either doesn\'t exist or is an invalid path.'
-                    % path
-                )
-
-        # Check optional exe_paths and mark as unavailable if missing
-        config["_optional_exes_available"] = {}
-        for key in optional_exes:
-            path = exe_paths.get(key, "")
-            if path and pathlib.Path(path).exists():
-                config["_optional_exes_available"][key] = True
-            else:
-                config["_optional_exes_available"][key] = False
-                print(
-                    "Warning: %s is not available (%s). Related features will be disabled."
-                    % (key, path + " not found" if path else "path not configured")
-                )
-
-    if error:
-        print(error)
-        input("Press enter to exit.")
-        sys.exit(0)
-
-    return config
-
-
-def save_config(config: dict):
-    """Save configuration to config.json."""
-    global SCRIPT_DIR
-    cf = SCRIPT_DIR / "config.json"
-    with cf.open("w") as f:
-        json.dump(config, f, indent=4, sort_keys=True)
-
-
-CONFIG = get_config()
-EXE_PATHS = CONFIG.get("exe_paths", {})
+try:
+    CONFIG = get_config()
+except RuntimeError as ex:
+    print(ex)
+    input("Press enter to exit.")
+    sys.exit(0)
 
 
 def play_sound(sf: str):
@@ -253,53 +122,6 @@ def notify_phone(msg="Done"):
         raise RuntimeError("Failed to send system notification") from ex
 
 
-def chunks(l, n):
-    if n < 1:
-        n = 1
-    return [l[i : i + n] for i in range(0, len(l), n)]
-
-
-def get_exif(filepath: pathlib.Path):
-    with filepath.open("rb") as f:
-        tags = exifread.process_file(f)
-
-    # Try different possible EXIF tag names for image dimensions
-    try:
-        width = str(tags["Image ImageWidth"])
-        height = str(tags["Image ImageLength"])
-    except KeyError:
-        try:
-            width = str(tags["EXIF ExifImageWidth"])
-            height = str(tags["EXIF ExifImageLength"])
-        except KeyError:
-            raise RuntimeError("Could not find image dimensions in EXIF data")
-
-    resolution = width + "x" + height
-    shutter_speed = eval(str(tags["EXIF ExposureTime"]))
-    try:
-        aperture = eval(str(tags["EXIF FNumber"]))
-    except ZeroDivisionError:
-        aperture = 0
-    iso = int(str(tags["EXIF ISOSpeedRatings"]))
-    return {
-        "resolution": resolution,
-        "shutter_speed": shutter_speed,
-        "aperture": aperture,
-        "iso": iso,
-    }
-
-
-def ev_diff(bright_image, dark_image):
-    dr_shutter = log(bright_image["shutter_speed"] / dark_image["shutter_speed"], 2)
-    try:
-        dr_aperture = log(dark_image["aperture"] / bright_image["aperture"], 1.41421)
-    except (ValueError, ZeroDivisionError):
-        # No lens data means aperture is 0, and we can't divide by 0 :)
-        dr_aperture = 0
-    dr_iso = log(bright_image["iso"] / dark_image["iso"], 2)
-    return dr_shutter + dr_aperture + dr_iso
-
-
 class EditProfileDialog(Toplevel):
     """Dialog window for editing a single PP3 profile."""
 
@@ -594,8 +416,8 @@ class HDRMergeMaster(Frame):
     def __init__(self, master=None):
         Frame.__init__(self, master)
         self.master = master
-        self.total_sets_global = 0
-        self.completed_sets_global = 0
+        self.batch = None  # The HDRBatch that is running, if any
+        self.running = False
         self.batch_folders = []
         self.folder_profiles = {}  # Maps folder path to profile name
         self._selected_folder = None  # Track currently selected folder
@@ -607,7 +429,7 @@ class HDRMergeMaster(Frame):
 
     def initUI(self):
         self.master.title("HDR Merge Master " + __version__)
-        self.master.geometry("600x225")
+        self.master.geometry("760x245")
         self.pack(fill=BOTH, expand=True)
 
         padding = 8
@@ -727,10 +549,13 @@ class HDRMergeMaster(Frame):
         lbl_threads.pack(side=LEFT, padx=(padding, 0))
         self.num_threads = Spinbox(r2, from_=1, to=9999999, width=2)
         self.num_threads.delete(0, "end")
-        self.num_threads.insert(0, self.saved_settings.get("threads", "6"))
+        self.num_threads.insert(0, get_default_threads(CONFIG))
         self.num_threads.bind("<Return>", self.save_threads)
         self.num_threads.pack(side=LEFT, padx=(padding / 3, 0))
         self.buttons_to_disable.append(self.num_threads)
+        self.btn_tune = Button(r2, text="Auto", command=self.auto_tune)
+        self.btn_tune.pack(side=LEFT, padx=(padding / 3, 0))
+        self.buttons_to_disable.append(self.btn_tune)
 
         self.do_raw = BooleanVar()
         self.do_raw.set(self.saved_settings.get("do_raw", False))
@@ -746,10 +571,11 @@ class HDRMergeMaster(Frame):
         self.raw.pack(side=LEFT)
         self.buttons_to_disable.append(self.raw)
 
-        # Disable RAW checkbox if RawTherapee CLI is not available
-        if not CONFIG.get("_optional_exes_available", {}).get(
-            "rawtherapee_cli_exe", False
-        ):
+        # Disable RAW checkbox if RawTherapee CLI is not available, unless RAW
+        # files are decoded with rawpy instead
+        if CONFIG["gui_settings"]["raw_backend"] != "rawpy" and not CONFIG.get(
+            "_optional_exes_available", {}
+        ).get("rawtherapee_cli_exe", False):
             self.raw.config(state="disabled")
             self.do_raw.set(False)
 
@@ -765,10 +591,11 @@ class HDRMergeMaster(Frame):
         self.align.pack(side=LEFT)
         self.buttons_to_disable.append(self.align)
 
-        # Disable Align checkbox if align_image_stack is not available
-        if not CONFIG.get("_optional_exes_available", {}).get(
-            "align_image_stack_exe", False
-        ):
+        # Disable Align checkbox if align_image_stack is not available, unless
+        # images are aligned with OpenCV instead
+        if CONFIG["gui_settings"]["align_backend"] != "opencv" and not CONFIG.get(
+            "_optional_exes_available", {}
+        ).get("align_image_stack_exe", False):
             self.align.config(state="disabled")
             self.do_align.set(False)
 
@@ -782,6 +609,25 @@ class HDRMergeMaster(Frame):
         self.recursive.pack(side=LEFT)
         self.buttons_to_disable.append(self.recursive)
 
+        lbl_backend = Label(r2, text="Merge:")
+        lbl_backend.pack(side=LEFT, padx=(padding, 0))
+        self.merge_backend = StringVar()
+        self.merge_backend.set(
+            MERGE_BACKENDS.get(
+                self.saved_settings.get("merge_backend", "blender"),
+                MERGE_BACKENDS["blender"],
+            )
+        )
+        self.backend_dropdown = ttk.Combobox(
+            r2,
+            textvariable=self.merge_backend,
+            values=list(MERGE_BACKENDS.values()),
+            state="readonly",
+            width=16,
+        )
+        self.backend_dropdown.pack(side=LEFT, padx=(padding / 3, 0))
+        self.buttons_to_disable.append(self.backend_dropdown)
+
         self.btn_execute = Button(r2, text="Create HDRs", command=self.execute)
         self.btn_execute.pack(side=RIGHT, fill=X, expand=True, padx=padding)
         self.buttons_to_disable.append(self.btn_execute)
@@ -792,7 +638,10 @@ class HDRMergeMaster(Frame):
         self.progress = ttk.Progressbar(
             r3, orient=HORIZONTAL, length=100, mode="determinate"
         )
-        self.progress.pack(fill=X, padx=padding, pady=(0, padding))
+        self.progress.pack(fill=X, padx=padding, pady=(0, padding / 2))
+
+        self.status_label = Label(r3, text="", anchor="w", fg="gray")
+        self.status_label.pack(fill=X, padx=padding, pady=(0, padding))
 
         r3.pack(fill=X, pady=(padding, 0))
 
@@ -895,39 +744,24 @@ class HDRMergeMaster(Frame):
             CONFIG["gui_settings"]["tif_extension"] = extension
         save_config(CONFIG)
 
+    def get_merge_backend(self):
+        """Get the config key of the merge backend selected in the dropdown."""
+        selected = self.merge_backend.get()
+        for key, name in MERGE_BACKENDS.items():
+            if name == selected:
+                return key
+        return "blender"
+
     def save_threads(self, event=None):
         """Save the current thread count to config."""
-        CONFIG["gui_settings"]["threads"] = self.num_threads.get()
+        remember_threads(CONFIG, self.num_threads.get())
         save_config(CONFIG)
 
     def get_profile_for_folder(self, folder_path):
         """Get the PP3 profile for a folder, auto-matching by folder key or using default."""
-        profiles = CONFIG.get("pp3_profiles", [])
-        if not profiles:
-            return None
-
-        folder_name = pathlib.Path(folder_path).name.lower()
-
-        # First check if folder has a manually assigned profile
-        if folder_path in self.folder_profiles:
-            profile_name = self.folder_profiles[folder_path]
-            for profile in profiles:
-                if profile.get("name") == profile_name:
-                    return profile
-
-        # Then try to auto-match by folder key
-        for profile in profiles:
-            folder_key = profile.get("folder_key", "").lower()
-            if folder_key and folder_key in folder_name:
-                return profile
-
-        # Fall back to default profile
-        for profile in profiles:
-            if profile.get("default", False):
-                return profile
-
-        # If no default, return first profile
-        return profiles[0] if profiles else None
+        return get_profile_for_folder(
+            CONFIG.get("pp3_profiles", []), folder_path, self.folder_profiles
+        )
 
     def update_profile_dropdown(self, folder_path=None):
         """Update the profile dropdown with available profiles and current selection."""
@@ -981,629 +815,157 @@ class HDRMergeMaster(Frame):
         if self._selected_folder:
             self.update_profile_dropdown(self._selected_folder)
 
-    def process_raw_with_rawtherapee(
-        self,
-        rawtherapee_cli_exe: str,
-        pp3_file: str,
-        folder: pathlib.Path,
-        extension: str,
-    ) -> pathlib.Path:
-        """Process RAW files in folder using RawTherapee CLI and output TIFFs to a 'tif' subfolder."""
-        print("\nFolder %s: Processing RAW files with RawTherapee..." % folder.name)
-
-        # Determine RAW file extension (default to .dng)
-        raw_extension = extension if extension.startswith(".") else "." + extension
-        if not raw_extension:
-            raw_extension = ".dng"
-
-        # Find all RAW files in the folder
-        glob_pattern = "*%s" % raw_extension
-        raw_files = list(folder.glob(glob_pattern))
-
-        if not raw_files:
-            print(
-                "Folder %s: No RAW files found with pattern '%s'"
-                % (folder.name, glob_pattern)
-            )
-            return None
-
-        # Create output folder for TIFFs
-        tif_folder = folder / "tif"
-        tif_folder.mkdir(parents=True, exist_ok=True)
-
-        # Build RawTherapee CLI command
-        # Usage: rawtherapee-cli -c -p profile.pp3 -o output_dir -t -Y input_files
-        # -t = TIFF output (16-bit by default)
-        # -Y = Overwrite existing files
-        # -p = PP3 profile
-        # -o = Output directory
-        # -c = Process files (must be last before files)
-        cmd = [
-            rawtherapee_cli_exe,
-            "-p",
-            pp3_file,  # Apply PP3 profile
-            "-o",
-            str(tif_folder),  # Output directory
-            "-t",  # TIFF output (16-bit uncompressed)
-            #"-Y",  # Overwrite existing files
-            "-c",  # Convert mode (must be last before input files)
-        ]
-
-        # Add all RAW files to process
-        for raw_file in raw_files:
-            cmd.append(str(raw_file))
-
-        print(
-            "Folder %s: Running RawTherapee CLI on %d RAW files..."
-            % (folder.name, len(raw_files))
-        )
-        if verbose:
-            print("Folder %s: Command: %s" % (folder.name, " ".join(cmd)))
+    def get_pp3_file(self, folder: pathlib.Path) -> str:
+        """The path of the PP3 profile to use for a folder, or "" if there is none."""
+        profile = self.get_profile_for_folder(str(folder))
+        return profile.get("path", "") if profile else ""
+
+    def show_progress(self):
+        """Update the progress bar and status line from the running batch.
+
+        Runs on the Tk main loop, rescheduling itself until the batch finishes."""
+        batch = self.batch
+        if batch is not None:
+            completed, failed, total = batch.get_progress()
+            if total:
+                self.progress["value"] = int((completed + failed) / total * 100)
+            self.status_label["text"] = batch.status_text()
+        if self.running:
+            self.after(PROGRESS_INTERVAL, self.show_progress)
+        else:
+            self.status_label["text"] = ""
 
-        # Run RawTherapee CLI
-        try:
-            run_subprocess_with_prefix(cmd, 0, "rawtherapee", out_folder=tif_folder)
-        except Exception as ex:
-            print("Folder %s: Failed to process RAW files: %s" % (folder.name, ex))
-            raise
+    def enable_buttons(self, text: str = "Create HDRs"):
+        for btn in self.buttons_to_disable:
+            btn["state"] = "normal"
+        self.btn_execute["text"] = text
 
-        print(
-            "Folder %s: RawTherapee processing complete. TIFFs saved to: %s"
-            % (folder.name, tif_folder)
-        )
-        return tif_folder
-
-    def do_merge(
-        self,
-        blender_exe: str,
-        merge_blend: pathlib.Path,
-        merge_py: pathlib.Path,
-        exifs,
-        out_folder: pathlib.Path,
-        filter_used,
-        i,
-        img_list,
-        folder: pathlib.Path,
-        luminance_cli_exe,
-        align_image_stack_exe,
-    ):
-
-        exr_folder = out_folder / "exr"
-        jpg_folder = out_folder / "jpg"
-        align_folder = out_folder / "aligned"
-
-        exr_folder.mkdir(parents=True, exist_ok=True)
-        jpg_folder.mkdir(parents=True, exist_ok=True)
-
-        exr_path = exr_folder / ("merged_%03d.exr" % i)
-        jpg_path = jpg_folder / exr_path.with_suffix(".jpg").name
-
-        if exr_path.exists():
-            print(
-                "Folder %s: Bracket %d: Skipping, %s exists"
-                % (folder.name, i, exr_path.relative_to(folder))
-            )
-            self.completed_sets_global += 1
-            print(
-                "Completed sets: %d/%d, %.1f%%"
-                % (
-                    self.completed_sets_global,
-                    self.total_sets_global,
-                    (self.completed_sets_global / self.total_sets_global) * 100,
-                )
-            )
-            return
+    def show_error(self, title: str, message: str):
+        """Show an error from a run and let the user start another one."""
+        messagebox.showerror(title, message)
+        self.enable_buttons()
 
-        if self.do_align.get():
-            if verbose:
-                print(
-                    "Folder %s: Bracket %d: Aligning images %s"
-                    % (folder.name, i, [Path(p.split("___")[0]).name for p in img_list])
-                )
-            else:
-                print("Folder %s: Bracket %d: Aligning images" % (folder.name, i))
-
-            align_folder.mkdir(parents=True, exist_ok=True)
-            actual_img_list = [i.split("___")[0] for i in img_list]
-            cmd = [
-                align_image_stack_exe,
-                "-v",
-                "-i",
-                "-l",
-                "-a",
-                (align_folder / "align_{}_".format(i)).as_posix(),
-                "--gpu",
-            ]
-            cmd += actual_img_list
-            new_img_list = []
-            for j, img in enumerate(img_list):
-                new_img_list.append(
-                    (
-                        align_folder
-                        / "align_{}_{}.tif___{}".format(
-                            i, str(j).zfill(4), img_list[j].split("___")[-1]
-                        )
-                    ).as_posix()
-                )
-            run_subprocess_with_prefix(cmd, i, "align", out_folder)
-            img_list = new_img_list
-
-        if verbose:
-            print(
-                "Folder %s: Bracket %d: Merging %s"
-                % (folder.name, i, [Path(p.split("___")[0]).name for p in img_list])
-            )
-        else:
-            print("Folder %s: Bracket %d: Merging" % (folder.name, i))
-
-        cmd = [
-            blender_exe,
-            "--background",
-            merge_blend.as_posix(),
-            "--factory-startup",
-            "--python",
-            merge_py.as_posix(),
-            "--",
-            exifs[0]["resolution"],
-            exr_path.as_posix(),
-            filter_used,
-            str(i),  # Bracket ID
-        ]
-        cmd += img_list
-        run_subprocess_with_prefix(cmd, i, "blender", out_folder)
-
-        # Delete .blend1 backup file created by Blender
-        blend1_path = exr_path.with_name("bracket_%03d_sample.blend1" % i)
-        if blend1_path.exists():
-            blend1_path.unlink()
-
-        cmd = [
-            luminance_cli_exe,
-            "-l",
-            exr_path.as_posix(),
-            "--tmo",
-            "reinhard02",
-            "-q",
-            "98",
-            "-o",
-            jpg_path.as_posix(),
-        ]
-        run_subprocess_with_prefix(cmd, i, "luminance", out_folder)
-        if verbose:
-            print(
-                "Folder %s: Bracket %d: Complete %s"
-                % (folder.name, i, [Path(p.split("___")[0]).name for p in img_list])
-            )
-        else:
-            print("Folder %s: Bracket %d: Complete" % (folder.name, i))
-        self.completed_sets_global += 1
-        print(
-            "Completed sets: %d/%d, %.1f%%"
-            % (
-                self.completed_sets_global,
-                self.total_sets_global,
-                (self.completed_sets_global / self.total_sets_global) * 100,
-            )
-        )
-
-    def process_folder(
-        self,
-        folder: pathlib.Path,
-        blender_exe: str,
-        luminance_cli_exe: str,
-        align_image_stack_exe: str,
-        merge_blend: pathlib.Path,
-        merge_py: pathlib.Path,
-        original_extension: str,
-        do_align: bool,
-        do_raw: bool,
-        rawtherapee_cli_exe: str,
-        pp3_file: str,
-        executor: ThreadPoolExecutor,
-    ) -> tuple:
-        """Process a single folder and return (num_brackets, num_sets, threads, error)."""
-        out_folder = folder / "Merged"
-
-        # If RAW processing is enabled, process RAW files first
-        if do_raw and pp3_file and pathlib.Path(pp3_file).exists():
-            tif_folder = self.process_raw_with_rawtherapee(
-                rawtherapee_cli_exe, pp3_file, folder, original_extension
+    def execute(self):
+        global CONFIG
+        extension = self.extension.get()
+        do_align = self.do_align.get()
+        do_raw = self.do_raw.get()
+        do_recursive = self.do_recursive.get()
+        merge_backend = self.get_merge_backend()
+        threads = self.num_threads.get()
+
+        # Save GUI settings to config - update the appropriate extension
+        # Update the extension settings based on current RAW state
+        if do_raw:
+            CONFIG["gui_settings"]["raw_extension"] = extension
+            CONFIG["gui_settings"]["tif_extension"] = self.saved_settings.get(
+                "tif_extension", ".tif"
             )
-            if tif_folder:
-                # Use the tif folder for subsequent processing
-                folder = tif_folder
-                # After RAW processing, we look for .tif files
-                extension = ".tif"
-            else:
-                return (0, 0, [], "RAW processing failed")
         else:
-            extension = original_extension
-
-        glob = extension
-        if "*" not in glob:
-            glob = "*%s" % glob
-        files = list(folder.glob(glob))
-
-        if not files:
-            return (0, 0, [], "No matching files found")
-
-        # Analyze EXIF to determine number of brackets
-        exifs = []
-        for f in files:
-            e = get_exif(f)
-            if e in exifs:
-                break
-            exifs.append(e)
-        brackets = len(exifs)
-        print("\nFolder: %s" % folder)
-        print("Brackets:", brackets)
-        sets = chunks(files, brackets)
-        print("Sets:", len(sets), "\n")
-        # print("Exifs:", json.dumps(exifs, indent=2))
-        if verbose:
-            print("Exifs:\n", str(exifs).replace("}, {", "},\n{"))
-        evs = [
-            ev_diff(
-                {"shutter_speed": 1000000000, "aperture": 0.1, "iso": 1000000000000}, e
+            CONFIG["gui_settings"]["raw_extension"] = self.saved_settings.get(
+                "raw_extension", ".dng"
             )
-            for e in exifs
-        ]
-        evs = [ev - min(evs) for ev in evs]
-
-        filter_used = "None"  # self.filter.get().replace(' ', '').replace('+', '_')  # Depreciated
-
-        # Submit merging tasks to the shared executor
-        threads = []
-        for i, s in enumerate(sets):
-            img_list = []
-            for ii, img in enumerate(s):
-                img_list.append(img.as_posix() + "___" + str(evs[ii]))
-
-            t = executor.submit(
-                self.do_merge,
-                blender_exe,
-                merge_blend,
-                merge_py,
-                exifs,
-                out_folder,
-                filter_used,
-                i,
-                img_list,
-                folder,
-                luminance_cli_exe,
-                align_image_stack_exe,
-            )
-            threads.append((i, t))
-
-        return (brackets, len(sets), threads, None)
-
-    def execute(self):
-        def real_execute():
-            folder_start_time = datetime.now()
-            folder = None
-
-            global CONFIG
-            global EXE_PATHS
-            global SCRIPT_DIR
-            blender_exe = EXE_PATHS["blender_exe"]
-            luminance_cli_exe = EXE_PATHS["luminance_cli_exe"]
-            align_image_stack_exe = EXE_PATHS["align_image_stack_exe"]
-            rawtherapee_cli_exe = EXE_PATHS["rawtherapee_cli_exe"]
-            merge_blend = SCRIPT_DIR / "blender" / "HDR_Merge.blend"
-            merge_py = SCRIPT_DIR / "blender" / "blender_merge.py"
-            extension = self.extension.get()
-            do_align = self.do_align.get()
-            do_raw = self.do_raw.get()
-
-            # Save GUI settings to config - update the appropriate extension
-            # Update the extension settings based on current RAW state
-            if do_raw:
-                CONFIG["gui_settings"]["raw_extension"] = extension
-                CONFIG["gui_settings"]["tif_extension"] = self.saved_settings.get(
-                    "tif_extension", ".tif"
-                )
-            else:
-                CONFIG["gui_settings"]["raw_extension"] = self.saved_settings.get(
-                    "raw_extension", ".dng"
-                )
-                CONFIG["gui_settings"]["tif_extension"] = extension
+            CONFIG["gui_settings"]["tif_extension"] = extension
 
-            CONFIG["gui_settings"]["threads"] = self.num_threads.get()
-            CONFIG["gui_settings"]["do_align"] = do_align
-            CONFIG["gui_settings"]["do_recursive"] = self.do_recursive.get()
-            CONFIG["gui_settings"]["do_raw"] = do_raw
+        remember_threads(CONFIG, threads)
+        CONFIG["gui_settings"]["do_align"] = do_align
+        CONFIG["gui_settings"]["do_recursive"] = do_recursive
+        CONFIG["gui_settings"]["do_raw"] = do_raw
+        CONFIG["gui_settings"]["merge_backend"] = merge_backend
 
-            save_config(CONFIG)
+        save_config(CONFIG)
 
-            original_extension = (
-                extension  # Keep track of original extension for RAW processing
-            )
+        self.btn_execute["text"] = "Busy..."
+        self.progress["value"] = 0
 
-            # Validate optional features
-            optional_exes_available = CONFIG.get("_optional_exes_available", {})
+        for btn in self.buttons_to_disable:
+            btn["state"] = "disabled"
 
-            if do_raw and not optional_exes_available.get("rawtherapee_cli_exe", False):
-                messagebox.showerror(
-                    "RawTherapee Not Available",
-                    "RAW processing is enabled but RawTherapee CLI is not configured or not found!\n\n"
-                    "Please configure the RawTherapee CLI path in config.json.",
-                )
-                for btn in self.buttons_to_disable:
-                    btn["state"] = "normal"
-                self.btn_execute["text"] = "Create HDRs"
-                return
+        def finish():
+            self.enable_buttons("Done!")
+            self.btn_execute["command"] = self.quit
 
-            # Validate RAW processing settings if enabled
-            if do_raw:
-                # Check if we have any profiles configured
-                profiles = CONFIG.get("pp3_profiles", [])
-                if not profiles:
-                    messagebox.showerror(
-                        "PP3 Profile Required",
-                        "RAW processing is enabled but no PP3 profiles are configured!\n\n"
-                        "Please add at least one PP3 profile using 'Manage Profiles...'.",
-                    )
-                    for btn in self.buttons_to_disable:
-                        btn["state"] = "normal"
-                    self.btn_execute["text"] = "Create HDRs"
-                    return
-                # Change extension to .tif for RAW processing (output from RawTherapee)
-                extension = ".tif"
-
-            # Validate Align feature if enabled
-            if do_align and not optional_exes_available.get(
-                "align_image_stack_exe", False
-            ):
-                messagebox.showerror(
-                    "Align Image Stack Not Available",
-                    "Align is enabled but align_image_stack is not configured or not found!\n\n"
-                    "Please configure the align_image_stack path in config.json.",
+        # Runs in a separate thread to keep the UI alive, so it leaves all UI
+        # updates to the Tk main loop
+        def real_execute():
+            try:
+                self.batch.run(
+                    self.batch_folders,
+                    extension,
+                    do_align,
+                    do_raw,
+                    do_recursive,
+                    merge_backend,
+                    threads,
+                    pp3_for_folder=self.get_pp3_file,
                 )
-                for btn in self.buttons_to_disable:
-                    btn["state"] = "normal"
-                self.btn_execute["text"] = "Create HDRs"
+            except SettingsError as ex:  # Also raised when no files were found
+                self.after(0, self.show_error, ex.title, str(ex))
                 return
-
-            # Determine folders to process
-            folders_to_process = []
-            do_recursive = self.do_recursive.get()
-
-            if self.batch_folders:
-                # Process all folders in batch list
-                for batch_folder_path in self.batch_folders:
-                    batch_folder = pathlib.Path(batch_folder_path)
-                    if not batch_folder.exists():
-                        print(
-                            "Warning: Batch folder does not exist: %s"
-                            % batch_folder_path
-                        )
-                        continue
-                    if do_recursive:
-                        # Find all subfolders containing matching files
-                        glob = extension
-                        if "*" not in glob:
-                            glob = "*%s" % glob
-                        for f in batch_folder.rglob(glob):
-                            parent = f.parent
-                            if (
-                                parent not in folders_to_process
-                                and parent != batch_folder
-                            ):
-                                folders_to_process.append(parent)
-                        print(
-                            "Batch folder '%s' (recursive): Found %d subfolders"
-                            % (
-                                batch_folder_path,
-                                len(
-                                    [
-                                        p
-                                        for p in folders_to_process
-                                        if str(p).startswith(str(batch_folder))
-                                    ]
-                                ),
-                            )
-                        )
-                    else:
-                        folders_to_process.append(batch_folder)
-                print("Batch mode: Processing %d folders" % len(folders_to_process))
-                for f in folders_to_process:
-                    print("  - %s" % f)
-            else:
-                folder = pathlib.Path(self.input_folder.get())
-                if not folder.exists():
-                    messagebox.showerror(
-                        "Folder does not exist",
-                        "The input path you have selected does not exist!",
-                    )
-                    return
-
-                # Determine folders to process
-                if do_recursive:
-                    # Find all subfolders containing matching files
-                    glob = extension
-                    if "*" not in glob:
-                        glob = "*%s" % glob
-                    for f in folder.rglob(glob):
-                        parent = f.parent
-                        if parent not in folders_to_process and parent != folder:
-                            folders_to_process.append(parent)
-                    print(
-                        "Recursive mode: Found %d subfolders" % len(folders_to_process)
-                    )
-                    print(
-                        "Subfolders to process: %s"
-                        % [
-                            str(subfolder.relative_to(folder))
-                            for subfolder in folders_to_process
-                        ]
-                    )
-                else:
-                    folders_to_process.append(folder)
-
-            print("Starting [%s]..." % folder_start_time.strftime("%H:%M:%S"))
-            self.btn_execute["text"] = "Busy..."
-            self.progress["value"] = 0
-
-            for btn in self.buttons_to_disable:
-                btn["state"] = "disabled"
-
-            # First pass: calculate total sets across all folders for progress tracking
-            total_sets_global = 0
-            folder_info = []
-
-            # Determine the file extension to look for in the first pass
-            if do_raw:
-                # For RAW processing, look for RAW files in the original folders
-                raw_extension = self.extension.get()
-                if not raw_extension.startswith("."):
-                    raw_extension = "." + raw_extension
-                if not raw_extension or raw_extension == ".":
-                    raw_extension = ".dng"
-                first_pass_extension = raw_extension
-            else:
-                first_pass_extension = extension
-
-            for proc_folder in folders_to_process:
-                glob = first_pass_extension
-                if "*" not in glob:
-                    glob = "*%s" % glob
-                files = list(proc_folder.glob(glob))
-                if files:
-                    exifs = []
-                    for f in files:
-                        e = get_exif(f)
-                        if e in exifs:
-                            break
-                        exifs.append(e)
-                    brackets = len(exifs)
-                    if brackets > 0:
-                        sets = len(files) // brackets
-                        total_sets_global += sets
-                        folder_info.append((proc_folder, brackets, sets))
-
-            # Check if any valid folders were found
-            if not folder_info:
-                print("No matching files found in the input folder.")
-                if self.batch_folders:
-                    if do_raw:
-                        messagebox.showerror(
-                            "No matching files",
-                            "No RAW files found in any of the batch folders!\n\n"
-                            "Please check that the folders contain RAW images with the pattern: '%s'"
-                            % first_pass_extension,
-                        )
-                    else:
-                        messagebox.showerror(
-                            "No matching files",
-                            "No matching files found in any of the batch folders!\n\n"
-                            "Please check that the folders contain images with the pattern: '%s'"
-                            % extension,
-                        )
-                else:
-                    if do_raw:
-                        messagebox.showerror(
-                            "No matching files",
-                            "No RAW files found in the input folder!\n\n"
-                            "Please check that the folder contains RAW images with the pattern: '%s'"
-                            % first_pass_extension,
-                        )
-                    else:
-                        messagebox.showerror(
-                            "No matching files",
-                            "No matching files found in the input folder!\n\n"
-                            "Please check that the folder contains images with the pattern: '%s'"
-                            % extension,
-                        )
-                for btn in self.buttons_to_disable:
-                    btn["state"] = "normal"
-                self.btn_execute["text"] = "Create HDRs"
+            except Exception as ex:
+                traceback.print_exc()
+                self.after(0, self.show_error, "Merging Failed", str(ex))
                 return
+            finally:
+                self.running = False
 
-            self.total_sets_global = total_sets_global
-            print("Total sets to process: %d" % total_sets_global)
-            self.completed_sets_global = 0
-
-            # Second pass: process all folders concurrently with shared executor
-            bracket_list = []
-            total_sets = 0
-            all_threads = []
-
-            with ThreadPoolExecutor(
-                max_workers=int(self.num_threads.get())
-            ) as executor:
-                # Submit all folder tasks
-                for proc_folder, brackets, sets in folder_info:
-                    # Get folder-specific PP3 profile
-                    profile = self.get_profile_for_folder(str(proc_folder))
-                    folder_pp3_file = profile.get("path", "") if profile else ""
-
-                    brackets, sets, threads, error = self.process_folder(
-                        proc_folder,
-                        blender_exe,
-                        luminance_cli_exe,
-                        align_image_stack_exe,
-                        merge_blend,
-                        merge_py,
-                        original_extension,
-                        do_align,
-                        do_raw,
-                        rawtherapee_cli_exe,
-                        folder_pp3_file,
-                        executor,
-                    )
-                    bracket_list.append(brackets)
-                    total_sets += sets
-                    all_threads.extend(threads)
-                    if error:
-                        print("Error processing %s: %s" % (proc_folder, error))
-
-                # Wait for all tasks to complete and update progress
-                completed = set()
-                while any(not t[1].done() for t in all_threads):
-                    sleep(1)
-                    self.update()
-
-                    for bracket_idx, tt in all_threads:
-                        if not tt.done():
-                            continue
-                        if bracket_idx in completed:
-                            continue
-                        try:
-                            tt.result()
-                        except Exception as ex:
-                            print("Bracket %d: Exception - %s" % (bracket_idx, ex))
-
-                        completed.add(bracket_idx)
-                        # self.completed_sets_global += 1
-                        # print("Completed sets: %d/%d, %.1f%%" % (self.completed_sets_global, self.total_sets_global, (self.completed_sets_global / self.total_sets_global) * 100))
-
-                    # Update global progress
-                    progress = (
-                        self.completed_sets_global / self.total_sets_global
-                    ) * 100
-                    self.progress["value"] = int(progress)
-
-            print("Done!!!")
-            folder_end_time = datetime.now()
-            folder_duration = (folder_end_time - folder_start_time).total_seconds()
-            print(
-                "Total time: %.1f seconds (%.1f minutes)"
-                % (folder_duration, folder_duration / 60)
-            )
-            print("Alignment: %s" % ("Yes" if do_align else "No"))
-            print("Images per bracket: %s" % bracket_list)
-            print("Total sets processed: %d" % total_sets)
-            print("Threads used: %d" % int(self.num_threads.get()))
-            notify_phone(f"Completed processing folders: {', '.join([f.name for f in folders_to_process])}")
-            for btn in self.buttons_to_disable:
-                btn["state"] = "normal"
-            self.btn_execute["text"] = "Done!"
-            self.btn_execute["command"] = self.quit
+            notify_phone(f"Completed processing folders: {', '.join([f.name for f in self.batch.processed_folders])}")
             play_sound("C:/Windows/Media/Speech On.wav")
-            self.update()
+            self.after(0, finish)
 
-        # Run in a separate thread to keep UI alive
+        self.batch = HDRBatch(CONFIG)
+        self.running = True
         threading.Thread(target=real_execute).start()
+        self.after(PROGRESS_INTERVAL, self.show_progress)
+
+    def auto_tune(self):
+        """Find the best thread count for this machine from the batch folders."""
+        settings = (
+            self.extension.get(),
+            self.do_align.get(),
+            self.do_raw.get(),
+            self.do_recursive.get(),
+            self.get_merge_backend(),
+        )
+        self.btn_execute["text"] = "Tuning..."
+        for btn in self.buttons_to_disable:
+            btn["state"] = "disabled"
+
+        def finish(result):
+            set_machine_threads(CONFIG, result)
+            save_config(CONFIG)
+            self.num_threads.delete(0, "end")
+            self.num_threads.insert(0, result["threads"])
+
+        def reset():
+            self.progress["value"] = 0
+            self.enable_buttons()
+
+        # Runs in a separate thread like real_execute
+        def real_auto_tune():
+            try:
+                result = calibrate(
+                    self.batch,
+                    self.batch_folders,
+                    *settings,
+                    pp3_for_folder=self.get_pp3_file,
+                )
+            except SettingsError as ex:
+                self.after(0, self.show_error, ex.title, str(ex))
+            except Exception as ex:
+                if not isinstance(ex, RuntimeError):
+                    traceback.print_exc()
+                self.after(0, self.show_error, "Auto-tune Failed", str(ex))
+            else:
+                self.after(0, finish, result)
+            finally:
+                self.running = False
+                self.after(0, reset)
+
+        self.batch = HDRBatch(CONFIG)
+        self.running = True
+        threading.Thread(target=real_auto_tune).start()
+        self.after(PROGRESS_INTERVAL, self.show_progress)
 
     def quit(self):
         global root
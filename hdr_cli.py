@@ -0,0 +1,325 @@
+"""Merge brackets from the command line, without starting the GUI.
+
+    python hdr_cli.py [options] FOLDER [FOLDER ...]
+
+Anything not given as an option is taken from config.json, the same as in the GUI.
+The command line only changes config.json with --auto-tune, which merges a few of
+the brackets at increasing thread counts first and saves the best count for this
+machine (see autotune.py).
+
+To spread the work over several machines, run one coordinator that finds the
+brackets and any number of workers that merge them, all using the same shared
+queue folder (see job_queue.py). The image folders must be reachable under the same
+paths on every machine:
+
+    python hdr_cli.py --coordinator //server/hdr_queue [options] FOLDER [FOLDER ...]
+    python hdr_cli.py --worker //server/hdr_queue [-t THREADS]
+
+Exit codes:
+
+    0  every bracket was merged (or was already up to date)
+    1  some brackets failed, see the output and Merged/logs for details
+    2  invalid options or configuration
+    3  no matching files were found in any of the folders
+"""
+
+import argparse
+import pathlib
+import sys
+
+import hdr_batch
+import image_io
+import tonemap
+from hdr_batch import (
+    ALIGN_BACKENDS,
+    MERGE_BACKENDS,
+    MERGE_MODES,
+    PROXY_SCALES,
+    RAW_BACKENDS,
+    TONEMAP_BACKENDS,
+    HDRBatch,
+    NoMatchingFilesError,
+    SettingsError,
+    get_config,
+    get_profile_for_folder,
+    save_config,
+)
+from job_queue import LEASE_TIMEOUT, FolderQueue
+from autotune import calibrate, get_default_threads, set_machine_threads
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_INVALID = 2
+EXIT_NO_FILES = 3
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Merge exposure brackets to HDR images without the GUI."
+    )
+    parser.add_argument("folders", nargs="*", help="Folders with the images to merge")
+    parser.add_argument(
+        "-e",
+        "--extension",
+        help="Extension or pattern of the files to merge, e.g. .tif or *.CR2 "
+        "(default: the last one used in the GUI)",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Brackets to merge at once (default: tuned for this machine, or from "
+        "config), with --auto-tune the most to try",
+    )
+    parser.add_argument(
+        "--auto-tune",
+        action="store_true",
+        help="Find the best number of threads for this machine by merging a few "
+        "brackets first, and save it to config.json",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        choices=list(MERGE_BACKENDS),
+        help="Merge backend (default: from config)",
+    )
+    parser.add_argument(
+        "--merge-mode",
+        choices=list(MERGE_MODES),
+        help="With -b numpy, weighted averages all exposures by their noise and "
+        "removes ghosts (default: from config)",
+    )
+    parser.add_argument(
+        "--proxy",
+        type=int,
+        choices=[s for s in PROXY_SCALES if s > 1],
+        help="Quickly merge previews at 1/N of the resolution into Merged/proxy, "
+        "with the NumPy backend",
+    )
+    parser.add_argument(
+        "--exr-compression",
+        choices=list(image_io.EXR_COMPRESSIONS),
+        help="Compression of the merged EXRs (default: from config)",
+    )
+    parser.add_argument(
+        "--exr-precision",
+        choices=list(image_io.EXR_PRECISIONS),
+        help="Save the merged EXRs as 32-bit float or 16-bit half (default: from "
+        "config)",
+    )
+    parser.add_argument(
+        "--tonemap-backend",
+        choices=list(TONEMAP_BACKENDS),
+        help="Tonemap the JPGs in-process, or with luminance-hdr-cli (default: from "
+        "config)",
+    )
+    parser.add_argument(
+        "--tmo",
+        choices=list(tonemap.OPERATORS),
+        help="Tonemapping operator for the JPGs (default: from config)",
+    )
+    parser.add_argument(
+        "-a", "--align", action="store_true", help="Align the images of each bracket"
+    )
+    parser.add_argument(
+        "--align-backend",
+        choices=list(ALIGN_BACKENDS),
+        help="Align with Hugin's align_image_stack, or in-process with OpenCV "
+        "(default: from config)",
+    )
+    parser.add_argument(
+        "-r", "--recursive", action="store_true", help="Also process subfolders"
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Develop RAW files first, --extension is then that of the RAW files",
+    )
+    parser.add_argument(
+        "--align-per-position",
+        action="store_true",
+        help="With --align-backend opencv, reuse the alignment of brackets shot "
+        "from the same camera position",
+    )
+    parser.add_argument(
+        "--raw-backend",
+        choices=list(RAW_BACKENDS),
+        help="Develop RAW files with RawTherapee and a PP3 profile, or decode them "
+        "in-process with rawpy (default: from config)",
+    )
+    parser.add_argument(
+        "--write-tiffs",
+        action="store_true",
+        help="With --raw-backend rawpy, also save the developed 16-bit TIFFs "
+        "(they are always written when aligning or merging with Blender)",
+    )
+    profile = parser.add_mutually_exclusive_group()
+    profile.add_argument(
+        "-p",
+        "--profile",
+        help="Name of the PP3 profile in config.json to use for every folder "
+        "(default: matched by folder key)",
+    )
+    profile.add_argument("--pp3", help="Path of a PP3 profile to use for every folder")
+    parser.add_argument(
+        "--memory-budget-gb",
+        help="Memory to allow for merging at once, 0 for no limit (default: from config)",
+    )
+    queue = parser.add_mutually_exclusive_group()
+    queue.add_argument(
+        "--coordinator",
+        metavar="QUEUE",
+        help="Find the brackets and publish them to this queue folder for workers",
+    )
+    queue.add_argument(
+        "--worker",
+        metavar="QUEUE",
+        help="Merge brackets from this queue folder until they are all done",
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=LEASE_TIMEOUT,
+        help="Seconds after which a bracket of an unresponsive worker is given "
+        "to another one (default: %(default)s)",
+    )
+    parser.add_argument("--config", help="Path of config.json to use")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="List the images of each bracket"
+    )
+    args = parser.parse_args(argv)
+    if not args.folders and not args.worker:
+        parser.error("at least one folder is required")
+    if args.auto_tune and (args.worker or args.coordinator):
+        parser.error("--auto-tune can't be used with --worker or --coordinator")
+    return args
+
+
+def get_pp3_chooser(args, config: dict):
+    """A function returning the PP3 profile path to use for a folder."""
+    if args.pp3:
+        if not pathlib.Path(args.pp3).exists():
+            raise SettingsError("PP3 Profile Not Found", "%s doesn't exist" % args.pp3)
+        return lambda folder: args.pp3
+
+    profiles = config.get("pp3_profiles", [])
+    if args.profile:
+        for profile in profiles:
+            if profile.get("name") == args.profile:
+                return lambda folder: profile.get("path", "")
+        raise SettingsError(
+            "PP3 Profile Not Found",
+            "There is no PP3 profile called '%s' in config.json" % args.profile,
+        )
+
+    def choose(folder):
+        profile = get_profile_for_folder(profiles, str(folder))
+        return profile.get("path", "") if profile else ""
+
+    return choose
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    hdr_batch.verbose = args.verbose
+
+    config_path = pathlib.Path(args.config) if args.config else None
+    try:
+        config = get_config(config_path)
+    except RuntimeError as ex:
+        print("Error: %s" % ex)
+        return EXIT_INVALID
+
+    gui_settings = config["gui_settings"]
+    if args.memory_budget_gb is not None:
+        gui_settings["memory_budget_gb"] = args.memory_budget_gb
+    if args.tonemap_backend:
+        gui_settings["tonemap_backend"] = args.tonemap_backend
+    if args.merge_mode:
+        gui_settings["merge_mode"] = args.merge_mode
+    if args.proxy:
+        gui_settings["proxy_scale"] = args.proxy
+    if args.exr_compression:
+        gui_settings["exr_compression"] = args.exr_compression
+    if args.exr_precision:
+        gui_settings["exr_precision"] = args.exr_precision
+    if args.tmo:
+        gui_settings["tonemap_operator"] = args.tmo
+    if args.align_backend:
+        gui_settings["align_backend"] = args.align_backend
+    if args.align_per_position:
+        gui_settings["align_per_position"] = True
+    if args.raw_backend:
+        gui_settings["raw_backend"] = args.raw_backend
+    if args.write_tiffs:
+        gui_settings["raw_write_tiffs"] = True
+    do_raw = args.raw
+    extension = args.extension
+    if not extension:
+        extension = gui_settings["raw_extension" if do_raw else "tif_extension"]
+
+    merge_backend = args.backend or gui_settings["merge_backend"]
+    if merge_backend not in MERGE_BACKENDS:
+        merge_backend = "blender"
+
+    threads = args.threads or get_default_threads(config)
+
+    batch = HDRBatch(config)
+    if args.worker:
+        failed = batch.work(FolderQueue(args.worker, args.lease_timeout), threads)
+        return EXIT_FAILED if failed else EXIT_OK
+
+    try:
+        if args.auto_tune:
+            result = calibrate(
+                batch,
+                args.folders,
+                extension,
+                args.align,
+                do_raw,
+                args.recursive,
+                merge_backend,
+                pp3_for_folder=get_pp3_chooser(args, config),
+                max_threads=int(args.threads) if args.threads else None,
+            )
+            set_machine_threads(config, result)
+            save_config(config, config_path)
+            threads = result["threads"]
+            batch = HDRBatch(config)
+
+        if args.coordinator:
+            failed = batch.coordinate(
+                FolderQueue(args.coordinator, args.lease_timeout),
+                args.folders,
+                extension,
+                args.align,
+                do_raw,
+                args.recursive,
+                merge_backend,
+                pp3_for_folder=get_pp3_chooser(args, config),
+            )
+        else:
+            failed = batch.run(
+                args.folders,
+                extension,
+                args.align,
+                do_raw,
+                args.recursive,
+                merge_backend,
+                threads,
+                pp3_for_folder=get_pp3_chooser(args, config),
+            )
+    except NoMatchingFilesError as ex:
+        print("Error: %s" % ex)
+        return EXIT_NO_FILES
+    except SettingsError as ex:
+        print("Error: %s" % ex)
+        return EXIT_INVALID
+    except RuntimeError as ex:  # A bracket failed while auto-tuning
+        print("Error: %s" % ex)
+        return EXIT_FAILED
+
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,442 @@
+"""Reading bracket images and writing EXR files for the built-in merge backend."""
+
+import importlib
+import os
+import pathlib
+import tempfile
+
+# Camera RAW formats, which are decoded with rawpy (LibRaw)
+RAW_EXTENSIONS = {
+    ".3fr",
+    ".arw",
+    ".cr2",
+    ".cr3",
+    ".crw",
+    ".dng",
+    ".erf",
+    ".iiq",
+    ".kdc",
+    ".mos",
+    ".mrw",
+    ".nef",
+    ".nrw",
+    ".orf",
+    ".pef",
+    ".raf",
+    ".rw2",
+    ".sr2",
+    ".srf",
+    ".srw",
+    ".x3f",
+}
+
+
+def require(module_name: str, package_name: str = None):
+    """Import an optional dependency, raising a helpful error if it is missing."""
+    package_name = package_name or module_name
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as ex:
+        raise RuntimeError(
+            "Missing required dependency '%s'. Install it with: pip install %s"
+            % (package_name, package_name)
+        ) from ex
+
+
+def srgb_to_linear(img):
+    """Convert sRGB encoded values in the 0-1 range to linear, in place."""
+    np = require("numpy")
+    low = img <= 0.04045
+    linear_low = img / 12.92
+    np.power((img + 0.055) / 1.055, 2.4, out=img)
+    img[low] = linear_low[low]
+    return img
+
+
+def linear_to_srgb(img):
+    """Convert linear values in the 0-1 range to sRGB encoded ones, in place."""
+    np = require("numpy")
+    np.clip(img, 0.0, 1.0, out=img)
+    low = img <= 0.0031308
+    srgb_low = img * 12.92
+    np.power(img, 1 / 2.4, out=img)
+    img *= 1.055
+    img -= 0.055
+    img[low] = srgb_low[low]
+    return img
+
+
+def luminance(img):
+    """Rec. 709 luminance (HxW) of a linear HxWx3 image."""
+    np = require("numpy")
+    # matmul rather than np.dot, which is much slower for this shape
+    return img @ np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+def to_rgb(img):
+    """Return an HxWx3 view of img, dropping alpha and expanding greyscale."""
+    np = require("numpy")
+    if img.ndim == 2:
+        return np.repeat(img[:, :, None], 3, axis=2)
+    if img.shape[0] in (3, 4) and img.shape[2] not in (3, 4):
+        # Planar TIFFs come back as CxHxW
+        img = np.moveaxis(img, 0, -1)
+    if img.shape[2] == 1:
+        return np.repeat(img, 3, axis=2)
+    return img[:, :, :3]
+
+
+def _read_exr(path: pathlib.Path):
+    np = require("numpy")
+    OpenEXR = require("OpenEXR")
+    Imath = require("Imath", "OpenEXR")
+
+    exr = OpenEXR.InputFile(str(path))
+    try:
+        window = exr.header()["dataWindow"]
+        width = window.max.x - window.min.x + 1
+        height = window.max.y - window.min.y + 1
+        pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
+        channels = [
+            np.frombuffer(exr.channel(c, pixel_type), dtype=np.float32) for c in "RGB"
+        ]
+    finally:
+        exr.close()
+    return np.stack(channels, axis=-1).reshape(height, width, 3)
+
+
+def is_raw(path) -> bool:
+    return pathlib.Path(path).suffix.lower() in RAW_EXTENSIONS
+
+
+def read_raw(path: pathlib.Path, half_size: bool = False):
+    """Demosaic a camera RAW file to a linear float32 HxWx3 array.
+
+    Only the basic develop settings are applied: the camera's white balance and
+    sRGB primaries, with no brightening or tone curve, so the exposures of a bracket
+    keep the ratios their EXIF describes. half_size skips demosaicing by using each
+    block of 2x2 sensor pixels as one pixel, which is much faster."""
+    np = require("numpy")
+    rawpy = require("rawpy")
+
+    with rawpy.imread(str(path)) as raw:
+        rgb = raw.postprocess(
+            gamma=(1, 1),
+            no_auto_bright=True,
+            use_camera_wb=True,
+            output_color=rawpy.ColorSpace.sRGB,
+            output_bps=16,
+            half_size=half_size,
+        )
+    img = rgb.astype(np.float32)
+    img /= 65535.0
+    return img
+
+
+def raw_resolution(path: pathlib.Path) -> str:
+    """The "WIDTHxHEIGHT" of a RAW file once developed, without decoding it.
+
+    The EXIF of some RAW files only gives the size of their embedded preview."""
+    rawpy = require("rawpy")
+    with rawpy.imread(str(path)) as raw:
+        sizes = raw.sizes
+    width, height = sizes.width, sizes.height
+    if sizes.flip in (5, 6):  # Rotated by 90 degrees
+        width, height = height, width
+    return "%dx%d" % (width, height)
+
+
+def write_tiff16(path: pathlib.Path, img):
+    """Write a linear float HxWx3 array as a 16-bit sRGB encoded TIFF, which is how
+    Blender and load_image read 16-bit TIFFs."""
+    np = require("numpy")
+    tifffile = require("tifffile")
+
+    img = linear_to_srgb(np.array(img, dtype=np.float32))
+    img *= 65535.0
+    img += 0.5
+    tifffile.imwrite(str(path), img.astype(np.uint16), photometric="rgb")
+
+
+def load_image(path: pathlib.Path, scale: int = 1):
+    """Load an image as a linear float32 HxWx3 array.
+
+    Integer images (8/16-bit TIFF, JPG, PNG) are treated as sRGB encoded, which is
+    how Blender interprets them by default. Float images are assumed to be linear,
+    and RAW files are developed to linear with read_raw().
+
+    With a scale above 1 the image is loaded at 1/scale of its size (rounded up),
+    decoding as little of it as the format allows, for quick previews.
+    """
+    np = require("numpy")
+    path = pathlib.Path(path)
+    suffix = path.suffix.lower()
+
+    if suffix in (".tif", ".tiff"):
+        # Converted straight from the page cache when possible, rather than read
+        # into memory first. That also means only the rows that are kept are read.
+        img = memmap_tiff(path)
+        if img is None:
+            img = require("tifffile").imread(str(path))
+    elif suffix == ".exr":
+        img = _read_exr(path)
+        if scale > 1:
+            img = np.ascontiguousarray(img[::scale, ::scale])
+        return img
+    elif suffix in RAW_EXTENSIONS:
+        if scale == 1:
+            return read_raw(path)
+        img = read_raw(path, half_size=True)
+        # Files that are already demosaiced (e.g. linear DNGs) come out full size
+        width = int(raw_resolution(path).split("x")[0])
+        step = max(1, round(scale * img.shape[1] / width))
+        return np.ascontiguousarray(img[::step, ::step])
+    else:
+        Image = require("PIL.Image", "Pillow")
+        with Image.open(path) as im:
+            if scale > 1:
+                size = (-(-im.width // scale), -(-im.height // scale))
+                # JPGs can be decoded at 1/2, 1/4 or 1/8 of their size directly
+                im.draft("RGB", size)
+                im = im.convert("RGB")
+                if im.size != size:
+                    im = im.resize(size, Image.BOX)
+                return to_linear(np.asarray(im))
+            img = np.asarray(im.convert("RGB"))
+
+    return to_linear(to_rgb(img)[::scale, ::scale])
+
+
+def to_linear(img):
+    """Convert an HxWx3 image as read from a file to linear float32."""
+    np = require("numpy")
+    if np.issubdtype(img.dtype, np.integer):
+        scale = float(np.iinfo(img.dtype).max)
+        img = img.astype(np.float32)
+        img /= scale
+        return srgb_to_linear(img)
+    return np.ascontiguousarray(img, dtype=np.float32)
+
+
+def memmap_tiff(path: pathlib.Path):
+    """Memory-map the pixels of a TIFF as a read-only HxW(xS) array, without copying.
+
+    Returns None unless they are stored uncompressed in one contiguous block, as in
+    the TIFFs RawTherapee and Lightroom save by default."""
+    tifffile = require("tifffile")
+    with tifffile.TiffFile(str(path)) as tiff:
+        page = tiff.pages[0]
+        if not page.is_memmappable or page.planarconfig != 1:
+            return None
+    return tifffile.memmap(str(path), page=0, mode="r")
+
+
+def strip_to_linear(strip, width: int):
+    """Convert rows of a TIFF (NxW or NxWxS) to a linear float32 NxWx3 array."""
+    np = require("numpy")
+    strip = strip.reshape(len(strip), width, -1)
+    if strip.shape[2] == 1:
+        strip = np.repeat(strip, 3, axis=2)
+    return to_linear(strip[:, :, :3])
+
+
+class StripReader:
+    """Reads an image a range of rows at a time, like load_image() does whole.
+
+    Uncompressed TIFFs are memory-mapped, so only the rows that are read are loaded
+    from disk, and the page cache is shared with anything else reading the same
+    file. The strips of other (non-tiled) TIFFs and the scanlines of EXRs are only
+    decoded when they are read. Other images, and any image read at a scale above 1
+    (see load_image), are decoded once and kept in a temporary file rather than in
+    memory, so reading all images of a bracket strip by strip only needs memory for
+    one strip of each."""
+
+    def __init__(self, path: pathlib.Path, scale: int = 1):
+        self.path = pathlib.Path(path)
+        self.scale = scale
+        self._map = None
+        self._tiff = None
+        self._exr = None
+        self._file = None
+        suffix = self.path.suffix.lower()
+        if scale > 1:
+            suffix = None
+        elif suffix in (".tif", ".tiff"):
+            self._map = memmap_tiff(self.path)
+            if self._map is not None:
+                self.height, self.width = self._map.shape[:2]
+                return
+            tiff = require("tifffile").TiffFile(str(self.path))
+            page = tiff.pages[0]
+            if not page.is_tiled and page.planarconfig == 1 and page.ndim in (2, 3):
+                self._tiff, self._page = tiff, page
+                self.height, self.width = page.shape[:2]
+                return
+            tiff.close()
+        elif suffix == ".exr":
+            self._exr = require("OpenEXR").InputFile(str(self.path))
+            window = self._exr.header()["dataWindow"]
+            self._top = window.min.y
+            self.width = window.max.x - window.min.x + 1
+            self.height = window.max.y - window.min.y + 1
+            return
+        self._load_to_file()
+
+    def _load_to_file(self):
+        np = require("numpy")
+        img = load_image(self.path, self.scale)
+        self.height, self.width = img.shape[:2]
+        handle, name = tempfile.mkstemp(prefix="hdr-strips-", suffix=".npy")
+        os.close(handle)
+        self._file = pathlib.Path(name)
+        stored = np.lib.format.open_memmap(
+            name, mode="w+", dtype=np.float32, shape=img.shape
+        )
+        stored[:] = img
+        del img
+        stored.flush()
+        self._stored = stored
+
+    def read(self, start: int, stop: int):
+        """Rows start to stop (exclusive) as a linear float32 array."""
+        np = require("numpy")
+        if self._exr is not None:
+            Imath = require("Imath", "OpenEXR")
+            pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
+            channels = [
+                np.frombuffer(
+                    self._exr.channel(
+                        c, pixel_type, self._top + start, self._top + stop - 1
+                    ),
+                    dtype=np.float32,
+                )
+                for c in "RGB"
+            ]
+            return np.stack(channels, axis=-1).reshape(stop - start, self.width, 3)
+        if self._map is not None:
+            return strip_to_linear(self._map[start:stop], self.width)
+        if self._tiff is None:
+            return np.array(self._stored[start:stop])
+
+        page = self._page
+        rows_per_strip = page.rowsperstrip or self.height
+        first = start // rows_per_strip
+        last = (stop - 1) // rows_per_strip
+        handle = self._tiff.filehandle
+        strips = []
+        for index in range(first, last + 1):
+            handle.seek(page.dataoffsets[index])
+            data = handle.read(page.databytecounts[index])
+            strip = page.decode(data, index)[0]
+            # The last strip may be padded to the full number of rows
+            rows = min(rows_per_strip, self.height - index * rows_per_strip)
+            strips.append(strip.reshape(-1, self.width, page.samplesperpixel)[:rows])
+        offset = first * rows_per_strip
+        return strip_to_linear(
+            np.concatenate(strips)[start - offset : stop - offset], self.width
+        )
+
+    def close(self):
+        # The mapping is closed once nothing refers to it any more
+        self._map = None
+        if self._tiff is not None:
+            self._tiff.close()
+        if self._exr is not None:
+            self._exr.close()
+        if self._file is not None:
+            # The file can only be removed once nothing maps it any more
+            del self._stored
+            self._file.unlink()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# EXR compression settings, mapped to their OpenEXR names
+EXR_COMPRESSIONS = {
+    "piz": "PIZ_COMPRESSION",
+    "zip": "ZIP_COMPRESSION",
+    "dwaa": "DWAA_COMPRESSION",
+    "none": "NO_COMPRESSION",
+}
+# EXR precision settings, mapped to the numpy type of their pixels
+EXR_PRECISIONS = {
+    "float": "float32",
+    "half": "float16",
+}
+# Rows written to an EXR at once
+EXR_CHUNK_ROWS = 64
+
+
+class ExrWriter:
+    """Writes an RGB EXR file a range of rows at a time, from top to bottom.
+
+    Rows are compressed and written as soon as they're given, so the whole image
+    never has to be in memory."""
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        width: int,
+        height: int,
+        compression: str = "piz",
+        precision: str = "float",
+    ):
+        OpenEXR = require("OpenEXR")
+        Imath = require("Imath", "OpenEXR")
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.dtype = EXR_PRECISIONS[precision]
+        pixel_type = "HALF" if precision == "half" else "FLOAT"
+        header = OpenEXR.Header(width, height)
+        header["compression"] = Imath.Compression(
+            getattr(Imath.Compression, EXR_COMPRESSIONS[compression])
+        )
+        channel = Imath.Channel(Imath.PixelType(getattr(Imath.PixelType, pixel_type)))
+        header["channels"] = {c: channel for c in "RGB"}
+        self._out = OpenEXR.OutputFile(str(path), header)
+
+    def write(self, rows):
+        """Write the next rows, an NxWx3 float array."""
+        np = require("numpy")
+        self._out.writePixels(
+            {
+                c: np.ascontiguousarray(rows[:, :, ci], dtype=self.dtype).tobytes()
+                for ci, c in enumerate("RGB")
+            },
+            rows.shape[0],
+        )
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        self._out.close()
+        if self.rows_written != self.height:
+            raise RuntimeError(
+                "Only %d of %d rows were written" % (self.rows_written, self.height)
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # The file is incomplete anyway, don't hide the original error
+            self._out.close()
+
+
+def write_exr(
+    path: pathlib.Path, img, compression: str = "piz", precision: str = "float"
+):
+    """Write an HxWx3 float array to an EXR file, PIZ compressed 32-bit by default."""
+    height, width = img.shape[:2]
+    with ExrWriter(path, width, height, compression, precision) as out:
+        # A chunk at a time, so only a chunk is converted to channels at once
+        for start in range(0, height, EXR_CHUNK_ROWS):
+            out.write(img[start : start + EXR_CHUNK_ROWS])
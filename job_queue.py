@@ -0,0 +1,219 @@
+"""A job queue in a shared folder, for spreading brackets over several machines.
+
+The coordinator writes one JSON file per bracket, and workers on any machine that
+can see the folder claim, run and complete them:
+
+    pending/  jobs waiting for a worker
+    leased/   jobs a worker is running, kept alive by touching the file
+    done/     finished jobs, with the worker's result
+    failed/   jobs that failed MAX_ATTEMPTS times
+    closed    exists once the coordinator has published every job
+
+Jobs move between the folders with os.rename, which is atomic within a file system,
+so a job can only ever be claimed by one worker. A lease that hasn't been touched
+for lease_timeout seconds belongs to a worker that crashed or lost the share, and
+is moved back to pending so another worker retries it. Lease times are compared to
+the local clock, so the machines' clocks need to be roughly in sync.
+"""
+
+import json
+import os
+import pathlib
+import shutil
+import socket
+import time
+
+LEASE_TIMEOUT = 120.0
+# How often workers touch their leases, well within LEASE_TIMEOUT
+HEARTBEAT_INTERVAL = 20.0
+MAX_ATTEMPTS = 3
+
+QUEUE_FOLDERS = ("pending", "leased", "done", "failed")
+
+
+def get_worker_id() -> str:
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+def _write_json(path: pathlib.Path, data: dict):
+    """Write a JSON file under a temporary name and rename it into place."""
+    tmp_path = path.with_name(path.name + ".%s.tmp" % get_worker_id())
+    with tmp_path.open("w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: pathlib.Path):
+    """The contents of a job file, or None if it was moved or is being written."""
+    try:
+        with path.open("r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+class Lease:
+    """A job claimed by this worker."""
+
+    def __init__(self, queue, job_id: str, job: dict):
+        self.queue = queue
+        self.job_id = job_id
+        self.job = job
+        self.path = queue.path / "leased" / (job_id + ".json")
+
+    def heartbeat(self) -> bool:
+        """Keep the lease from expiring. Returns False if it was already lost."""
+        try:
+            os.utime(self.path)
+            return True
+        except OSError:
+            return False
+
+    def is_held(self) -> bool:
+        """Whether the leased job file is still this claim, and not one made by
+        another worker after this lease expired and the job was requeued."""
+        job = _read_json(self.path)
+        return (
+            job is not None
+            and job.get("worker") == self.job["worker"]
+            and job.get("attempts") == self.job["attempts"]
+        )
+
+    def complete(self, result: dict) -> bool:
+        """Mark the job as done. Returns False if the lease had expired."""
+        if not self.is_held():
+            return False
+        done_path = self.queue.path / "done" / (self.job_id + ".json")
+        try:
+            os.rename(self.path, done_path)
+        except OSError:
+            return False
+        _write_json(done_path, dict(self.job, result=result))
+        return True
+
+    def fail(self, error: str) -> bool:
+        """Put the job back in the queue to be retried, or move it to failed/ once
+        it has been attempted MAX_ATTEMPTS times."""
+        if not self.is_held() or not self.heartbeat():
+            return False
+        self.job.setdefault("errors", []).append("%s: %s" % (self.job["worker"], error))
+        try:
+            _write_json(self.path, self.job)
+        except OSError:
+            return False
+        if self.job["attempts"] >= MAX_ATTEMPTS:
+            target = self.queue.path / "failed" / (self.job_id + ".json")
+        else:
+            target = self.queue.path / "pending" / (self.job_id + ".json")
+        try:
+            os.rename(self.path, target)
+        except OSError:
+            return False
+        return True
+
+
+class FolderQueue:
+    """The job queue in one shared folder, see the module docstring."""
+
+    def __init__(self, path, lease_timeout: float = LEASE_TIMEOUT):
+        self.path = pathlib.Path(path)
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = min(HEARTBEAT_INTERVAL, lease_timeout / 4)
+        for name in QUEUE_FOLDERS:
+            (self.path / name).mkdir(parents=True, exist_ok=True)
+
+    def _job_ids(self, folder: str) -> list:
+        try:
+            names = os.listdir(self.path / folder)
+        except OSError:
+            return []
+        return sorted(n[: -len(".json")] for n in names if n.endswith(".json"))
+
+    def reset(self):
+        """Remove all jobs, e.g. those left over from an earlier run."""
+        for name in QUEUE_FOLDERS:
+            shutil.rmtree(self.path / name, ignore_errors=True)
+            (self.path / name).mkdir(parents=True, exist_ok=True)
+        (self.path / "closed").unlink(missing_ok=True)
+
+    def put(self, job_id: str, job: dict):
+        _write_json(
+            self.path / "pending" / (job_id + ".json"),
+            dict(job, attempts=0, published=time.time()),
+        )
+
+    def close(self):
+        """Tell workers that no more jobs will be added."""
+        (self.path / "closed").touch()
+
+    def is_finished(self) -> bool:
+        """Whether all jobs have been published and none are waiting or running."""
+        return (
+            (self.path / "closed").exists()
+            and not self._job_ids("pending")
+            and not self._job_ids("leased")
+        )
+
+    def claim(self):
+        """Claim the next pending job, returning a Lease or None if there is none."""
+        for job_id in self._job_ids("pending"):
+            pending_path = self.path / "pending" / (job_id + ".json")
+            lease_path = self.path / "leased" / (job_id + ".json")
+            try:
+                # Renaming keeps the old modification time, which would make a
+                # requeued job look expired as soon as it's claimed
+                os.utime(pending_path)
+                os.rename(pending_path, lease_path)
+            except OSError:
+                continue  # Claimed by another worker first
+            job = _read_json(lease_path)
+            if job is None:
+                continue
+            if job["attempts"] >= MAX_ATTEMPTS:
+                # The last worker to try this one crashed
+                job.setdefault("errors", []).append(
+                    "Lease expired after %d attempts" % job["attempts"]
+                )
+                try:
+                    _write_json(lease_path, job)
+                    os.rename(lease_path, self.path / "failed" / (job_id + ".json"))
+                except OSError:
+                    pass
+                continue
+            job["attempts"] += 1
+            job["worker"] = get_worker_id()
+            job["claimed"] = time.time()
+            _write_json(lease_path, job)
+            return Lease(self, job_id, job)
+        return None
+
+    def requeue_expired(self) -> list:
+        """Move leases that haven't been touched in time back to pending."""
+        requeued = []
+        now = time.time()
+        for job_id in self._job_ids("leased"):
+            lease_path = self.path / "leased" / (job_id + ".json")
+            try:
+                if now - lease_path.stat().st_mtime < self.lease_timeout:
+                    continue
+                os.rename(lease_path, self.path / "pending" / (job_id + ".json"))
+            except OSError:
+                continue  # Completed or requeued in the meantime
+            requeued.append(job_id)
+        return requeued
+
+    def finished_jobs(self, seen: set):
+        """Yield (job id, job, succeeded) for done and failed jobs not in seen,
+        adding them to it."""
+        for folder, succeeded in (("done", True), ("failed", False)):
+            for job_id in self._job_ids(folder):
+                if job_id in seen:
+                    continue
+                job = _read_json(self.path / folder / (job_id + ".json"))
+                if job is None or (succeeded and "result" not in job):
+                    continue  # Still being written, pick it up next time
+                seen.add(job_id)
+                yield job_id, job, succeeded
+
+    def counts(self) -> dict:
+        return {name: len(self._job_ids(name)) for name in QUEUE_FOLDERS}
@@ -0,0 +1,177 @@
+"""Per-folder build manifest, so reruns only redo brackets that actually changed.
+
+For every merged output, Merged/manifest.json records what it was built from: the
+size and modification time of each input image, the EVs, and the settings and tool
+versions used. A bracket is only skipped when all of these still match and its
+outputs exist. Outputs are written under a temporary name and renamed when complete,
+so a crashed merge never leaves a file behind that looks finished.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+MANIFEST_VERSION = 1
+
+# Write the manifest at most this often while brackets are completing (seconds)
+SAVE_INTERVAL = 5.0
+
+
+def file_fingerprint(path) -> list:
+    """[path, size, mtime] of a file, or [path, None, None] if it doesn't exist."""
+    path = pathlib.Path(path).absolute()
+    try:
+        stat = path.stat()
+    except OSError:
+        return [path.as_posix(), None, None]
+    return [path.as_posix(), stat.st_size, stat.st_mtime_ns]
+
+
+def tool_fingerprint(exe_path: str) -> list:
+    """Identifies the installed version of an external tool by its executable."""
+    return file_fingerprint(exe_path) if exe_path else None
+
+
+def file_hash(path) -> str:
+    """SHA-1 of a small file such as a PP3 profile, or "" if it can't be read."""
+    try:
+        return hashlib.sha1(pathlib.Path(path).read_bytes()).hexdigest()
+    except OSError:
+        return ""
+
+
+def partial_path(path: pathlib.Path) -> pathlib.Path:
+    """Temporary name to write an output to before renaming it into place.
+
+    The real extension is kept so tools still pick the right file format."""
+    return path.with_name(path.stem + ".partial" + path.suffix)
+
+
+def commit_output(path: pathlib.Path):
+    """Move a completed output from its partial_path to its final name."""
+    os.replace(partial_path(path), path)
+
+
+class BuildManifest:
+    """The manifest of one Merged folder."""
+
+    def __init__(self, out_folder: pathlib.Path):
+        self.out_folder = out_folder
+        self.path = out_folder / "manifest.json"
+        self.entries = {}  # output name (e.g. "merged_000") -> entry dict
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open("r") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as ex:
+            print("Warning: Ignoring unreadable manifest %s: %s" % (self.path, ex))
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.entries = data.get("outputs", {})
+
+    @staticmethod
+    def signature(img_list: list, settings: dict) -> dict:
+        """Everything an output depends on, for a bracket given as "path___ev"."""
+        images = [i.split("___") for i in img_list]
+        return {
+            "inputs": [file_fingerprint(path) for path, ev in images],
+            "evs": [float(ev) for path, ev in images],
+            "settings": settings,
+        }
+
+    def _outputs_exist(self, entry: dict) -> bool:
+        return all((self.out_folder / o).exists() for o in entry.get("outputs", []))
+
+    def is_up_to_date(self, name: str, signature: dict) -> bool:
+        with self._lock:
+            entry = self.entries.get(name)
+        return (
+            entry is not None
+            and entry.get("signature") == signature
+            and self._outputs_exist(entry)
+        )
+
+    def reconcile(self, planned: dict):
+        """Reuse outputs whose bracket now has a different number.
+
+        planned maps each output name to its signature. When a bracket's inputs
+        match an existing output under another name (e.g. after a file was added
+        earlier in the folder), those outputs are renamed instead of re-merged."""
+        by_signature = {}
+        for name, entry in self.entries.items():
+            if self._outputs_exist(entry):
+                key = json.dumps(entry.get("signature"), sort_keys=True)
+                by_signature.setdefault(key, name)
+
+        moves = []  # (old name, new name)
+        for name, signature in planned.items():
+            if self.is_up_to_date(name, signature):
+                continue
+            old_name = by_signature.pop(json.dumps(signature, sort_keys=True), None)
+            if old_name is not None and old_name != name:
+                moves.append((old_name, name))
+        if not moves:
+            return
+
+        # Move everything out of the way first, as the names may overlap
+        staged = []
+        for old_name, new_name in moves:
+            entry = self.entries.pop(old_name)
+            files = []
+            for output in entry["outputs"]:
+                src = self.out_folder / output
+                tmp = src.with_name(src.name + ".moving")
+                os.replace(src, tmp)
+                dst = output.replace(old_name, new_name)
+                files.append((tmp, self.out_folder / dst))
+            entry["outputs"] = [o.replace(old_name, new_name) for o in entry["outputs"]]
+            staged.append((new_name, entry, files))
+
+        for new_name, entry, files in staged:
+            for tmp, dst in files:
+                os.replace(tmp, dst)
+            self.entries[new_name] = entry
+            print("Reusing outputs for %s from an earlier run" % new_name)
+        self.save()
+
+    def record(self, name: str, signature: dict, outputs: list):
+        """Record a completed output. outputs are paths inside the Merged folder."""
+        with self._lock:
+            self.entries[name] = {
+                "signature": signature,
+                "outputs": [
+                    pathlib.Path(o).relative_to(self.out_folder).as_posix()
+                    for o in outputs
+                ],
+            }
+            self._dirty = True
+            due = time.monotonic() - self._last_save > SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def save(self):
+        """Write the manifest atomically."""
+        with self._lock:
+            data = {"version": MANIFEST_VERSION, "outputs": self.entries}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = partial_path(self.path)
+            with tmp_path.open("w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def flush(self):
+        """Save any records that haven't been written yet."""
+        if self._dirty:
+            self.save()
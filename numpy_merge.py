@@ -0,0 +1,264 @@
+"""Built-in NumPy HDR merge, an in-process alternative to the Blender merge.
+
+Does the same job as the "Merge HDR" node group in HDR_Merge.blend: exposures are
+chained from brightest to darkest, and wherever the brighter exposure approaches
+clipping the result is replaced by the next darker exposure scaled up by its EV
+difference.
+
+The weighted mode instead averages every exposure, weighted by how little noise it
+has at each pixel, and leaves out pixels where something moved between exposures.
+It reads and merges the images a strip of rows at a time, and writes every strip to
+the EXR as soon as it's merged, so it only needs memory for one strip of each image
+rather than the full images.
+"""
+
+import pathlib
+
+from align import is_identity, reference_index, warp
+from image_io import (
+    ExrWriter,
+    StripReader,
+    load_image,
+    luminance,
+    require,
+    write_exr,
+)
+
+# Range (of the brightest channel, linear) over which a brighter exposure is faded
+# out in favour of the next darker one.
+CLIP_START = 0.7
+CLIP_END = 0.95
+
+# Rough noise model of a sensor at base ISO, in linear 0-1 units: the variance of a
+# value v is SHOT_NOISE * v + READ_NOISE ** 2
+SHOT_NOISE = 2e-4
+READ_NOISE = 1e-3
+# A pixel whose radiance differs from the reference exposure's by more than this many
+# standard deviations starts being treated as a ghost, and is left out entirely at
+# twice as many.
+GHOST_THRESHOLD = 4.0
+# Rows of every image that are merged at once in the weighted mode
+STRIP_ROWS = 256
+
+
+def parse_img_list(img_list: list) -> list:
+    """Split "path___ev" strings (as passed to blender_merge.py) into (path, ev) pairs
+    sorted from brightest (lowest EV) to darkest."""
+    images = [i.split("___") for i in img_list]
+    return sorted(
+        ((pathlib.Path(path), float(ev)) for path, ev in images), key=lambda x: x[1]
+    )
+
+
+def clip_weight(img):
+    """Weight (HxWx1) of how much the next darker exposure should replace img."""
+    np = require("numpy")
+    weight = img.max(axis=2, keepdims=True)
+    weight -= CLIP_START
+    weight *= 1.0 / (CLIP_END - CLIP_START)
+    np.clip(weight, 0.0, 1.0, out=weight)
+    # Smoothstep to avoid visible seams at the transition
+    return weight * weight * (3.0 - 2.0 * weight)
+
+
+def merge_exposures(exposures):
+    """Merge an iterable of (image, ev) pairs, ordered brightest to darkest.
+
+    Only the previous and current exposures are needed at any point, so when
+    exposures is a generator only a couple of frames are held in memory at once.
+    """
+    np = require("numpy")
+    exposures = iter(exposures)
+    previous, ev = next(exposures)
+    # EVs are relative to the brightest exposure of the folder, which may not be
+    # in this bracket
+    result = np.multiply(previous, 2.0**ev, dtype=np.float32)
+    for img, ev in exposures:
+        weight = clip_weight(previous)
+        scaled = np.multiply(img, 2.0**ev, dtype=np.float32)
+        scaled -= result
+        scaled *= weight
+        result += scaled
+        previous = img
+    return result
+
+
+def merge_brackets(img_list: list, transforms: list = None, scale: int = 1):
+    """Load and merge a bracket given as "path___ev" strings.
+
+    transforms are those of align.estimate_transforms, in the order of img_list,
+    to align the images as they are loaded. The images are loaded at 1/scale of
+    their size, see load_image()."""
+    images = parse_img_list(img_list)
+    if not images:
+        raise ValueError("No images to merge")
+    paths = [pathlib.Path(i.split("___")[0]) for i in img_list]
+    transform_of = dict(zip(paths, transforms or []))
+    return merge_exposures(
+        (warp(load_image(path, scale), transform_of.get(path)), ev)
+        for path, ev in images
+    )
+
+
+def smoothstep(x):
+    np = require("numpy")
+    x = np.clip(x, 0.0, 1.0)
+    return x * x * (3.0 - 2.0 * x)
+
+
+def noise_variance(values, gain: float):
+    """Variance of the radiance (values * gain) measured by an exposure."""
+    return (SHOT_NOISE * values + READ_NOISE**2) * gain**2
+
+
+def merge_weighted(strips, evs: list, reference: int):
+    """Merge strips of the same rows of each exposure, by inverse noise variance.
+
+    Near clipping the weights are faded out, except in the darkest exposure so that
+    there's always one left. Pixels whose radiance doesn't match that of the
+    reference exposure within the noise are taken as having moved, and are left
+    out wherever the reference isn't clipped itself."""
+    np = require("numpy")
+    darkest = evs.index(max(evs))
+    ref_gain = 2.0 ** evs[reference]
+    ref_lum = luminance(strips[reference])
+    ref_variance = noise_variance(ref_lum, ref_gain)
+    ref_lum *= ref_gain
+    ref_valid = 1.0 - clip_weight(strips[reference])[:, :, 0]
+
+    total = np.zeros(strips[0].shape, dtype=np.float32)
+    total_weight = np.zeros(strips[0].shape[:2], dtype=np.float32)
+    for k, (img, ev) in enumerate(zip(strips, evs)):
+        gain = 2.0**ev
+        lum = luminance(img)
+        weight = 1.0 / noise_variance(lum, gain)
+        if k != darkest:
+            weight *= 1.0 - clip_weight(img)[:, :, 0]
+        if k != reference:
+            difference = np.abs(lum * gain - ref_lum)
+            difference /= np.sqrt(noise_variance(lum, gain) + ref_variance)
+            ghost = smoothstep(difference / GHOST_THRESHOLD - 1.0)
+            weight *= 1.0 - ghost * ref_valid
+        total += img * (weight * gain)[:, :, None]
+        total_weight += weight
+    # Where the others are left out as ghosts the reference isn't clipped, and
+    # elsewhere the darkest exposure is never left out, so this is never zero
+    total /= np.maximum(total_weight, 1e-12)[:, :, None]
+    return total
+
+
+def source_rows(transform, start: int, stop: int, width: int, height: int):
+    """The rows of an image that warp() reads for rows start to stop of its output."""
+    np = require("numpy")
+    if is_identity(transform):
+        return start, stop
+    matrix = np.array(transform, dtype=np.float64)
+    corners = [(x, y) for x in (0, width - 1) for y in (start, stop - 1)]
+    ys = [matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2] for x, y in corners]
+    # One more row either side for the bilinear interpolation
+    first = max(int(np.floor(min(ys))) - 1, 0)
+    last = min(int(np.ceil(max(ys))) + 2, height)
+    return min(first, height - 1), max(last, first + 1)
+
+
+def warp_strip(reader: StripReader, transform, start: int, stop: int):
+    """Rows start to stop of warp(image, transform), reading only the rows needed."""
+    np = require("numpy")
+    first, last = source_rows(transform, start, stop, reader.width, reader.height)
+    strip = reader.read(first, last)
+    if is_identity(transform):
+        return strip
+    # Move the transform to the strip's own coordinates
+    matrix = np.array(transform, dtype=np.float32)
+    matrix[:, 2] += matrix[:, 1] * start
+    matrix[1, 2] -= first
+    cv2 = require("cv2", "opencv-python")
+    return cv2.warpAffine(
+        strip,
+        matrix,
+        (reader.width, stop - start),
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+
+
+def merge_weighted_strips(img_list: list, transforms: list = None, scale: int = 1):
+    """Merge a bracket with merge_weighted() a strip at a time.
+
+    Yields the (height, width) of the image first, then the merged strips from top
+    to bottom."""
+    images = parse_img_list(img_list)
+    if not images:
+        raise ValueError("No images to merge")
+    paths = [pathlib.Path(i.split("___")[0]) for i in img_list]
+    transform_of = dict(zip(paths, transforms or []))
+    evs = [ev for _, ev in images]
+    reference = reference_index(evs)
+
+    readers = []
+    try:
+        for path, _ in images:
+            readers.append(StripReader(path, scale))
+        height = readers[0].height
+        yield height, readers[0].width
+        for start in range(0, height, STRIP_ROWS):
+            stop = min(start + STRIP_ROWS, height)
+            strips = [
+                warp_strip(reader, transform_of.get(path), start, stop)
+                for reader, (path, _) in zip(readers, images)
+            ]
+            yield merge_weighted(strips, evs, reference)
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def merge_brackets_weighted(img_list: list, transforms: list = None, scale: int = 1):
+    """Like merge_brackets(), but with merge_weighted()."""
+    np = require("numpy")
+    strips = merge_weighted_strips(img_list, transforms, scale)
+    height, width = next(strips)
+    result = np.empty((height, width, 3), dtype=np.float32)
+    start = 0
+    for strip in strips:
+        result[start : start + len(strip)] = strip
+        start += len(strip)
+    return result
+
+
+def merge_to_exr(
+    img_list: list,
+    exr_path: pathlib.Path,
+    transforms: list = None,
+    mode: str = "chain",
+    compression: str = "piz",
+    precision: str = "float",
+    keep_result: bool = True,
+    scale: int = 1,
+):
+    """Merge a bracket and write the result to an EXR file.
+
+    In the weighted mode every strip is written as soon as it's merged, and the
+    whole merged image is only kept (and returned) if keep_result is set."""
+    np = require("numpy")
+    exr_path = pathlib.Path(exr_path)
+    exr_path.parent.mkdir(parents=True, exist_ok=True)
+    if mode == "chain":
+        merged = merge_brackets(img_list, transforms, scale)
+        write_exr(exr_path, merged, compression, precision)
+        return merged
+
+    strips = merge_weighted_strips(img_list, transforms, scale)
+    try:
+        height, width = next(strips)
+        merged = None
+        if keep_result:
+            merged = np.empty((height, width, 3), dtype=np.float32)
+        with ExrWriter(exr_path, width, height, compression, precision) as out:
+            for strip in strips:
+                if merged is not None:
+                    merged[out.rows_written : out.rows_written + len(strip)] = strip
+                out.write(strip)
+    finally:
+        strips.close()
+    return merged
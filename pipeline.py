@@ -0,0 +1,236 @@
+"""Staged scheduler that runs each step of a bracket in its own worker pool.
+
+Aligning, merging and tonemapping have very different CPU and RAM needs, so rather
+than running all of them back to back in one thread slot, every stage gets its own
+pool with its own worker count. A bracket moves on to the next stage's queue as soon
+as its previous step finishes.
+
+Steps can also reserve an estimated amount of memory from a MemoryBudget, so that
+merges are only started while they fit in RAM alongside the ones already running.
+"""
+
+import ctypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Stage names in the order a bracket passes through them
+STAGES = ("raw", "align", "merge", "tonemap")
+
+# Every image is held as an RGBA float32 buffer while merging
+BYTES_PER_PIXEL = 4 * 4
+# Blender's own footprint, on top of the image buffers
+BLENDER_OVERHEAD = 300 * 1024**2
+
+
+def get_total_memory() -> int:
+    """Total physical memory in bytes, or 0 if it can't be determined."""
+    try:
+        return __import__("psutil").virtual_memory().total
+    except ImportError:
+        pass
+
+    if sys.platform.startswith("win"):
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong),
+                ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong),
+                ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong),
+                ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong),
+                ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+        return 0
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+def estimate_merge_memory(
+    resolution: str, image_count: int, backend: str, strip_rows: int = 0
+) -> int:
+    """Estimate the peak memory in bytes of merging one bracket.
+
+    resolution is the "WIDTHxHEIGHT" string from get_exif. strip_rows is the
+    number of rows merged at once, if the images aren't all loaded whole."""
+    width, height = (int(d) for d in resolution.split("x"))
+    if strip_rows:
+        # A strip of each input and of the weights, plus the merged result and one
+        # whole image for inputs that can't be read in strips (e.g. RAW files)
+        estimate = width * min(strip_rows, height) * BYTES_PER_PIXEL * (image_count + 2)
+        estimate += width * height * BYTES_PER_PIXEL * 2
+        return estimate
+    # The inputs, plus the merged result and a scratch buffer
+    estimate = width * height * BYTES_PER_PIXEL * (image_count + 2)
+    if backend != "numpy":
+        estimate += BLENDER_OVERHEAD
+    return estimate
+
+
+def get_memory_budget(budget_gb: str) -> int:
+    """Memory budget in bytes from the memory_budget_gb setting.
+
+    An empty setting uses 75% of physical memory, 0 disables the limit."""
+    if str(budget_gb).strip():
+        return int(float(budget_gb) * 1024**3)
+    return int(get_total_memory() * 0.75)
+
+
+class MemoryBudget:
+    """Blocks new reservations while the reserved total would exceed the budget.
+
+    A reservation is always admitted when nothing else is reserved, so a bracket
+    larger than the whole budget still runs, just on its own."""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.reserved = 0
+        self._changed = threading.Condition()
+
+    def acquire(self, amount: int):
+        with self._changed:
+            while (
+                self.budget > 0
+                and self.reserved > 0
+                and self.reserved + amount > self.budget
+            ):
+                self._changed.wait()
+            self.reserved += amount
+
+    def release(self, amount: int):
+        with self._changed:
+            self.reserved -= amount
+            self._changed.notify_all()
+
+
+class StagedPipeline:
+    """A set of per-stage thread pools that brackets flow through."""
+
+    def __init__(
+        self, stage_workers: dict, memory_budget: MemoryBudget = None, on_step=None
+    ):
+        """stage_workers maps each stage name to its number of workers.
+
+        on_step, if given, is called as on_step(tag, stage, queued, started,
+        finished) after each step of a chain submitted with a tag. The times are
+        from time.monotonic, and started is after any memory was reserved."""
+        self.memory_budget = memory_budget
+        self.on_step = on_step
+        self.executors = {
+            name: ThreadPoolExecutor(
+                max_workers=max(1, int(stage_workers.get(name, 1))),
+                thread_name_prefix="hdr_%s" % name,
+            )
+            for name in STAGES
+        }
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def run(self, stage: str, fn, *args, **kwargs) -> Future:
+        """Run a single function in a stage's pool."""
+        return self.executors[stage].submit(fn, *args, **kwargs)
+
+    def submit(self, steps: list, tag=None) -> Future:
+        """Queue a chain of (stage, callable) steps to run one after the other.
+
+        A step may also be (stage, callable, memory), in which case that many bytes
+        are reserved from the memory budget while the callable runs. memory can be a
+        function, called when the step starts, for an amount that depends on the
+        earlier steps. tag is passed to on_step to say which chain a step belonged
+        to.
+
+        Returns a Future that completes when the last step has finished, or with the
+        exception of the first step that failed."""
+        result = Future()
+        result.set_running_or_notify_cancel()
+        with self._idle:
+            self._pending += 1
+        self._run_step(list(steps), 0, result, tag)
+        return result
+
+    def _finish(self, result: Future, exception=None):
+        if exception is None:
+            result.set_result(None)
+        else:
+            result.set_exception(exception)
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+
+    def _run_step(self, steps: list, index: int, result: Future, tag=None):
+        if index >= len(steps):
+            self._finish(result)
+            return
+
+        stage, fn = steps[index][:2]
+        memory = steps[index][2] if len(steps[index]) > 2 else 0
+        if tag is not None and self.on_step is not None:
+            fn = self._timed(fn, tag, stage)
+        if memory and self.memory_budget is not None:
+            fn = self._reserving(fn, memory)
+
+        def on_done(step_future):
+            exception = step_future.exception()
+            if exception is not None:
+                self._finish(result, exception)
+            else:
+                self._run_step(steps, index + 1, result, tag)
+
+        try:
+            self.executors[stage].submit(fn).add_done_callback(on_done)
+        except RuntimeError as ex:  # Pool already shut down
+            self._finish(result, ex)
+
+    def _timed(self, fn, tag, stage: str):
+        queued = time.monotonic()
+
+        def run():
+            started = time.monotonic()
+            try:
+                return fn()
+            finally:
+                self.on_step(tag, stage, queued, started, time.monotonic())
+
+        return run
+
+    def _reserving(self, fn, memory):
+        def run():
+            amount = memory() if callable(memory) else memory
+            self.memory_budget.acquire(amount)
+            try:
+                return fn()
+            finally:
+                self.memory_budget.release(amount)
+
+        return run
+
+    def wait(self):
+        """Block until every submitted chain has finished."""
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+    def shutdown(self):
+        """Wait for all queued brackets, then stop the stage pools."""
+        self.wait()
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
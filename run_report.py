@@ -0,0 +1,223 @@
+"""Timings of every step of a run, written as a report next to the tool logs.
+
+For each bracket and stage this records how long the step waited for a free worker
+(and, when merging, for room in the memory budget), how long it ran, and for the
+external tools the CPU time and peak memory of the child process. At the end of a
+run the rows of each output folder are saved as Merged/logs/run_report_*.json and
+.csv, and a table per stage is printed so it's clear which stage to give more
+workers.
+"""
+
+import csv
+import json
+import pathlib
+import sys
+import threading
+from datetime import datetime
+from statistics import mean
+
+from pipeline import STAGES
+
+# Columns of the CSV report, in order
+FIELDS = (
+    "folder",
+    "bracket",
+    "stage",
+    "tool",
+    "queue_wait",
+    "wall",
+    "cpu_user",
+    "cpu_sys",
+    "max_rss_mb",
+    "worker",
+)
+
+
+def get_child_usage(rusage) -> dict:
+    """CPU seconds and peak memory of a child process from its resource usage."""
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    rss_bytes = (
+        rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    )
+    return {
+        "cpu_user": rusage.ru_utime,
+        "cpu_sys": rusage.ru_stime,
+        "max_rss_mb": rss_bytes / 1024**2,
+    }
+
+
+class RunReport:
+    """The timing rows of one run, safe to add to from the stage threads."""
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.rows = {}  # (out folder, folder name, bracket, stage) -> row
+        self._lock = threading.Lock()
+
+    def record(self, out_folder, folder_name: str, bracket, stage: str, **values):
+        """Add values to the row of one step, creating it on first use.
+
+        bracket is None for steps done once per folder, like RAW conversion."""
+        key = (str(out_folder), folder_name, bracket, stage)
+        with self._lock:
+            row = self.rows.setdefault(
+                key,
+                {
+                    "out_folder": str(out_folder),
+                    "folder": folder_name,
+                    "bracket": bracket,
+                    "stage": stage,
+                },
+            )
+            row.update(values)
+
+    def record_job(self, job, stage: str, **values):
+        self.record(job.out_folder, job.folder.name, job.index, stage, **values)
+
+    def add_rows(self, rows: list):
+        """Add rows recorded elsewhere, e.g. by a worker on another machine."""
+        for row in rows:
+            row = dict(row)
+            self.record(
+                row.pop("out_folder"),
+                row.pop("folder"),
+                row.pop("bracket"),
+                row.pop("stage"),
+                **row
+            )
+
+    def job_rows(self, job) -> list:
+        """The rows of a single bracket, as plain dicts that can be sent as JSON."""
+        out_folder = str(job.out_folder)
+        with self._lock:
+            return [
+                dict(row)
+                for key, row in self.rows.items()
+                if key[0] == out_folder
+                and key[1] == job.folder.name
+                and key[2] == job.index
+            ]
+
+    def write(self, settings: dict = None) -> list:
+        """Save the rows of each output folder to its logs folder as JSON and CSV.
+
+        settings (e.g. the workers per stage) are included in the JSON to make
+        reports of different runs comparable. Returns the paths written."""
+        with self._lock:
+            rows = list(self.rows.values())
+        by_folder = {}
+        for row in rows:
+            by_folder.setdefault(row["out_folder"], []).append(row)
+
+        timestamp = self.started.strftime("%Y%m%d_%H%M%S")
+        paths = []
+        for out_folder, folder_rows in by_folder.items():
+            folder_rows = [
+                {k: v for k, v in row.items() if k != "out_folder"}
+                for row in folder_rows
+            ]
+            folder_rows.sort(
+                key=lambda r: (
+                    r["folder"],
+                    -1 if r["bracket"] is None else r["bracket"],
+                    self.stage_order(r["stage"]),
+                )
+            )
+            logs_folder = pathlib.Path(out_folder) / "logs"
+            logs_folder.mkdir(parents=True, exist_ok=True)
+
+            json_path = logs_folder / ("run_report_%s.json" % timestamp)
+            with json_path.open("w") as f:
+                json.dump(
+                    {
+                        "started": self.started.isoformat(timespec="seconds"),
+                        "settings": settings or {},
+                        "steps": folder_rows,
+                        "stages": self.summary(folder_rows),
+                    },
+                    f,
+                    indent=2,
+                )
+
+            csv_path = logs_folder / ("run_report_%s.csv" % timestamp)
+            with csv_path.open("w", newline="") as f:
+                writer = csv.DictWriter(f, FIELDS, extrasaction="ignore")
+                writer.writeheader()
+                for row in folder_rows:
+                    writer.writerow(
+                        {
+                            k: "%.3f" % v if isinstance(v, float) else v
+                            for k, v in row.items()
+                        }
+                    )
+            paths += [json_path, csv_path]
+        return paths
+
+    @staticmethod
+    def stage_order(stage: str) -> int:
+        # Finding the brackets and waiting in the job queue come before any stage
+        return STAGES.index(stage) if stage in STAGES else -1
+
+    def summary(self, rows: list = None) -> dict:
+        """Totals per stage: steps, wall and wait times, CPU time and peak memory."""
+        if rows is None:
+            with self._lock:
+                rows = list(self.rows.values())
+        stages = {}
+        for row in rows:
+            stages.setdefault(row["stage"], []).append(row)
+
+        summary = {}
+        for stage in sorted(stages, key=self.stage_order):
+            stage_rows = stages[stage]
+            wall = [r["wall"] for r in stage_rows if "wall" in r]
+            wait = [r["queue_wait"] for r in stage_rows if "queue_wait" in r]
+            cpu = [r["cpu_user"] + r["cpu_sys"] for r in stage_rows if "cpu_user" in r]
+            rss = [r["max_rss_mb"] for r in stage_rows if "max_rss_mb" in r]
+            summary[stage] = {
+                "steps": len(stage_rows),
+                "wall_total": sum(wall),
+                "wall_mean": mean(wall) if wall else None,
+                "wall_max": max(wall, default=None),
+                "queue_wait_total": sum(wait),
+                "queue_wait_mean": mean(wait) if wait else None,
+                "cpu_total": sum(cpu) if cpu else None,
+                "max_rss_mb": max(rss, default=None),
+            }
+        return summary
+
+    def summary_table(self) -> str:
+        """The summary as a table for the console."""
+        summary = self.summary()
+        if not summary:
+            return ""
+
+        def seconds(value):
+            return "-" if value is None else "%.1fs" % value
+
+        lines = [
+            "%-8s %6s %10s %9s %9s %10s %10s %9s"
+            % ("Stage", "Steps", "Wall", "Mean", "Max", "Wait mean", "CPU", "Peak RSS")
+        ]
+        for stage, s in summary.items():
+            lines.append(
+                "%-8s %6d %10s %9s %9s %10s %10s %9s"
+                % (
+                    stage,
+                    s["steps"],
+                    seconds(s["wall_total"]),
+                    seconds(s["wall_mean"]),
+                    seconds(s["wall_max"]),
+                    seconds(s["queue_wait_mean"]),
+                    seconds(s["cpu_total"]),
+                    "-" if s["max_rss_mb"] is None else "%.0f MB" % s["max_rss_mb"],
+                )
+            )
+        waits = {stage: s["queue_wait_total"] for stage, s in summary.items()}
+        slowest = max(waits, key=waits.get)
+        if waits[slowest] > 0:
+            lines.append(
+                "Brackets waited longest for the %s stage (%.1fs in total)"
+                % (slowest, waits[slowest])
+            )
+        return "\n".join(lines)
@@ -0,0 +1,46 @@
+import exif_index
+from exif_index import ExifIndex
+
+
+def fake_exif(reads: list):
+    def get_exif(filepath):
+        reads.append(filepath.name)
+        return {"resolution": "4x2", "shutter_speed": len(reads), "timestamp": None}
+
+    return get_exif
+
+
+def test_unchanged_files_are_not_read_again(tmp_path, monkeypatch):
+    reads = []
+    monkeypatch.setattr(exif_index, "get_exif", fake_exif(reads))
+    image = tmp_path / "a.tif"
+    image.write_bytes(b"1")
+    index_path = tmp_path / "cache" / "exif_index.jsonl"
+
+    first = ExifIndex(index_path).get(image)
+    assert ExifIndex(index_path).get(image) == first
+    assert reads == ["a.tif"]
+
+    image.write_bytes(b"22")
+    assert ExifIndex(index_path).get(image) != first
+    assert reads == ["a.tif", "a.tif"]
+
+
+def test_unwritable_index_warns_once(tmp_path, monkeypatch, capsys):
+    reads = []
+    monkeypatch.setattr(exif_index, "get_exif", fake_exif(reads))
+    (tmp_path / "not_a_folder").write_text("")
+    index = ExifIndex(tmp_path / "not_a_folder" / "exif_index.jsonl")
+    for name in ("a.tif", "b.tif"):
+        (tmp_path / name).write_bytes(b"1")
+        index.get(tmp_path / name)
+    index._rewrite()
+
+    assert reads == ["a.tif", "b.tif"]
+    assert capsys.readouterr().out.count("Warning") == 1
+
+
+def test_default_path_is_outside_the_script_folder(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(exif_index.sys, "platform", "linux")
+    assert exif_index.get_index_path().parent.parent == tmp_path
@@ -0,0 +1,85 @@
+from grouping import group_brackets, usual_sequence
+
+SHUTTER = {"0": 1 / 60, "-": 1 / 250, "+": 1 / 15, "++": 1 / 4, "--": 1 / 1000}
+
+
+def make_exifs(sequence: str, timestamps: list = None) -> list:
+    """EXIF data for frames given as space separated EVs, e.g. "0 - +"."""
+    exifs = []
+    for i, ev in enumerate(sequence.split()):
+        exif = {"shutter_speed": SHUTTER[ev], "aperture": 8, "iso": 100}
+        if timestamps is not None:
+            exif["timestamp"] = timestamps[i]
+        exifs.append(exif)
+    return exifs
+
+
+def evs(sequence: str, sets: list) -> list:
+    frames = sequence.split()
+    return [" ".join(frames[i] for i in s) for s in sets]
+
+
+def shot_times(set_sizes: list, frame_gap=0.5, set_gap=5.0) -> list:
+    times = []
+    t = 0.0
+    for size in set_sizes:
+        for _ in range(size):
+            times.append(t)
+            t += frame_gap
+        t += set_gap
+    return times
+
+
+def test_regular_sets():
+    sequence = "0 - + 0 - + 0 - +"
+    assert evs(sequence, group_brackets(make_exifs(sequence))) == ["0 - +"] * 3
+
+
+def test_empty():
+    assert group_brackets([]) == []
+
+
+def test_dropped_frame_without_timestamps():
+    sequence = "0 - + - + 0 - + 0 - +"
+    sets = group_brackets(make_exifs(sequence))
+    assert evs(sequence, sets) == ["0 - +", "- +", "0 - +", "0 - +"]
+
+
+def test_extra_frame_without_timestamps():
+    sequence = "0 - + 0 - + + 0 - + 0 - +"
+    sets = group_brackets(make_exifs(sequence))
+    assert evs(sequence, sets) == ["0 - +", "0 - +", "+", "0 - +", "0 - +"]
+
+
+def test_dropped_first_frame_without_timestamps():
+    sequence = "0 - + 0 - + - + 0 - +"
+    sets = group_brackets(make_exifs(sequence))
+    assert evs(sequence, sets) == ["0 - +", "0 - +", "- +", "0 - +"]
+
+
+def test_variable_length_sets():
+    sequence = "0 - + 0 - + -- ++ 0 - + -- ++ 0 - +"
+    sets = group_brackets(make_exifs(sequence))
+    assert evs(sequence, sets) == ["0 - +", "0 - + -- ++", "0 - + -- ++", "0 - +"]
+
+
+def test_dropped_frames_with_timestamps():
+    # The list starts mid-set and the third set is missing its first frame
+    sequence = "- + 0 - + - + 0 - + 0 - +"
+    times = shot_times([2, 3, 2, 3, 3])
+    sets = group_brackets(make_exifs(sequence, times))
+    assert evs(sequence, sets) == ["- +", "0 - +", "- +", "0 - +", "0 - +"]
+
+
+def test_pause_splits_sets_of_equal_exposures():
+    # Without a repeat or order change, only the pause separates these sets
+    sequence = "0 - 0 - + 0 - +"
+    times = shot_times([2, 3, 3])
+    sets = group_brackets(make_exifs(sequence, times))
+    assert evs(sequence, sets) == ["0 -", "0 - +", "0 - +"]
+
+
+def test_usual_sequence_is_rotation_invariant():
+    exifs = make_exifs("+ 0 - + 0 - + 0 - +", shot_times([1, 3, 3, 3]))
+    order = sorted(usual_sequence(exifs).items(), key=lambda item: item[1])
+    assert [key[0] for key, _ in order] == [SHUTTER[ev] for ev in ("0", "-", "+")]
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import tifffile
+
+from image_io import (
+    EXR_COMPRESSIONS,
+    ExrWriter,
+    StripReader,
+    load_image,
+    memmap_tiff,
+    to_linear,
+    write_exr,
+)
+
+
+def make_image(height=70, width=20):
+    rng = np.random.default_rng(0)
+    return rng.uniform(0, 50, (height, width, 3)).astype(np.float32)
+
+
+@pytest.mark.parametrize("compression", sorted(set(EXR_COMPRESSIONS) - {"dwaa"}))
+def test_exr_round_trip(tmp_path, compression):
+    img = make_image()
+    path = tmp_path / "merged.exr"
+    write_exr(path, img, compression)
+    np.testing.assert_array_equal(load_image(path), img)
+
+
+def test_exr_half_precision(tmp_path):
+    img = make_image()
+    path = tmp_path / "merged.exr"
+    write_exr(path, img, "zip", "half")
+    np.testing.assert_allclose(load_image(path), img, rtol=1e-3)
+    assert path.stat().st_size < img.nbytes / 2
+
+
+def test_exr_written_in_strips(tmp_path):
+    img = make_image()
+    path = tmp_path / "merged.exr"
+    with ExrWriter(path, 20, 70) as out:
+        for start, stop in [(0, 3), (3, 40), (40, 70)]:
+            out.write(img[start:stop])
+    assert out.rows_written == 70
+    with StripReader(path) as reader:
+        np.testing.assert_array_equal(reader.read(10, 45), img[10:45])
+
+
+def test_exr_missing_rows(tmp_path):
+    with pytest.raises(RuntimeError):
+        with ExrWriter(tmp_path / "merged.exr", 20, 70) as out:
+            out.write(make_image(height=10))
+
+
+def test_exr_error_is_not_hidden(tmp_path):
+    with pytest.raises(ZeroDivisionError):
+        with ExrWriter(tmp_path / "merged.exr", 20, 70):
+            1 / 0
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_tiff_strips_match_whole_image(tmp_path, compression):
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 65535, (50, 12, 3), dtype=np.uint16)
+    path = tmp_path / "img.tif"
+    tifffile.imwrite(
+        str(path), pixels, photometric="rgb", compression=compression, rowsperstrip=8
+    )
+    assert (memmap_tiff(path) is None) == (compression is not None)
+    whole = load_image(path)
+    np.testing.assert_allclose(whole, to_linear(pixels))
+    with StripReader(path) as reader:
+        assert (reader.height, reader.width) == (50, 12)
+        for start, stop in [(0, 5), (5, 17), (17, 50)]:
+            np.testing.assert_array_equal(reader.read(start, stop), whole[start:stop])
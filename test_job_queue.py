@@ -0,0 +1,84 @@
+import os
+import time
+
+from job_queue import MAX_ATTEMPTS, FolderQueue
+
+
+def expire(queue: FolderQueue, job_id: str):
+    """Make a lease look like its worker stopped touching it long ago."""
+    lease_path = queue.path / "leased" / (job_id + ".json")
+    old = time.time() - queue.lease_timeout - 10
+    os.utime(lease_path, (old, old))
+
+
+def test_claim_complete(tmp_path):
+    queue = FolderQueue(tmp_path)
+    queue.put("a", {"job": 1})
+    queue.close()
+    assert not queue.is_finished()
+
+    lease = queue.claim()
+    assert lease.job_id == "a"
+    assert lease.job["attempts"] == 1
+    assert queue.claim() is None
+
+    assert lease.complete({"ok": True})
+    assert queue.is_finished()
+    finished = list(queue.finished_jobs(set()))
+    assert [(job_id, ok) for job_id, _, ok in finished] == [("a", True)]
+    assert finished[0][1]["result"] == {"ok": True}
+
+
+def test_fail_retries_then_fails(tmp_path):
+    queue = FolderQueue(tmp_path)
+    queue.put("a", {"job": 1})
+    for attempt in range(MAX_ATTEMPTS):
+        lease = queue.claim()
+        assert lease.job["attempts"] == attempt + 1
+        assert lease.fail("boom")
+    assert queue.claim() is None
+    assert queue.counts() == {"pending": 0, "leased": 0, "done": 0, "failed": 1}
+    ((_, job, ok),) = queue.finished_jobs(set())
+    assert not ok
+    assert len(job["errors"]) == MAX_ATTEMPTS
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = FolderQueue(tmp_path, lease_timeout=60)
+    queue.put("a", {"job": 1})
+    lease = queue.claim()
+    assert queue.requeue_expired() == []
+    expire(queue, "a")
+    assert queue.requeue_expired() == ["a"]
+    assert not lease.heartbeat()
+    assert queue.claim().job["attempts"] == 2
+
+
+def test_crashed_attempts_fail_with_an_error(tmp_path):
+    queue = FolderQueue(tmp_path, lease_timeout=60)
+    queue.put("a", {"job": 1})
+    for _ in range(MAX_ATTEMPTS):
+        queue.claim()
+        expire(queue, "a")
+        queue.requeue_expired()
+    assert queue.claim() is None
+    ((_, job, ok),) = queue.finished_jobs(set())
+    assert not ok
+    assert job["errors"] == ["Lease expired after %d attempts" % MAX_ATTEMPTS]
+
+
+def test_expired_lease_cannot_complete_a_new_claim(tmp_path):
+    queue = FolderQueue(tmp_path, lease_timeout=60)
+    queue.put("a", {"job": 1})
+    stale = queue.claim()
+    expire(queue, "a")
+    queue.requeue_expired()
+    # The job is claimed again, possibly by the same process
+    current = queue.claim()
+
+    assert not stale.complete({"by": "stale"})
+    assert not stale.fail("late")
+    assert current.complete({"by": "current"})
+    ((_, job, _),) = queue.finished_jobs(set())
+    assert job["result"] == {"by": "current"}
+
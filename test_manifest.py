@@ -0,0 +1,89 @@
+import os
+
+from manifest import BuildManifest, commit_output, partial_path
+
+
+def make_bracket(folder, names: list) -> list:
+    img_list = []
+    for ev, name in enumerate(names):
+        path = folder / name
+        path.write_bytes(name.encode())
+        img_list.append("%s___%d" % (path.as_posix(), ev))
+    return img_list
+
+
+def write_outputs(out_folder, name: str) -> list:
+    outputs = [
+        out_folder / "exr" / (name + ".exr"),
+        out_folder / "jpg" / (name + ".jpg"),
+    ]
+    for path in outputs:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    return outputs
+
+
+def test_up_to_date_until_an_input_changes(tmp_path):
+    out_folder = tmp_path / "Merged"
+    img_list = make_bracket(tmp_path, ["a.tif", "b.tif"])
+    signature = BuildManifest.signature(img_list, {"backend": "numpy"})
+    manifest = BuildManifest(out_folder)
+    assert not manifest.is_up_to_date("merged_000", signature)
+
+    manifest.record("merged_000", signature, write_outputs(out_folder, "merged_000"))
+    manifest.flush()
+    reloaded = BuildManifest(out_folder)
+    assert reloaded.is_up_to_date("merged_000", signature)
+    other_settings = BuildManifest.signature(img_list, {"backend": "blender"})
+    assert not reloaded.is_up_to_date("merged_000", other_settings)
+
+    (tmp_path / "b.tif").write_bytes(b"changed")
+    changed = BuildManifest.signature(img_list, {"backend": "numpy"})
+    assert not reloaded.is_up_to_date("merged_000", changed)
+
+
+def test_missing_output_is_not_up_to_date(tmp_path):
+    out_folder = tmp_path / "Merged"
+    signature = BuildManifest.signature(make_bracket(tmp_path, ["a.tif"]), {})
+    manifest = BuildManifest(out_folder)
+    outputs = write_outputs(out_folder, "merged_000")
+    manifest.record("merged_000", signature, outputs)
+    outputs[1].unlink()
+    assert not manifest.is_up_to_date("merged_000", signature)
+
+
+def test_reconcile_renames_shifted_outputs(tmp_path):
+    out_folder = tmp_path / "Merged"
+    first = make_bracket(tmp_path, ["a.tif", "b.tif"])
+    second = make_bracket(tmp_path, ["c.tif", "d.tif"])
+    signatures = [BuildManifest.signature(s, {}) for s in (first, second)]
+    manifest = BuildManifest(out_folder)
+    for i, signature in enumerate(signatures):
+        name = "merged_%03d" % i
+        manifest.record(name, signature, write_outputs(out_folder, name))
+
+    # A new bracket was added in front, so both move up by one
+    new = BuildManifest.signature(make_bracket(tmp_path, ["0.tif", "1.tif"]), {})
+    planned = {
+        "merged_000": new,
+        "merged_001": signatures[0],
+        "merged_002": signatures[1],
+    }
+    manifest.reconcile(planned)
+
+    assert not manifest.is_up_to_date("merged_000", new)
+    assert manifest.is_up_to_date("merged_001", signatures[0])
+    assert manifest.is_up_to_date("merged_002", signatures[1])
+    assert (out_folder / "exr" / "merged_001.exr").read_text() == "merged_000"
+    assert (out_folder / "jpg" / "merged_002.jpg").read_text() == "merged_001"
+    assert not (out_folder / "exr" / "merged_000.exr").exists()
+    assert BuildManifest(out_folder).is_up_to_date("merged_002", signatures[1])
+
+
+def test_partial_outputs_are_committed_by_rename(tmp_path):
+    path = tmp_path / "merged_000.exr"
+    assert partial_path(path).suffix == ".exr"
+    partial_path(path).write_text("done")
+    commit_output(path)
+    assert path.read_text() == "done"
+    assert os.listdir(tmp_path) == ["merged_000.exr"]
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+import numpy_merge
+from align import warp
+from image_io import StripReader, load_image, write_tiff16
+from numpy_merge import (
+    clip_weight,
+    merge_brackets,
+    merge_brackets_weighted,
+    merge_exposures,
+    merge_weighted,
+    source_rows,
+    warp_strip,
+)
+
+
+def make_scene(height=8, width=64):
+    """Linear radiance from deep shadows to well above the brightest exposure's
+    clipping point."""
+    ramp = np.logspace(-3, 1, width, dtype=np.float32)
+    scene = np.repeat(ramp[None, :, None], height, axis=0).repeat(3, axis=2)
+    scene[:, :, 0] *= 0.8
+    return scene
+
+
+def expose(scene, ev):
+    """What an exposure EV stops darker than the brightest one records."""
+    return np.clip(scene / 2.0**ev, 0.0, 1.0).astype(np.float32)
+
+
+def test_clip_weight():
+    img = np.array([[[0.1, 0.2, 0.3], [0.5, 0.96, 0.1]]], dtype=np.float32)
+    weight = clip_weight(img)
+    assert weight.shape == (1, 2, 1)
+    assert weight[0, 0, 0] == 0
+    assert weight[0, 1, 0] == 1
+
+
+def test_merge_recovers_the_scene():
+    scene = make_scene()
+    evs = [0, 2, 4, 6]
+    merged = merge_exposures((expose(scene, ev), ev) for ev in evs)
+    # Everything below the darkest exposure's own clipping point is recovered
+    valid = scene.max(axis=2) < 0.7 * 2.0 ** evs[-1]
+    np.testing.assert_allclose(merged[valid], scene[valid], rtol=1e-4)
+
+
+def test_first_exposure_is_scaled_by_its_ev():
+    # A set missing the folder's brightest exposure starts at EV 2
+    scene = make_scene()
+    full = merge_exposures((expose(scene, ev), ev) for ev in [0, 2, 4])
+    missing = merge_exposures((expose(scene, ev), ev) for ev in [2, 4])
+    dark = scene.max(axis=2) < 0.5
+    np.testing.assert_allclose(missing[dark], full[dark], rtol=1e-4)
+
+
+def test_merge_brackets_sorts_by_ev(tmp_path):
+    scene = make_scene()
+    img_list = []
+    for ev in [4, 0, 2]:
+        path = tmp_path / ("ev%d.tif" % ev)
+        write_tiff16(path, expose(scene, ev))
+        img_list.append("%s___%d" % (path.as_posix(), ev))
+    merged = merge_brackets(img_list)
+    valid = scene.max(axis=2) < 0.7 * 2.0**4
+    # 16-bit sRGB is only precise to a fraction of a percent in the shadows
+    np.testing.assert_allclose(merged[valid], scene[valid], rtol=0.02, atol=1e-4)
+
+
+def test_merge_brackets_needs_images():
+    with pytest.raises(ValueError):
+        merge_brackets([])
+
+
+def test_weighted_merge_recovers_the_scene():
+    scene = make_scene()
+    evs = [0, 2, 4]
+    merged = merge_weighted([expose(scene, ev) for ev in evs], evs, 1)
+    valid = scene.max(axis=2) < 0.7 * 2.0 ** evs[-1]
+    np.testing.assert_allclose(merged[valid], scene[valid], rtol=1e-3)
+
+
+def test_weighted_merge_leaves_out_ghosts():
+    scene = make_scene()
+    evs = [0, 2, 4]
+    strips = [expose(scene, ev) for ev in evs]
+    # Something bright moved through a dark area of the darkest exposure
+    strips[2][:, 8:12] = 0.5
+    merged = merge_weighted(strips, evs, 1)
+    np.testing.assert_allclose(merged[:, 8:12], scene[:, 8:12], rtol=1e-3)
+
+
+def test_weighted_strips_match_whole_merge(tmp_path, monkeypatch):
+    monkeypatch.setattr(numpy_merge, "STRIP_ROWS", 5)
+    scene = make_scene(height=23)
+    evs = [0, 2, 4]
+    img_list = []
+    for ev in evs:
+        path = tmp_path / ("ev%d.tif" % ev)
+        write_tiff16(path, expose(scene, ev))
+        img_list.append("%s___%d" % (path.as_posix(), ev))
+    shift = [[1, 0, 0.5], [0, 1, 2.25]]
+    transforms = [None, shift, None]
+
+    merged = merge_brackets_weighted(img_list, transforms)
+    images = [
+        warp(load_image(path), t)
+        for path, t in zip(sorted(tmp_path.iterdir()), transforms)
+    ]
+    expected = merge_weighted(images, evs, 1)
+    np.testing.assert_allclose(merged, expected, rtol=1e-5, atol=1e-7)
+
+
+@pytest.mark.parametrize(
+    "transform",
+    [None, [[1, 0, 3.5], [0, 1, -4.25]], [[0.99, -0.05, 2.0], [0.05, 0.99, 6.0]]],
+)
+def test_warp_strip_matches_warp(tmp_path, transform):
+    rng = np.random.default_rng(1)
+    img = rng.uniform(0, 1, (40, 30, 3)).astype(np.float32)
+    path = tmp_path / "img.tif"
+    write_tiff16(path, img)
+    whole = warp(load_image(path), transform)
+    with StripReader(path) as reader:
+        for start, stop in [(0, 7), (7, 20), (33, 40)]:
+            first, last = source_rows(transform, start, stop, 30, 40)
+            assert 0 <= first < last <= 40
+            strip = warp_strip(reader, transform, start, stop)
+            np.testing.assert_allclose(strip, whole[start:stop], atol=1e-5)
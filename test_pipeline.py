@@ -0,0 +1,167 @@
+import threading
+
+import pytest
+
+from pipeline import (
+    BYTES_PER_PIXEL,
+    MemoryBudget,
+    StagedPipeline,
+    estimate_merge_memory,
+    get_memory_budget,
+)
+
+
+def test_steps_run_in_order_on_their_stage():
+    ran = []
+    with StagedPipeline({"merge": 2}) as pipeline:
+        future = pipeline.submit(
+            [
+                (
+                    "align",
+                    lambda: ran.append(("align", threading.current_thread().name)),
+                ),
+                (
+                    "merge",
+                    lambda: ran.append(("merge", threading.current_thread().name)),
+                ),
+                (
+                    "tonemap",
+                    lambda: ran.append(("tonemap", threading.current_thread().name)),
+                ),
+            ]
+        )
+    assert future.result() is None
+    assert [stage for stage, _ in ran] == ["align", "merge", "tonemap"]
+    for stage, thread in ran:
+        assert thread.startswith("hdr_%s" % stage)
+
+
+def test_failed_step_stops_the_chain():
+    ran = []
+
+    def fail():
+        raise ValueError("bad bracket")
+
+    with StagedPipeline({}) as pipeline:
+        failed = pipeline.submit(
+            [("align", fail), ("merge", lambda: ran.append("merge"))]
+        )
+        other = pipeline.submit([("merge", lambda: ran.append("other"))])
+    with pytest.raises(ValueError):
+        failed.result()
+    assert other.result() is None
+    assert ran == ["other"]
+
+
+def test_empty_chain_completes():
+    with StagedPipeline({}) as pipeline:
+        assert pipeline.submit([]).result() is None
+
+
+def test_on_step_is_called_for_tagged_chains():
+    steps = []
+    with StagedPipeline(
+        {}, on_step=lambda tag, stage, *times: steps.append((tag, stage, times))
+    ) as pipeline:
+        pipeline.submit([("align", lambda: None), ("merge", lambda: None)], tag="b1")
+        pipeline.submit([("merge", lambda: None)])
+    assert [(tag, stage) for tag, stage, _ in steps] == [
+        ("b1", "align"),
+        ("b1", "merge"),
+    ]
+    for _, _, (queued, started, finished) in steps:
+        assert queued <= started <= finished
+
+
+def test_stages_overlap():
+    # The merge of the first bracket waits for the align of the second, which can
+    # only happen if the two stages run at the same time
+    aligned = threading.Event()
+
+    def merge():
+        assert aligned.wait(5)
+
+    with StagedPipeline({}) as pipeline:
+        first = pipeline.submit([("merge", merge)])
+        second = pipeline.submit([("align", aligned.set)])
+    first.result()
+    second.result()
+
+
+def test_memory_budget_limits_concurrent_steps():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def merge():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        threading.Event().wait(0.02)
+        with lock:
+            running.pop()
+
+    budget = MemoryBudget(250)
+    with StagedPipeline({"merge": 8}, budget) as pipeline:
+        for _ in range(8):
+            pipeline.submit([("merge", merge, 100)])
+    assert max(peak) == 2
+    assert budget.reserved == 0
+
+
+def test_memory_budget_admits_oversized_step_alone():
+    budget = MemoryBudget(100)
+    budget.acquire(500)
+    assert budget.reserved == 500
+    admitted = threading.Event()
+
+    def acquire():
+        budget.acquire(10)
+        admitted.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not admitted.wait(0.05)
+    budget.release(500)
+    assert admitted.wait(5)
+    thread.join()
+
+
+def test_memory_can_depend_on_earlier_steps():
+    state = {}
+    budget = MemoryBudget(0)
+    with StagedPipeline({}, budget) as pipeline:
+        future = pipeline.submit(
+            [
+                ("raw", lambda: state.update(size=123)),
+                (
+                    "merge",
+                    lambda: state.update(reserved=budget.reserved),
+                    lambda: state["size"],
+                ),
+            ]
+        )
+    future.result()
+    assert state["reserved"] == 123
+
+
+@pytest.mark.parametrize(
+    "resolution, images, backend, strip_rows",
+    [
+        ("6000x4000", 3, "numpy", 0),
+        ("6000x4000", 5, "blender", 0),
+        ("6000x4000", 5, "numpy", 256),
+    ],
+)
+def test_estimate_merge_memory(resolution, images, backend, strip_rows):
+    estimate = estimate_merge_memory(resolution, images, backend, strip_rows)
+    whole = 6000 * 4000 * BYTES_PER_PIXEL
+    if strip_rows:
+        assert 2 * whole < estimate < (images + 2) * whole
+    else:
+        assert estimate >= (images + 2) * whole
+
+
+def test_get_memory_budget():
+    assert get_memory_budget("0") == 0
+    assert get_memory_budget("1.5") == int(1.5 * 1024**3)
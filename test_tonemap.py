@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from tonemap import OPERATORS, tonemap
+
+
+def gradient(height=16, width=32):
+    ramp = np.logspace(-3, 2, width, dtype=np.float32)
+    img = np.repeat(ramp[None, :, None], height, axis=0).repeat(3, axis=2)
+    img[:, :, 2] *= 0.5
+    return img
+
+
+@pytest.mark.parametrize("operator", sorted(OPERATORS))
+def test_output_is_8bit_and_monotonic(operator):
+    out = tonemap(gradient(), operator)
+    assert out.dtype == np.uint8
+    assert out.shape == (16, 32, 3)
+    green = out[0, :, 1].astype(int)
+    assert (np.diff(green) >= 0).all()
+    assert green[-1] > green[0]
+
+
+@pytest.mark.parametrize("operator", sorted(OPERATORS))
+def test_slightly_negative_pixels(operator):
+    img = gradient()
+    expected = tonemap(img, operator)
+    img[0, 0] = -1e-4
+    out = tonemap(img, operator)
+    assert out[0, 0].tolist() == [0, 0, 0]
+    # The rest of the image isn't turned black
+    assert out[1:].mean() > expected[1:].mean() / 2
+
+
+@pytest.mark.parametrize("operator", sorted(OPERATORS))
+def test_black_image(operator):
+    out = tonemap(np.zeros((4, 4, 3), dtype=np.float32), operator)
+    assert out.max() == 0
@@ -0,0 +1,131 @@
+"""Built-in tonemapping, an in-process alternative to luminance-hdr-cli.
+
+The JPGs are only used for stitching, so rather than starting Luminance for every
+bracket and having it read the EXR back from disk, the merged image is tonemapped
+with NumPy while it is still in memory. The operators follow the global versions of
+those in Luminance HDR, with its default parameters, so the JPGs look much the same.
+"""
+
+import functools
+import pathlib
+
+from image_io import linear_to_srgb, luminance, require
+
+# Changing an operator makes brackets tonemapped with it out of date
+TONEMAP_VERSION = 2
+JPG_QUALITY = 98
+# Keeps the logarithms finite in black areas
+EPSILON = 1e-6
+
+
+def non_negative(img):
+    """img and its luminance, with negative values set to 0.
+
+    Merging, half float EXRs and interpolation while aligning can all leave values
+    slightly below 0, which the logarithms and powers below can't take."""
+    np = require("numpy")
+    if float(img.min()) < 0:
+        img = np.maximum(img, 0, dtype=np.float32)
+    return img, luminance(img)
+
+
+def log_average(lum) -> float:
+    np = require("numpy")
+    return float(np.exp(np.mean(np.log(lum + EPSILON))))
+
+
+def scale_colour(img, lum, display_lum):
+    """Scale the colour of every pixel by how much its luminance was changed."""
+    np = require("numpy")
+    ratio = display_lum / (lum + EPSILON)
+    return np.multiply(img, ratio[:, :, None], dtype=np.float32)
+
+
+def reinhard02(img, key: float = 0.18):
+    """Reinhard et al. 2002, "Photographic Tone Reproduction", global operator."""
+    img, lum = non_negative(img)
+    scaled = lum * (key / log_average(lum))
+    white = max(float(scaled.max()), EPSILON)
+    display_lum = scaled * (1 + scaled / white**2) / (1 + scaled)
+    return scale_colour(img, lum, display_lum)
+
+
+def reinhard05(
+    img, brightness: float = 0.0, chromatic: float = 0.0, light: float = 1.0
+):
+    """Reinhard and Devlin 2005, "Dynamic Range Reduction Inspired by
+    Photoreceptor Physiology"."""
+    np = require("numpy")
+    img, lum = non_negative(img)
+    log_lum = np.log(lum + EPSILON)
+    log_min, log_max = float(log_lum.min()), float(log_lum.max())
+    log_av = float(log_lum.mean())
+    k = (log_max - log_av) / (log_max - log_min) if log_max > log_min else 0.5
+    contrast = 0.3 + 0.7 * k**1.4
+    intensity = np.exp(-brightness)
+
+    out = np.empty_like(img, dtype=np.float32)
+    for c in range(3):
+        channel = img[:, :, c]
+        local = chromatic * channel + (1 - chromatic) * lum
+        average = chromatic * float(channel.mean()) + (1 - chromatic) * float(
+            lum.mean()
+        )
+        adaptation = light * local + (1 - light) * average
+        out[:, :, c] = channel / (
+            channel + (intensity * adaptation) ** contrast + EPSILON
+        )
+    low, high = float(out.min()), float(out.max())
+    if high > low:
+        out -= low
+        out /= high - low
+    return out
+
+
+def drago03(img, bias: float = 0.85):
+    """Drago et al. 2003, "Adaptive Logarithmic Mapping For Displaying High
+    Contrast Scenes"."""
+    np = require("numpy")
+    img, lum = non_negative(img)
+    world = lum / log_average(lum)
+    world_max = max(float(world.max()), EPSILON)
+    divider = np.log10(world_max + 1)
+    bias_power = np.log(bias) / np.log(0.5)
+    display_lum = np.log(world + 1) / np.log(2 + 8 * (world / world_max) ** bias_power)
+    display_lum /= divider
+    return scale_colour(img, lum, display_lum)
+
+
+# Operators by the name luminance-hdr-cli's --tmo option uses
+OPERATORS = {
+    "reinhard02": reinhard02,
+    "reinhard05": reinhard05,
+    "drago": drago03,
+}
+
+
+@functools.lru_cache()
+def srgb8_table():
+    """8-bit sRGB values of every 16-bit linear value, as a lookup table."""
+    np = require("numpy")
+    table = linear_to_srgb(np.linspace(0.0, 1.0, 65536, dtype=np.float32))
+    table *= 255
+    table += 0.5
+    return table.astype(np.uint8)
+
+
+def tonemap(img, operator: str = "reinhard02"):
+    """Tonemap a linear HxWx3 image to 8-bit sRGB."""
+    np = require("numpy")
+    out = OPERATORS[operator](img)
+    # Looking the encoding up is much faster than computing it for every pixel
+    np.clip(out, 0.0, 1.0, out=out)
+    out *= 65535
+    out += 0.5
+    return srgb8_table()[out.astype(np.uint16)]
+
+
+def write_jpg(path: pathlib.Path, img, operator: str = "reinhard02"):
+    """Tonemap a linear HxWx3 image and save it as a JPG."""
+    Image = require("PIL.Image", "Pillow")
+    Image.fromarray(tonemap(img, operator)).save(str(path), "JPEG", quality=JPG_QUALITY)
@@ -0,0 +1,39 @@
+"""Turning the console output of external tools into short progress messages.
+
+Each tool's output is read line by line while it runs, and lines that say how far
+along it is are summarised so the GUI can show what every bracket is doing.
+"""
+
+import re
+
+# For each log label, (pattern, message) pairs tried in order. The message is
+# formatted with the match's groups.
+PROGRESS_PATTERNS = {
+    "blender": [
+        (re.compile(r"^Loading:\s+(\d+)\s"), "loading image %s"),
+        (
+            re.compile(r"\|\s*Compositing\s*\|\s*Tile\s+(\d+)-(\d+)"),
+            "compositing %s/%s",
+        ),
+        (re.compile(r"\|\s*Compositing"), "compositing"),
+        (re.compile(r"^Saved:"), "saving EXR"),
+    ],
+    "align": [
+        (re.compile(r"control points between", re.I), "finding control points"),
+        (re.compile(r"^Optimiz", re.I), "optimizing"),
+        (re.compile(r"^(?:Remapping|saving)", re.I), "remapping"),
+    ],
+    "rawtherapee": [
+        (re.compile(r"^Processing:?\s+(?:.*[/\\])?(.+?)\s*$"), "converting %s"),
+    ],
+}
+
+
+def parse_progress(label: str, line: str):
+    """Summarise a line of a tool's output, or None if it isn't a progress line."""
+    for pattern, message in PROGRESS_PATTERNS.get(label, []):
+        match = pattern.search(line)
+        if match:
+            groups = match.groups()
+            return message % groups if groups else message
+    return None